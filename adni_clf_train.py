@@ -17,9 +17,19 @@ import adni_data_loader_all
 import config.system as sys_config
 import clf_model_multitask as model_mt
 import utils
+import label_encodings
 from batch_generator_list import iterate_minibatches
+import input_pipeline
+from augmentation_pool import AugmentationPool
+from tfwrapper import augmentation
+from tfwrapper.gradient_accumulation import GradientAccumulator
 import data_utils
+import data_parallel
+from checkpoint_writer import CheckpointWriter
+from step_profiler import StepProfiler
+from resident_eval_set import ResidentEvalSet
 import gan_model
+from translation_cache import open_translation_cache, TranslatedImages
 
 
 
@@ -48,9 +58,14 @@ def _list_mean(list_of_arrays):
     return sum(mean_list)/len(mean_list)
 
 
-def run_training(continue_run, log_dir):
+def run_training(continue_run, log_dir, worker=None):
+    '''
+    :param worker: data_parallel.DataParallelWorker if the training runs in several worker processes. Only the chief
+    (worker 0) evaluates and writes the summaries and checkpoints
+    '''
 
     logging.info('EXPERIMENT NAME: %s' % exp_config.experiment_name)
+    is_chief = worker is None or worker.is_chief
 
     init_step = 0
 
@@ -81,9 +96,9 @@ def run_training(continue_run, log_dir):
         force_overwrite=False
     )
 
-    # the following are HDF5 datasets, not numpy arrays
-    labels_train = data['diagnosis_train']
-    ages_train = data['age_train']
+    # the diagnoses are precomputed in the standard range of label_list (see label_encodings), so the batches are not
+    # mapped again
+    labels_train = label_encodings.diagnosis_labels(data, 'train', exp_config.label_list)
 
     images_train, source_images_train_ind, target_images_train_ind, \
     images_val, source_images_val_ind, target_images_val_ind = data_utils.get_images_and_fieldstrength_indices(data, exp_config.source_field_strength, exp_config.target_field_strength)
@@ -112,14 +127,13 @@ def run_training(continue_run, log_dir):
 
 
     if exp_config.age_ordinal_regression:
-        ages_train = utils.age_to_ordinal_reg_format(ages_train, bins=exp_config.age_bins)
+        ages_train = label_encodings.age_labels(data, 'train', exp_config.age_bins, ordinal_regression=True)
         ordinal_reg_weights = utils.get_ordinal_reg_weights(ages_train)
     else:
-        ages_train = utils.age_to_bins(ages_train, bins=exp_config.age_bins)
+        ages_train = label_encodings.age_labels(data, 'train', exp_config.age_bins, ordinal_regression=False)
         ordinal_reg_weights = None
 
-    labels_val = data['diagnosis_val']
-    ages_val = data['age_val']
+    labels_val = label_encodings.diagnosis_labels(data, 'val', exp_config.label_list)
 
     # select on which images to train on
     if exp_config.training_domain == 'source':
@@ -136,9 +150,9 @@ def run_training(continue_run, log_dir):
                          ' is not a valid training domain. It must be in {"source", "target", "all"}')
 
     if exp_config.age_ordinal_regression:
-        ages_val = utils.age_to_ordinal_reg_format(ages_val, bins=exp_config.age_bins)
+        ages_val = label_encodings.age_labels(data, 'val', exp_config.age_bins, ordinal_regression=True)
     else:
-        ages_val= utils.age_to_bins(ages_val, bins=exp_config.age_bins)
+        ages_val = label_encodings.age_labels(data, 'val', exp_config.age_bins, ordinal_regression=False)
 
     if exp_config.use_data_fraction:
         num_images = images_train.shape[0]
@@ -149,6 +163,15 @@ def run_training(continue_run, log_dir):
         images_train = images_train[0:new_last_index,...]
         labels_train = labels_train[0:new_last_index,...]
 
+    # in data parallel training every worker trains on its own shard of the training images (the evaluation uses all)
+    if worker is not None:
+        all_train_indices = range(images_train.shape[0]) if train_image_selection is None else train_image_selection
+        train_batch_selection = data_parallel.shard_indices(all_train_indices, worker.rank, worker.n_workers)
+        logging.info('Worker %d of %d trains on %d images, effective batch size %d'
+                     % (worker.rank, worker.n_workers, len(train_batch_selection),
+                        worker.n_workers*exp_config.n_accum_batches*exp_config.batch_size))
+    else:
+        train_batch_selection = train_image_selection
 
     logging.info('Data summary:')
     logging.info(data_utils.data_summary(data))
@@ -171,6 +194,40 @@ def run_training(continue_run, log_dir):
 
     with tf.Graph().as_default():
 
+        # the translated images are read from the translation cache of the generator checkpoint if it exists
+        # (see translation_cache.py) instead of running the generator
+        translation_cache = None
+        if exp_config.use_generator and exp_config.use_translation_cache:
+            gan_config, _ = utils.load_log_exp_config(exp_config.generator_path)
+            gan_checkpoint_path, _ = utils.get_latest_checkpoint_and_step(exp_config.generator_path, 'model.ckpt')
+            noise_seed = exp_config.translation_noise_seed if gan_config.use_generator_input_noise else None
+            translation_cache = open_translation_cache(data, gan_checkpoint_path, noise_seed)
+            if translation_cache is None:
+                logging.warning('No translation cache of %s, the generator is used' % gan_checkpoint_path)
+
+        generator = None
+        if translation_cache is not None:
+            images_train = TranslatedImages(images_train, translation_cache, 'train', exp_config.translation_fraction)
+            images_val = TranslatedImages(images_val, translation_cache, 'val', exp_config.translation_fraction,
+                                          seed=0)
+            generator_augmentation_function = None
+        elif exp_config.use_generator:
+            # build generator graph if generator is used (the generator has its own graph)
+            generator_batch_size = round(exp_config.translation_fraction*exp_config.batch_size)
+            generator = gan_model.Generator(exp_config.generator_path, batch_size=generator_batch_size)
+            generator.restore_variables()
+            generator_augmentation_function = lambda X, y_list: exp_config.augmentation_function(generator, X, y_list)
+        else:
+            generator_augmentation_function = None
+
+        # the validation set is read (and translated by the fixed generator) once and evaluated in the same order
+        # every time. Only the chief evaluates
+        if is_chief:
+            val_set = ResidentEvalSet(images_val, exp_config.batch_size, exp_config, labels_list=[labels_val, ages_val],
+                                      selection_indices=val_image_selection,
+                                      augmentation_function=generator_augmentation_function,
+                                      map_labels_to_standard_range=False, name='validation')
+
         # Generate placeholders for the images and labels.
 
         image_tensor_shape = [exp_config.batch_size] + list(exp_config.image_size) + [1]
@@ -181,17 +238,41 @@ def run_training(continue_run, log_dir):
         else:
             ages_tensor_shape = [exp_config.batch_size]
 
-        images_placeholder = tf.placeholder(tf.float32, shape=image_tensor_shape, name='images')
-        diag_placeholder = tf.placeholder(tf.uint8, shape=labels_tensor_shape, name='labels')
-        ages_placeholder = tf.placeholder(tf.uint8, shape=ages_tensor_shape, name='ages')
+        if exp_config.use_tf_data_pipeline:
+            # the training batches are read by a tf.data pipeline, every training run takes the next batch.
+            # The placeholders can still be fed (e.g. for the evaluation)
+            train_dataset = input_pipeline.epoch_dataset(images_train,
+                                                         [labels_train, ages_train],
+                                                         batch_size=exp_config.batch_size,
+                                                         exp_config=exp_config,
+                                                         label_dtypes=[np.uint8, np.uint8],
+                                                         selection_indices=train_batch_selection,
+                                                         augmentation_function=generator_augmentation_function,
+                                                         map_labels_to_standard_range=False,
+                                                         block_size=exp_config.sampling_block_size,
+                                                         num_parallel_calls=exp_config.pipeline_parallel_reads,
+                                                         prefetch_batches=exp_config.pipeline_prefetch_batches)
+            n_train_images = images_train.shape[0] if train_batch_selection is None else len(train_batch_selection)
+            train_input = input_pipeline.PipelineInput(train_dataset, names=['images', 'labels', 'ages'],
+                                                       batches_per_epoch=n_train_images // exp_config.batch_size)
+            images_placeholder, diag_placeholder, ages_placeholder = train_input.tensors
+        else:
+            train_input = None
+            images_placeholder = tf.placeholder(tf.float32, shape=image_tensor_shape, name='images')
+            diag_placeholder = tf.placeholder(tf.uint8, shape=labels_tensor_shape, name='labels')
+            ages_placeholder = tf.placeholder(tf.uint8, shape=ages_tensor_shape, name='ages')
 
         learning_rate_placeholder = tf.placeholder(tf.float32, shape=[], name='learning_rate')
         training_time_placeholder = tf.placeholder(tf.bool, shape=[], name='training_time')
 
+        # random augmentation of the training batches in the graph (identity when training_time_placeholder is False)
+        images_input = augmentation.augment_images_with_config(images_placeholder, training_time_placeholder,
+                                                               exp_config)
+
         tf.summary.scalar('learning_rate', learning_rate_placeholder)
 
         # Build a Graph that computes predictions from the inference model.
-        diag_logits, ages_logits = exp_config.clf_model_handle(images_placeholder,
+        diag_logits, ages_logits = exp_config.clf_model_handle(images_input,
                                                            nlabels=exp_config.nlabels,
                                                            training=training_time_placeholder,
                                                            n_age_thresholds=len(exp_config.age_bins),
@@ -221,29 +302,11 @@ def run_training(continue_run, log_dir):
         else:
             optimiser = exp_config.optimizer_handle(learning_rate=learning_rate_placeholder)
 
-        # create a copy of all trainable variables with `0` as initial values
+        # the gradients are accumulated over n_accum_batches batches and applied in the same call as the last batch
+        # (in data parallel training they are averaged over the workers before they are applied)
         t_vars = tf.global_variables() #tf.trainable_variables()
-        accum_tvars = [tf.Variable(tf.zeros_like(tv.initialized_value()), trainable=False) for tv in t_vars]
-
-        # create an op to initialize all accums vars
-        zero_ops = [tv.assign(tf.zeros_like(tv)) for tv in accum_tvars]
-
-        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-        with tf.control_dependencies(update_ops):
-            # compute gradients for a batch
-            batch_grads_vars = optimiser.compute_gradients(loss, t_vars)
-
-            # collect the batch gradient into accumulated vars
-
-            accum_ops = [accum_tvar.assign_add(batch_grad_var[0]) for accum_tvar, batch_grad_var in zip(accum_tvars, batch_grads_vars)]
-
-            accum_normaliser_pl = tf.placeholder(dtype=tf.float32, name='accum_normaliser')
-            accum_mean_op = [accum_tvar.assign(tf.divide(accum_tvar, accum_normaliser_pl)) for accum_tvar in accum_tvars]
-
-            # apply accums gradients
-            train_op = optimiser.apply_gradients(
-                [(accum_tvar, batch_grad_var[1]) for accum_tvar, batch_grad_var in zip(accum_tvars, batch_grads_vars)]
-            )
+        accumulator = GradientAccumulator(optimiser, loss, t_vars, n_accum_batches=exp_config.n_accum_batches,
+                                          average_externally=worker is not None)
 
         eval_diag_loss, eval_ages_loss, pred_labels, ages_softmaxs = model_mt.evaluation(diag_logits, ages_logits,
                                                                                          diag_placeholder,
@@ -258,28 +321,25 @@ def run_training(continue_run, log_dir):
         summary = tf.summary.merge_all()
 
         # Add the variable initializer Op.
-        init = tf.global_variables_initializer()
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
 
         # Create a saver for writing training checkpoints.
-        saver = tf.train.Saver(max_to_keep=3)
-        saver_best_diag_f1 = tf.train.Saver(max_to_keep=5)
-        saver_best_ages_f1 = tf.train.Saver(max_to_keep=2)
-        saver_best_xent = tf.train.Saver(max_to_keep=5)
+        # the checkpoints are written in a background thread
+        checkpoint_writer = CheckpointWriter()
+        saver = checkpoint_writer.saver(max_to_keep=3)
+        saver_best_diag_f1 = checkpoint_writer.saver(max_to_keep=5)
+        saver_best_ages_f1 = checkpoint_writer.saver(max_to_keep=2)
+        saver_best_xent = checkpoint_writer.saver(max_to_keep=5)
 
-        # build generator graph if generator is used
-        if exp_config.use_generator:
-            generator_batch_size = round(exp_config.translation_fraction*exp_config.batch_size)
-            generator = gan_model.Generator(exp_config.generator_path, batch_size=generator_batch_size)
-            generator.restore_variables()
-            generator_augmentation_function = lambda X, y_list: exp_config.augmentation_function(generator, X, y_list)
-        else:
-            generator_augmentation_function = None
+        config = tf.ConfigProto()
+        if worker is not None:
+            worker.configure_session(config)
 
         # Create a session for running Ops on the Graph.
-        sess = tf.Session()
+        sess = tf.Session(config=config)
 
         # Instantiate a SummaryWriter to output summaries and the Graph.
-        summary_writer = tf.summary.FileWriter(log_dir, sess.graph)
+        summary_writer = tf.summary.FileWriter(log_dir, sess.graph) if is_chief else None
 
         # with tf.name_scope('monitoring'):
 
@@ -312,6 +372,12 @@ def run_training(continue_run, log_dir):
             # Restore session
             saver.restore(sess, init_checkpoint_path)
 
+        if worker is not None:
+            worker.sync_variables(sess, tf.global_variables())
+
+        if train_input is not None:
+            sess.run(train_input.initializer)
+
         step = init_step
         curr_lr = exp_config.learning_rate
 
@@ -326,18 +392,52 @@ def run_training(continue_run, log_dir):
 
         # acum_manual = 0  #np.zeros((2,3,3,3,1,32))
 
+        if train_input is None and generator_augmentation_function is not None and exp_config.augmentation_workers > 0:
+            augmentation_pool = AugmentationPool(generator_augmentation_function,
+                                                 n_workers=exp_config.augmentation_workers,
+                                                 queue_size=exp_config.augmentation_queue_size,
+                                                 use_processes=exp_config.augmentation_use_processes)
+        else:
+            augmentation_pool = None
+
+        # time of the phases of the steps, optionally with Chrome trace timelines of the session runs (only the chief
+        # logs and traces in data parallel training)
+        profiler = StepProfiler(log_frequency=exp_config.profile_log_frequency if is_chief else 0,
+                                trace_frequency=exp_config.trace_frequency if is_chief else 0,
+                                trace_dir=os.path.join(log_dir, 'timelines'))
+        profiler.start_step(step)
+
         for epoch in range(exp_config.max_epochs):
 
             logging.info('EPOCH %d' % epoch)
-            sess.run(zero_ops)
-            accum_counter = 0
-
-            for batch in iterate_minibatches(images_train,
-                                             [labels_train, ages_train],
-                                             batch_size=exp_config.batch_size,
-                                             selection_indices = train_image_selection,
-                                             augmentation_function=generator_augmentation_function,
-                                             exp_config=exp_config):
+            sess.run(accumulator.reset_op)
+            # number of batches accumulated since the gradients were last applied
+            n_accumulated = 0
+
+            if train_input is not None:
+                # every epoch restarts the dataset, the training runs take the batches from it (they are not fed)
+                train_batches = train_input.iterate_batches(sess)
+            elif augmentation_pool is not None:
+                # the batches are augmented in the workers of the pool while the previous batches are trained on
+                train_batches = augmentation_pool.augmented(iterate_minibatches(images_train,
+                                                                                [labels_train, ages_train],
+                                                                                batch_size=exp_config.batch_size,
+                                                                                selection_indices=train_batch_selection,
+                                                                                augmentation_function=None,
+                                                                                map_labels_to_standard_range=False,
+                                                                                exp_config=exp_config,
+                                                                                block_size=exp_config.sampling_block_size))
+            else:
+                train_batches = iterate_minibatches(images_train,
+                                                   [labels_train, ages_train],
+                                                   batch_size=exp_config.batch_size,
+                                                   selection_indices=train_batch_selection,
+                                                   augmentation_function=generator_augmentation_function,
+                                                   map_labels_to_standard_range=False,
+                                                   exp_config=exp_config,
+                                                   block_size=exp_config.sampling_block_size)
+
+            for batch in profiler.iterate(train_batches, 'data'):
 
 
                 if exp_config.warmup_training:
@@ -348,71 +448,81 @@ def run_training(continue_run, log_dir):
 
                 start_time = time.time()
 
-                # get a batch
-                x, [y, a] = batch
-
-                # TEMPORARY HACK (to avoid incomplete batches
-                # if y.shape[0] < exp_config.batch_size:
-                #     step += 1
-                #     continue
-
-
                 # Run accumulation
                 feed_dict = {
-                    images_placeholder: x,
-                    diag_placeholder: y,
-                    ages_placeholder: a,
                     learning_rate_placeholder: curr_lr,
                     training_time_placeholder: True
                 }
 
-                _, loss_value = sess.run([accum_ops, loss], feed_dict=feed_dict)
-
-                accum_counter += 1
-
-                if accum_counter == exp_config.n_accum_batches:
-
-                    # Average gradient over batches
-                    sess.run(accum_mean_op, feed_dict={accum_normaliser_pl: float(exp_config.n_accum_batches)})
-                    sess.run(train_op, feed_dict=feed_dict)
-
-                    # Reset all counters etc.
-                    sess.run(zero_ops)
-                    accum_counter = 0
+                if batch is not None:
+                    # get a batch
+                    x, [y, a] = batch
+
+                    # TEMPORARY HACK (to avoid incomplete batches
+                    # if y.shape[0] < exp_config.batch_size:
+                    #     step += 1
+                    #     continue
+                    feed_dict.update({
+                        images_placeholder: x,
+                        diag_placeholder: y,
+                        ages_placeholder: a
+                    })
+
+                # the summaries are fetched with the training run (with the tf.data pipeline a separate run would
+                # take the next batch). step only advances when the gradients are applied, so the summary is only
+                # fetched with the last batch of the accumulation
+                applies_gradients = n_accumulated + 1 == exp_config.n_accum_batches
+                write_summary = is_chief and step % 10 == 0 and applies_gradients
+                train_fetches = [loss, summary] if write_summary else [loss]
+
+                # accumulates the gradients of the batch, every n_accum_batches-th call also applies them
+                if worker is None:
+                    applied, fetched = profiler.run(sess, 'train', [accumulator.train_op, train_fetches],
+                                                    feed_dict=feed_dict)
+                else:
+                    with profiler.phase('train'):
+                        applied, fetched = worker.train_step(sess, accumulator, train_fetches, feed_dict,
+                                                             {learning_rate_placeholder: curr_lr})
+                loss_value = fetched[0]
+                n_accumulated = 0 if applied else n_accumulated + 1
+
+                if applied:
 
                     duration = time.time() - start_time
 
                     # Write the summaries and print an overview fairly often.
-                    if step % 10 == 0:
+                    if write_summary:
                         # Print status to stdout.
 
 
                         logging.info('Step %d: loss = %.2f (%.3f sec)' % (step, loss_value, duration))
                         # Update the events file.
 
-                        summary_str = sess.run(summary, feed_dict=feed_dict)
-                        summary_writer.add_summary(summary_str, step)
-                        summary_writer.flush()
+                        with profiler.phase('summaries'):
+                            summary_writer.add_summary(fetched[1], step)
+                            summary_writer.flush()
 
-                    if (step + 1) % exp_config.train_eval_frequency == 0:
+                    if is_chief and (step + 1) % exp_config.train_eval_frequency == 0:
 
                         # Evaluate against the training set
                         logging.info('Training Data Eval:')
-                        [train_loss, train_diag_f1, train_ages_f1] = do_eval(sess,
-                                                                             eval_diag_loss,
-                                                                             eval_ages_loss,
-                                                                             pred_labels,
-                                                                             ages_softmaxs,
-                                                                             images_placeholder,
-                                                                             diag_placeholder,
-                                                                             ages_placeholder,
-                                                                             training_time_placeholder,
-                                                                             images_train,
-                                                                             [labels_train, ages_train],
-                                                                             batch_size=exp_config.batch_size,
-                                                                             do_ordinal_reg=exp_config.age_ordinal_regression,
-                                                                             selection_indices=train_image_selection,
-                                                                             augmentation_function=generator_augmentation_function)
+                        with profiler.phase('evaluation'):
+                            [train_loss, train_diag_f1, train_ages_f1] = do_eval(sess,
+                                                                                 eval_diag_loss,
+                                                                                 eval_ages_loss,
+                                                                                 pred_labels,
+                                                                                 ages_softmaxs,
+                                                                                 images_placeholder,
+                                                                                 diag_placeholder,
+                                                                                 ages_placeholder,
+                                                                                 training_time_placeholder,
+                                                                                 images_train,
+                                                                                 [labels_train, ages_train],
+                                                                                 batch_size=exp_config.batch_size,
+                                                                                 do_ordinal_reg=exp_config.age_ordinal_regression,
+                                                                                 selection_indices=train_image_selection,
+                                                                                 augmentation_function=generator_augmentation_function,
+                                                                                 map_labels_to_standard_range=False)
 
 
                         train_summary_msg = sess.run(train_summary, feed_dict={train_error_: train_loss,
@@ -444,30 +554,35 @@ def run_training(continue_run, log_dir):
 
                         last_train = train_loss
 
+                    if worker is not None and (step + 1) % exp_config.train_eval_frequency == 0:
+                        # the learning rate schedule of the chief is used by all workers
+                        curr_lr = worker.broadcast_scalar(curr_lr)
+
                     # Save a checkpoint and evaluate the model periodically.
-                    if (step + 1) % exp_config.val_eval_frequency == 0:
+                    if is_chief and (step + 1) % exp_config.val_eval_frequency == 0:
 
                         checkpoint_file = os.path.join(log_dir, 'model.ckpt')
-                        saver.save(sess, checkpoint_file, global_step=step)
+                        with profiler.phase('checkpoint'):
+                            saver.save(sess, checkpoint_file, global_step=step)
 
                         # Evaluate against the validation set.
                         logging.info('Validation Data Eval:')
 
-                        [val_loss, val_diag_f1, val_ages_f1] = do_eval(sess,
-                                                                       eval_diag_loss,
-                                                                       eval_ages_loss,
-                                                                       pred_labels,
-                                                                       ages_softmaxs,
-                                                                       images_placeholder,
-                                                                       diag_placeholder,
-                                                                       ages_placeholder,
-                                                                       training_time_placeholder,
-                                                                       images_val,
-                                                                       [labels_val, ages_val],
-                                                                       batch_size=exp_config.batch_size,
-                                                                       do_ordinal_reg=exp_config.age_ordinal_regression,
-                                                                       selection_indices=val_image_selection,
-                                                                       augmentation_function=generator_augmentation_function)
+                        with profiler.phase('validation'):
+                            [val_loss, val_diag_f1, val_ages_f1] = do_eval(sess,
+                                                                           eval_diag_loss,
+                                                                           eval_ages_loss,
+                                                                           pred_labels,
+                                                                           ages_softmaxs,
+                                                                           images_placeholder,
+                                                                           diag_placeholder,
+                                                                           ages_placeholder,
+                                                                           training_time_placeholder,
+                                                                           None,
+                                                                           None,
+                                                                           batch_size=exp_config.batch_size,
+                                                                           do_ordinal_reg=exp_config.age_ordinal_regression,
+                                                                           eval_set=val_set)
 
 
                         val_summary_msg = sess.run(val_summary, feed_dict={val_error_: val_loss,
@@ -479,23 +594,42 @@ def run_training(continue_run, log_dir):
                         if val_diag_f1 >= best_diag_f1_score:
                             best_diag_f1_score = val_diag_f1
                             best_file = os.path.join(log_dir, 'model_best_diag_f1.ckpt')
-                            saver_best_diag_f1.save(sess, best_file, global_step=step)
+                            with profiler.phase('checkpoint'):
+                                saver_best_diag_f1.save(sess, best_file, global_step=step)
                             logging.info('Found new best DIAGNOSIS F1 score on validation set! - %f -  Saving model_best_diag_f1.ckpt' % val_diag_f1)
 
                         if val_ages_f1 >= best_ages_f1_score:
                             best_ages_f1_score = val_ages_f1
                             best_file = os.path.join(log_dir, 'model_best_ages_f1.ckpt')
-                            saver_best_ages_f1.save(sess, best_file, global_step=step)
+                            with profiler.phase('checkpoint'):
+                                saver_best_ages_f1.save(sess, best_file, global_step=step)
                             logging.info('Found new best AGES F1 score on validation set! - %f -  Saving model_best_ages_f1.ckpt' % val_ages_f1)
 
                         if val_loss <= best_val:
                             best_val = val_loss
                             best_file = os.path.join(log_dir, 'model_best_xent.ckpt')
-                            saver_best_xent.save(sess, best_file, global_step=step)
+                            with profiler.phase('checkpoint'):
+                                saver_best_xent.save(sess, best_file, global_step=step)
                             logging.info('Found new best crossentropy on validation set! - %f -  Saving model_best_xent.ckpt' % val_loss)
 
                     step += 1
-
+                    profiler.end_step()
+                    profiler.start_step(step)
+
+            if augmentation_pool is not None:
+                augmentation_pool.log_stats()
+            if generator is not None:
+                generator.log_throughput()
+            if worker is not None:
+                worker.log_stats()
+            if is_chief:
+                checkpoint_writer.log_stats()
+
+        if augmentation_pool is not None:
+            augmentation_pool.close()
+        if translation_cache is not None:
+            translation_cache.close()
+        checkpoint_writer.close()
         sess.close()
 
 def do_eval(sess,
@@ -514,7 +648,9 @@ def do_eval(sess,
             selection_indices=None,
             augmentation_function=None,
             experiment_config=exp_config,
-            additional_feed_dict={}):
+            additional_feed_dict={},
+            eval_set=None,
+            map_labels_to_standard_range=True):
 
     '''
     Function for running the evaluations every X iterations on the training and validation sets. 
@@ -527,6 +663,8 @@ def do_eval(sess,
     :param labels_list: A numpy array or h45py dataset containing the corresponding labels 
     :param batch_size: The batch_size to use.
     :param additional_feed_dict: the feed_dict will be updated with this dictionary if this dictionary is not empty
+    :param eval_set: ResidentEvalSet (with labels) that is evaluated instead of images and labels_list
+    :param map_labels_to_standard_range: False if the diagnoses in labels_list are already in the standard range
     :return: The average loss (as defined in the experiment), and the average dice over all `images`. 
     '''
 
@@ -538,12 +676,18 @@ def do_eval(sess,
     predictions_ages = []
     predictions_ages_gt = []
 
-    for batch in iterate_minibatches(images,
-                                     labels_list,
-                                     batch_size=batch_size,
-                                     selection_indices=selection_indices,
-                                     augmentation_function=augmentation_function,
-                                     exp_config=experiment_config):  # No aug in evaluation
+    if eval_set is not None:
+        batches = eval_set.batches()
+    else:
+        batches = iterate_minibatches(images,
+                                      labels_list,
+                                      batch_size=batch_size,
+                                      selection_indices=selection_indices,
+                                      augmentation_function=augmentation_function,
+                                      map_labels_to_standard_range=map_labels_to_standard_range,
+                                      exp_config=experiment_config)  # No aug in evaluation
+
+    for batch in batches:
     # As before you can wrap the iterate_minibatches function in the BackgroundGenerator class for speed improvements
     # but at the risk of not catching exceptions
 
@@ -625,7 +769,10 @@ def main():
     else:
         shutil.copy(exp_config.__file__, log_dir)
 
-    run_training(continue_run, log_dir=log_dir)
+    if exp_config.data_parallel_workers > 1:
+        data_parallel.run_workers(run_training, exp_config.data_parallel_workers, args=(continue_run, log_dir))
+    else:
+        run_training(continue_run, log_dir=log_dir)
 
 
 if __name__ == '__main__':
@@ -12,6 +12,8 @@ import math
 
 import utils
 import image_utils
+import dataset_server
+import hdf5_handles
 
 import pandas as pd
 from sklearn.model_selection import train_test_split
@@ -287,7 +289,8 @@ def load_and_maybe_process_data(input_folder,
                                 label_list,
                                 offset=None,
                                 rescale_to_one=False,
-                                force_overwrite=False):
+                                force_overwrite=False,
+                                use_shared_memory=True):
 
     '''
     This function is used to load and if necessary preprocesses the ACDC challenge data
@@ -297,8 +300,10 @@ def load_and_maybe_process_data(input_folder,
     :param size: Size of the output slices/volumes in pixels/voxels
     :param target_resolution: Resolution to which the data should resampled. Should have same shape as size
     :param force_overwrite: Set this to True if you want to overwrite already preprocessed data [default: False]
+    :param use_shared_memory: Use the shared memory copy of the data if it is served by dataset_server.py
      
-    :return: Returns an h5py.File handle to the dataset
+    :return: Returns a hdf5_handles.ForkSafeFile of the dataset, which every process reads with its own h5py handle
+             (or a dataset_server.SharedDataset if the data is served)
     '''
 
     size_str = '_'.join([str(i) for i in size])
@@ -328,7 +333,13 @@ def load_and_maybe_process_data(input_folder,
     else:
         logging.info('Already preprocessed this configuration. Loading now!')
 
-    return h5py.File(data_file_path, 'r')
+    if use_shared_memory and not force_overwrite:
+        shared_data = dataset_server.attach_dataset(data_file_path)
+        if shared_data is not None:
+            logging.info('Attached to the served data in %s' % shared_data.folder)
+            return shared_data
+
+    return hdf5_handles.ForkSafeFile(data_file_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,118 @@
+# Authors:
+# Jonathan Dietrich
+
+# augmentation of the minibatches in a pool of worker threads or processes
+# The raw batches are read in the training thread and handed to the workers, which augment up to queue_size batches
+# ahead of the training loop. The augmentation then runs while the training step of an earlier batch is computed.
+
+import collections
+import concurrent.futures
+import logging
+import time
+
+import numpy as np
+
+
+def _augment_batch(augmentation_function, X, y_list, batch_seed, augmentation_kwargs, seed_global_state=False):
+    # runs in the worker, returns the augmented batch and the time the augmentation took
+    start_time = time.time()
+    if hasattr(augmentation_function, 'seeded'):
+        # e.g. BatchAugmentor, gets its own random state for this batch
+        augmentation_function = augmentation_function.seeded(batch_seed)
+    elif seed_global_state:
+        # only in worker processes, which have their own global random state. Worker threads would race on the
+        # global random state of the training process (and reset the shuffling of the epochs)
+        np.random.seed(batch_seed)
+    X, y_list = augmentation_function(X, y_list, **augmentation_kwargs)
+    return X, y_list, time.time() - start_time
+
+
+class AugmentationPool(object):
+    '''
+    Augments batches of the form (X, y_list) (as from iterate_minibatches without augmentation_function) in worker
+    threads or processes and yields them in the original order.
+    At most queue_size batches are read ahead and being augmented. Batch number b (counted over all calls of augmented)
+    is augmented with the seed [seed, b], so the augmentation does not depend on the number of workers or their timing.
+    Worker processes need a picklable augmentation function (e.g. BatchAugmentor or flip_augment, no lambdas). Threads
+    run in parallel to the training step as long as the augmentation releases the GIL (numpy/scipy operations, sess.run).
+    Functions without a seeded method (e.g. the generator augmentation) are only seeded in worker processes, in
+    worker threads they run unseeded.
+    The time the training loop waited for the augmented batches is compared to the time the workers spent augmenting
+    them, the rest was hidden behind the training (see stats).
+    '''
+    def __init__(self, augmentation_function, n_workers=2, queue_size=4, use_processes=False, seed=0,
+                 augmentation_kwargs=None):
+        self.augmentation_function = augmentation_function
+        self.queue_size = queue_size
+        self.use_processes = use_processes
+        self.seed = seed
+        self.augmentation_kwargs = {} if augmentation_kwargs is None else augmentation_kwargs
+        if use_processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+            if not hasattr(augmentation_function, 'seeded'):
+                logging.info('The augmentation function has no seeded method, the augmentation in worker threads is '
+                             'not reproducible')
+
+        self.n_batches = 0  # number of submitted batches
+        self.n_augmented = 0  # number of augmented batches that were yielded
+        self.augmentation_time = 0.0  # time the workers spent augmenting
+        self.wait_time = 0.0  # time the training loop waited for augmented batches
+
+    def _submit(self, batch):
+        X, y_list = batch
+        # the reader reuses its buffers (BatchBufferRing) for the batches that are read ahead. Worker processes also
+        # need the copy, the arguments are only pickled later by the feeder thread of the executor
+        X = X.copy()
+        batch_seed = [self.seed, self.n_batches]
+        self.n_batches += 1
+        return self.executor.submit(_augment_batch, self.augmentation_function, X, y_list, batch_seed,
+                                    self.augmentation_kwargs, self.use_processes)
+
+    def augmented(self, batches):
+        '''
+        :param batches: iterator of raw batches (X, y_list)
+        :return: yields the augmented batches (X, y_list) in the order of batches
+        '''
+        pending = collections.deque()
+        batches = iter(batches)
+        try:
+            while True:
+                while len(pending) < self.queue_size:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    pending.append(self._submit(batch))
+                if not pending:
+                    return
+                start_time = time.time()
+                X, y_list, augmentation_time = pending.popleft().result()
+                self.wait_time += time.time() - start_time
+                self.augmentation_time += augmentation_time
+                self.n_augmented += 1
+                yield X, y_list
+        finally:
+            # e.g. the training loop stopped in the middle of the epoch
+            for future in pending:
+                future.cancel()
+
+    def stats(self):
+        '''
+        :return: dict with the number of batches, the time spent augmenting and waiting [s] and the fraction of the
+        augmentation time that was hidden behind the training
+        '''
+        hidden_time = max(self.augmentation_time - self.wait_time, 0.0)
+        return {'batches': self.n_augmented,
+                'augmentation_time': self.augmentation_time,
+                'wait_time': self.wait_time,
+                'hidden_fraction': hidden_time / self.augmentation_time if self.augmentation_time > 0 else 1.0}
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info('Augmentation: %d batches, %.1f s augmenting, %.1f s waited for batches (%.0f%% hidden)'
+                     % (stats['batches'], stats['augmentation_time'], stats['wait_time'],
+                        100*stats['hidden_fraction']))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -4,39 +4,157 @@
 
 # augmentation functions for the MR images.
 
+import copy
+
 import numpy as np
+from scipy import ndimage
 
 import adni_data_loader
 from batch_generator_list import iterate_minibatches
 
 
 def flip_augment(X, y_list=None, do_fliplr=True):
+    # flips the images in place, i.e. X is modified and returned (no copy of the batch is made)
 
-    N = X.shape[0]
-
-    X_list = []
-
-    for ii in range(N):
-
-        img = np.squeeze(X[ii,...])
-
+    if do_fliplr:
         # RANDOM FLIP
-        if do_fliplr:
-            coin_flip = np.random.randint(2)
-            if coin_flip == 0:
-                img = np.flip(img, 0)
-
-
-        X_list.append(img[..., np.newaxis])
-
-    X_ = np.asarray(X_list)
+        coin_flips = np.random.randint(2, size=X.shape[0])
+        flip_indices = np.flatnonzero(coin_flips == 0)
+        X[flip_indices, ...] = X[flip_indices, ::-1, ...]
 
     if y_list is None:
-        return X_
+        return X
     else:
-        return X_, y_list
+        return X, y_list
+
+
+def rotation_matrices(angles):
+    '''
+    3D rotation matrices for a batch of rotation angles
+    :param angles: numpy array with shape [N, 3] with the angles [rad] around the three image axes
+    :return: numpy array with shape [N, 3, 3]
+    '''
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    n = angles.shape[0]
+    rotations = np.zeros([3, n, 3, 3])
+    # rotation around axis a acts on the plane of the two other axes
+    for axis, (i, j) in enumerate([(1, 2), (0, 2), (0, 1)]):
+        rotations[axis, :, axis, axis] = 1
+        rotations[axis, :, i, i] = cos[:, axis]
+        rotations[axis, :, j, j] = cos[:, axis]
+        rotations[axis, :, i, j] = -sin[:, axis]
+        rotations[axis, :, j, i] = sin[:, axis]
+    return np.matmul(np.matmul(rotations[0], rotations[1]), rotations[2])
+
+
+class BatchAugmentor(object):
+    '''
+    Random augmentation of whole batches with shape [N, x, y, z, 1]. Every image gets its own random parameters:
+        flip along the first image axis (do_fliplr)
+        small rotation around the image center (do_rotations), at most max_rotation_degrees around every axis
+        isotropic scaling (do_scaleaug) with a factor in scale_range
+        intensity scaling and shift (do_intensityaug) with a factor in intensity_scale_range and a shift in
+        intensity_shift_range
+    The parameters of a batch are drawn at once from the random state of the augmentor, so the augmentation is
+    reproducible with a seed. Rotation and scaling are combined into one affine resampling (linear interpolation) per
+    image, flips and intensity changes are applied to the whole batch at once.
+    The batch is modified in place and returned like with flip_augment. An instance can be used as augmentation_function
+    of all batch iterators, also from several threads at once.
+    '''
+    def __init__(self, do_fliplr=True, do_rotations=False, do_scaleaug=False, do_intensityaug=False,
+                 max_rotation_degrees=10.0, scale_range=(0.9, 1.1), intensity_scale_range=(0.9, 1.1),
+                 intensity_shift_range=(-0.1, 0.1), seed=None):
+        self.do_fliplr = do_fliplr
+        self.do_rotations = do_rotations
+        self.do_scaleaug = do_scaleaug
+        self.do_intensityaug = do_intensityaug
+        self.max_rotation = np.deg2rad(max_rotation_degrees)
+        self.scale_range = scale_range
+        self.intensity_scale_range = intensity_scale_range
+        self.intensity_shift_range = intensity_shift_range
+        self.random_state = np.random.RandomState(seed)
+
+    def seeded(self, seed):
+        '''
+        Copy of the augmentor with its own random state, e.g. for one batch in an augmentation worker
+        '''
+        augmentor = copy.copy(self)
+        augmentor.random_state = np.random.RandomState(seed)
+        return augmentor
+
+    def draw_parameters(self, n_images, do_fliplr):
+        '''
+        Draws the random augmentation parameters of a batch
+        :return: dict with the parameters of every image (None for augmentations that are switched off)
+        '''
+        parameters = {'flip': None, 'angles': None, 'scales': None, 'intensity_scales': None, 'intensity_shifts': None}
+        if do_fliplr:
+            parameters['flip'] = self.random_state.randint(2, size=n_images) == 0
+        if self.do_rotations:
+            parameters['angles'] = self.random_state.uniform(-self.max_rotation, self.max_rotation, size=[n_images, 3])
+        if self.do_scaleaug:
+            parameters['scales'] = self.random_state.uniform(self.scale_range[0], self.scale_range[1], size=n_images)
+        if self.do_intensityaug:
+            parameters['intensity_scales'] = self.random_state.uniform(self.intensity_scale_range[0],
+                                                                       self.intensity_scale_range[1], size=n_images)
+            parameters['intensity_shifts'] = self.random_state.uniform(self.intensity_shift_range[0],
+                                                                       self.intensity_shift_range[1], size=n_images)
+        return parameters
+
+    def affine_matrices(self, parameters, n_images):
+        # maps the coordinates of the augmented image to the coordinates of the original image
+        matrices = np.tile(np.eye(3), [n_images, 1, 1])
+        if parameters['angles'] is not None:
+            matrices = rotation_matrices(parameters['angles'])
+        if parameters['scales'] is not None:
+            matrices = matrices / parameters['scales'][:, np.newaxis, np.newaxis]
+        return matrices
+
+    def resample(self, X, matrices):
+        image_shape = X.shape[1:4]
+        # volume that the resampling writes into before it is copied back into the batch. It is allocated per call,
+        # since the tf.data pipelines call the same instance from several threads
+        resampled = np.empty(image_shape, dtype=X.dtype)
+        # rotation and scaling around the image center
+        center = (np.asarray(image_shape, dtype=np.float64) - 1) / 2
+        for ii in range(X.shape[0]):
+            offset = center - np.dot(matrices[ii], center)
+            ndimage.affine_transform(X[ii, ..., 0], matrices[ii], offset=offset, output=resampled, order=1,
+                                     mode='nearest')
+            X[ii, ..., 0] = resampled
+
+    def __call__(self, X, y_list=None, do_fliplr=None):
+        '''
+        :param X: batch with shape [N, x, y, z, 1], modified in place
+        :param y_list: labels of the batch, they are returned unchanged
+        :param do_fliplr: overrides the do_fliplr setting of the augmentor if it is not None
+        :return: X or X, y_list
+        '''
+        if do_fliplr is None:
+            do_fliplr = self.do_fliplr
+        n_images = X.shape[0]
+        parameters = self.draw_parameters(n_images, do_fliplr)
+
+        if parameters['flip'] is not None:
+            flip_indices = np.flatnonzero(parameters['flip'])
+            X[flip_indices, ...] = X[flip_indices, ::-1, ...]
+
+        if self.do_rotations or self.do_scaleaug:
+            self.resample(X, self.affine_matrices(parameters, n_images))
+
+        if parameters['intensity_scales'] is not None:
+            broadcast_shape = [n_images] + [1]*(X.ndim - 1)
+            X *= parameters['intensity_scales'].reshape(broadcast_shape).astype(X.dtype)
+            X += parameters['intensity_shifts'].reshape(broadcast_shape).astype(X.dtype)
+
+        if y_list is None:
+            return X
+        else:
+            return X, y_list
 
 # translate the fraction generate_fraction of the given image batch with generator (class Generator)
+# the generator translates any number of images in its own micro batch size
 def generator_augment(generator, X, y_list=None, generate_fraction=0.5):
 
     if generate_fraction < 0 or generate_fraction > 1:
@@ -79,7 +197,7 @@ if __name__ == '__main__':
 
         X, [y, a] = batch
 
-        X_, [y_, a_] = flip_augment(X, [y, a], exp_config.do_fliplr)
+        X_, [y_, a_] = flip_augment(X.copy(), [y, a], exp_config.do_fliplr)
 
         fig1 = plt.figure()
         fig1.add_subplot(131)
@@ -5,10 +5,108 @@
 
 import numpy as np
 import logging
+
+from label_encodings import labels_to_standard_range
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
+
+class BatchBufferRing(object):
+    '''
+    Small ring of preallocated float32 image batches with shape [batch_size, x, y, z, n_channels].
+    Each call of next_buffer hands out the next buffer of the ring. A buffer is only written again after ring_size
+    further calls, so a consumer can hold at most ring_size-1 batches at the same time (e.g. the batch in use plus
+    the one prefetched by a BackgroundGenerator). Copy a batch if it has to be kept for longer.
+    '''
+    def __init__(self, batch_size, image_size, ring_size=3, n_channels=1, dtype=np.float32):
+        self.buffers = [np.empty([batch_size] + list(image_size) + [n_channels], dtype=dtype) for _ in range(ring_size)]
+        self.position = 0
+
+    def next_buffer(self, n_images=None):
+        buffer = self.buffers[self.position]
+        self.position = (self.position + 1) % len(self.buffers)
+        if n_images is not None and n_images < buffer.shape[0]:
+            # incomplete last batch, the leading slice of a C-contiguous buffer is still contiguous
+            return buffer[:n_images, ...]
+        return buffer
+
+
+def coalesce_index_ranges(sorted_indices):
+    '''
+    Groups increasing indices into runs of consecutive indices
+    E.g. [1, 2, 3, 7, 8] becomes [(1, 4), (7, 9)]
+    :param sorted_indices: indices in increasing order
+    :return: list of (start, stop) tuples that can be used as slices
+    '''
+    sorted_indices = np.asarray(sorted_indices)
+    if sorted_indices.size == 0:
+        return []
+    # position of the first index of every run except the first one
+    breaks = np.flatnonzero(np.diff(sorted_indices) != 1) + 1
+    starts = sorted_indices[np.concatenate(([0], breaks))]
+    stops = sorted_indices[np.concatenate((breaks - 1, [sorted_indices.size - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def read_images_into(images, batch_indices, out):
+    '''
+    Reads the images with the given indices directly into a preallocated array without intermediate copies.
+    Consecutive indices are read as one range (hyperslab), which is much faster for HDF5 than a point selection.
+    :param images: hdf5 dataset or numpy array with shape [N, x, y, z]
+    :param batch_indices: indices of the images in increasing order (required by HDF5)
+    :param out: C-contiguous array with shape [len(batch_indices), x, y, z, 1], usually from a BatchBufferRing
+    :return: out filled with the images
+    '''
+    # view without the channel axis that has the same shape as the selection in images
+    out_view = out.reshape([out.shape[0]] + list(images.shape[1:]))
+    out_pos = 0
+    for start, stop in coalesce_index_ranges(batch_indices):
+        n_range = stop - start
+        if hasattr(images, 'read_direct'):
+            images.read_direct(out_view, source_sel=np.s_[start:stop, ...], dest_sel=np.s_[out_pos:out_pos + n_range, ...])
+        else:
+            out_view[out_pos:out_pos + n_range, ...] = images[start:stop, ...]
+        out_pos += n_range
+    return out
+
+
+def read_labels(labels, batch_indices):
+    '''
+    Reads the labels of a batch. HDF5 datasets only accept strictly increasing indices, so every index is read once
+    and the labels are expanded again if an index occurs more than once in the batch.
+    :param labels: hdf5 dataset or numpy array
+    :param batch_indices: indices in increasing order, can contain repeated indices
+    :return: numpy array with the labels
+    '''
+    unique_indices, inverse = np.unique(batch_indices, return_inverse=True)
+    if len(unique_indices) == len(batch_indices):
+        return labels[batch_indices, ...]
+    return labels[unique_indices, ...][inverse, ...]
+
+
+def block_shuffle_indices(indices, block_size, random_state=np.random):
+    '''
+    Shuffles indices in blocks of block_size neighbouring indices instead of globally. The sorted indices are split
+    into contiguous blocks, the blocks are put in a random order and the indices are shuffled inside each block.
+    Consecutive batches are then taken from few blocks, so a batch can be read with few range reads.
+    block_size=1 is a normal shuffle, larger blocks trade randomness of the batches for read throughput.
+    :param indices: indices to shuffle
+    :param block_size: number of neighbouring indices in a block
+    :param random_state: np.random or a np.random.RandomState
+    :return: numpy array with the shuffled indices
+    '''
+    indices = np.sort(np.asarray(indices))
+    n_blocks = int(np.ceil(len(indices) / float(block_size)))
+    # random rank of the block each (sorted) index belongs to
+    block_rank = random_state.permutation(n_blocks)[np.arange(len(indices)) // block_size]
+    jitter = random_state.random_sample(len(indices))
+    # primary key is the block rank, the jitter shuffles inside the blocks
+    return indices[np.lexsort((jitter, block_rank))]
+
+
 def iterate_minibatches_endlessly(images, batch_size, exp_config, labels_list=None, selection_indices=None,
-                                  augmentation_function=None, map_labels_to_standard_range=True, shuffle_data=True):
+                                  augmentation_function=None, map_labels_to_standard_range=True, shuffle_data=True,
+                                  buffer_ring_size=3, block_size=None, sampler=None):
     '''
     Function to create mini batches from the dataset of a certain batch size
     :param images: hdf5 dataset
@@ -17,6 +115,11 @@ def iterate_minibatches_endlessly(images, batch_size, exp_config, labels_list=No
     :param selection_indices: indices from which images are selected. If this is None the selection is from all images
     :param augment_batch: should batch be augmented?
     :param skip_remainder: skip the last images if the batch size is larger than their number
+    :param buffer_ring_size: number of preallocated image batches. A yielded image batch gets overwritten
+    buffer_ring_size batches later
+    :param block_size: if not None the data is shuffled in blocks of neighbouring images (see block_shuffle_indices)
+    :param sampler: StratifiedSampler (see batch_sampler) that draws the batch indices. If it is given,
+    selection_indices, shuffle_data and block_size are ignored
     :return: mini batches
     '''
     if selection_indices is None:
@@ -24,29 +127,39 @@ def iterate_minibatches_endlessly(images, batch_size, exp_config, labels_list=No
     else:
         random_indices = selection_indices
     initial_indices = random_indices
-    if shuffle_data:
-        np.random.shuffle(random_indices)
+    if shuffle_data and sampler is None:
+        if block_size is None:
+            np.random.shuffle(random_indices)
+        else:
+            random_indices = block_shuffle_indices(initial_indices, block_size)
 
     n_images = len(random_indices)
 
+    buffer_ring = BatchBufferRing(batch_size, exp_config.image_size, ring_size=buffer_ring_size)
+
     # starting index of the batch
     b_i = 0
     while True:
-        if b_i+batch_size > n_images:
+        if sampler is not None:
+            batch_indices = sampler.next_indices(batch_size)
+        elif b_i+batch_size > n_images:
             # start a new epoch
             random_indices = initial_indices
             if shuffle_data:
-                np.random.shuffle(random_indices)
+                if block_size is None:
+                    np.random.shuffle(random_indices)
+                else:
+                    random_indices = block_shuffle_indices(initial_indices, block_size)
             b_i = 0
 
-        # HDF5 requires indices to be in increasing order
-        batch_indices = np.sort(random_indices[b_i:(b_i+batch_size)])
+        if sampler is None:
+            # HDF5 requires indices to be in increasing order
+            batch_indices = np.sort(random_indices[b_i:(b_i+batch_size)])
 
-        X = images[batch_indices, ...]
-        # y = labels[batch_indices, ...]
+        X = read_images_into(images, batch_indices, buffer_ring.next_buffer())
 
         if labels_list is not None:
-            y_list = [y_ll[batch_indices,...] for y_ll in labels_list]
+            y_list = [read_labels(y_ll, batch_indices) for y_ll in labels_list]
 
             # DEBUG
             # print(y_list)
@@ -54,10 +167,7 @@ def iterate_minibatches_endlessly(images, batch_size, exp_config, labels_list=No
             if map_labels_to_standard_range:
                 # This puts the labels in a range from 0 to nlabels.
                 # E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
-                y_list[0] = np.asarray([np.argwhere(i==np.asarray(exp_config.label_list)) for i in y_list[0]]).flatten()
-
-        image_tensor_shape = [X.shape[0]] + list(exp_config.image_size) + [1]
-        X = np.reshape(X, image_tensor_shape)
+                y_list[0] = labels_to_standard_range(y_list[0], exp_config.label_list)
 
         if augmentation_function:
             if labels_list is None:
@@ -74,31 +184,210 @@ def iterate_minibatches_endlessly(images, batch_size, exp_config, labels_list=No
 
 
 
-def iterate_minibatches(images,
-                        labels_list,
-                        batch_size,
-                        exp_config,
-                        selection_indices=None,
-                        augmentation_function=None,
-                        map_labels_to_standard_range=True,
-                        shuffle_data=True,
-                        skip_remainder=True):
+def read_merged(images, indices_list, labels_list=None, merged_out=None):
     '''
-    Function to create mini batches from the dataset of a certain batch size
+    Reads the images of several index arrays (e.g. the source and target batch of several steps) with one sorted read.
+    Every image is read only once, even if it occurs in several of the index arrays.
     :param images: hdf5 dataset
-    :param labels: hdf5 dataset
-    :param batch_size: batch size
+    :param indices_list: list of index arrays
+    :param labels_list: list of hdf5 datasets or numpy arrays with labels or None
+    :param merged_out: buffer with at least as many images as all index arrays together. Allocated if it is None
+    :return: merged images, list of merged labels (None if labels_list is None), list with the positions of the
+    images of each index array in the merged arrays
+    '''
+    all_indices = np.concatenate(indices_list)
+    if merged_out is None:
+        merged_out = np.empty([len(all_indices)] + list(images.shape[1:]) + [1], dtype=np.float32)
+
+    # in increasing order as HDF5 requires
+    merged_indices, merged_position = np.unique(all_indices, return_inverse=True)
+    merged = read_images_into(images, merged_indices, merged_out[:len(merged_indices), ...])
+    merged_position = merged_position.reshape(-1)
+
+    if labels_list is None:
+        merged_labels = None
+    else:
+        merged_labels = [y_ll[merged_indices, ...] for y_ll in labels_list]
+
+    split_points = np.cumsum([len(indices) for indices in indices_list])[:-1]
+    return merged, merged_labels, np.split(merged_position, split_points)
+
+
+def take_batch(merged, merged_labels, positions, exp_config, map_labels_to_standard_range=True, out=None):
+    '''
+    Takes one batch out of the result of read_merged
+    :return: X, y_list (y_list is None if there are no labels)
+    '''
+    X = np.take(merged, positions, axis=0, out=out)
+    if merged_labels is None:
+        return X, None
+
+    y_list = [y_merged[positions, ...] for y_merged in merged_labels]
+    if map_labels_to_standard_range:
+        # This puts the labels in a range from 0 to nlabels.
+        # E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
+        y_list[0] = labels_to_standard_range(y_list[0], exp_config.label_list)
+    return X, y_list
+
+
+def read_paired_batch(images, source_indices, target_indices, exp_config, labels_list=None,
+                      map_labels_to_standard_range=True, merged_out=None, source_out=None, target_out=None):
+    '''
+    Reads a source and a target batch from the same dataset with one merged read
+    :param images: hdf5 dataset
+    :param source_indices: indices of the source batch in increasing order
+    :param target_indices: indices of the target batch in increasing order
+    :param labels_list: list of hdf5 datasets or numpy arrays with labels or None
+    :param merged_out: buffer with at least len(source_indices) + len(target_indices) images for the merged read
+    :param source_out: buffer for the source batch
+    :param target_out: buffer for the target batch. New arrays are allocated for the buffers that are None
+    :return: x_s, y_list_s, x_t, y_list_t. The label lists are None if labels_list is None
+    '''
+    merged, merged_labels, [source_position, target_position] = read_merged(images, [source_indices, target_indices],
+                                                                            labels_list, merged_out)
+    X_s, y_list_s = take_batch(merged, merged_labels, source_position, exp_config, map_labels_to_standard_range,
+                               out=source_out)
+    X_t, y_list_t = take_batch(merged, merged_labels, target_position, exp_config, map_labels_to_standard_range,
+                               out=target_out)
+    return X_s, y_list_s, X_t, y_list_t
+
+
+class PairedMinibatchReader(object):
+    '''
+    Endless iterator over pairs of source and target mini batches from the same dataset.
+    next() reads one pair with one merged read. next_batches(n_batches) reads the pairs of several steps (e.g. all
+    critic iterations of a step) with as few merged reads as the memory cap allows and slices them in memory.
+    The yielded batches are written into rings of preallocated buffers and get overwritten buffer_ring_size
+    batches later.
+    '''
+    def __init__(self, images, source_batch_size, target_batch_size, exp_config, source_sampler, target_sampler,
+                 labels_list=None, augmentation_function=None, map_labels_to_standard_range=True, buffer_ring_size=3,
+                 max_bulk_megabytes=1024):
+        '''
+        :param images: hdf5 dataset
+        :param source_sampler: StratifiedSampler (see batch_sampler) for the source indices
+        :param target_sampler: StratifiedSampler for the target indices
+        :param labels_list: list of hdf5 datasets or numpy arrays with labels. If it is None, only the images are
+        yielded
+        :param max_bulk_megabytes: memory cap of the buffer for the merged read of several steps
+        '''
+        self.images = images
+        self.source_batch_size = source_batch_size
+        self.target_batch_size = target_batch_size
+        self.exp_config = exp_config
+        self.source_sampler = source_sampler
+        self.target_sampler = target_sampler
+        self.labels_list = labels_list
+        self.augmentation_function = augmentation_function
+        self.map_labels_to_standard_range = map_labels_to_standard_range
+
+        self.n_pair = source_batch_size + target_batch_size
+        pair_megabytes = self.n_pair * np.prod(exp_config.image_size) * np.dtype(np.float32).itemsize / 1e6
+        self.max_bulk_pairs = max(1, int(max_bulk_megabytes // pair_megabytes))
+        self.bulk_buffer = None  # allocated with the first bulk read
+        self.merged_ring = BatchBufferRing(self.n_pair, exp_config.image_size, ring_size=1)
+        self.source_ring = BatchBufferRing(source_batch_size, exp_config.image_size, ring_size=buffer_ring_size)
+        self.target_ring = BatchBufferRing(target_batch_size, exp_config.image_size, ring_size=buffer_ring_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._read_pairs(1, self.merged_ring.next_buffer()))
+
+    next = __next__  # python 2
+
+    def next_batches(self, n_batches):
+        '''
+        Generates the next n_batches pairs. The indices of all pairs are drawn and read in chunks of at most
+        max_bulk_pairs pairs with one sorted read per chunk.
+        '''
+        n_yielded = 0
+        while n_yielded < n_batches:
+            n_chunk = min(n_batches - n_yielded, self.max_bulk_pairs)
+            if n_chunk == 1:
+                merged_out = self.merged_ring.next_buffer()
+            else:
+                if self.bulk_buffer is None or self.bulk_buffer.shape[0] < n_chunk * self.n_pair:
+                    self.bulk_buffer = np.empty([n_chunk * self.n_pair] + list(self.exp_config.image_size) + [1],
+                                                dtype=np.float32)
+                merged_out = self.bulk_buffer
+            for pair in self._read_pairs(n_chunk, merged_out):
+                yield pair
+            n_yielded += n_chunk
+
+    def _read_pairs(self, n_pairs, merged_out):
+        indices_list = []
+        for _ in range(n_pairs):
+            indices_list.append(self.source_sampler.next_indices(self.source_batch_size))
+            indices_list.append(self.target_sampler.next_indices(self.target_batch_size))
+
+        merged, merged_labels, positions = read_merged(self.images, indices_list, self.labels_list, merged_out)
+
+        for pair_nr in range(n_pairs):
+            X_s, y_list_s = take_batch(merged, merged_labels, positions[2*pair_nr], self.exp_config,
+                                       self.map_labels_to_standard_range, out=self.source_ring.next_buffer())
+            X_t, y_list_t = take_batch(merged, merged_labels, positions[2*pair_nr + 1], self.exp_config,
+                                       self.map_labels_to_standard_range, out=self.target_ring.next_buffer())
+
+            if self.labels_list is None:
+                if self.augmentation_function:
+                    X_s = self.augmentation_function(X_s, do_fliplr=self.exp_config.do_fliplr)
+                    X_t = self.augmentation_function(X_t, do_fliplr=self.exp_config.do_fliplr)
+                yield X_s, X_t
+                continue
+
+            if self.augmentation_function:
+                X_s, y_list_s = self.augmentation_function(X_s, y_list_s, do_fliplr=self.exp_config.do_fliplr)
+                X_t, y_list_t = self.augmentation_function(X_t, y_list_t, do_fliplr=self.exp_config.do_fliplr)
+
+            yield X_s, y_list_s, X_t, y_list_t
+
+
+def iterate_paired_minibatches_endlessly(images, source_batch_size, target_batch_size, exp_config, source_sampler,
+                                         target_sampler, labels_list=None, augmentation_function=None,
+                                         map_labels_to_standard_range=True, buffer_ring_size=3, max_bulk_megabytes=1024):
+    '''
+    Creates pairs of source and target mini batches from the same dataset. The indices of both batches are merged and
+    read with one sorted read per step instead of one read per domain. A pair is yielded as one item, so it can be
+    prefetched as a unit (e.g. with a BackgroundGenerator).
+    :param images: hdf5 dataset
+    :param source_batch_size: batch size of the source domain
+    :param target_batch_size: batch size of the target domain
+    :param source_sampler: StratifiedSampler (see batch_sampler) for the source indices
+    :param target_sampler: StratifiedSampler for the target indices
+    :param labels_list: list of hdf5 datasets or numpy arrays with labels. If it is None, only the images are yielded
+    :param buffer_ring_size: number of preallocated image batches per domain. A yielded image batch gets overwritten
+    buffer_ring_size batches later
+    :param max_bulk_megabytes: memory cap of the merged reads of PairedMinibatchReader.next_batches
+    :return: PairedMinibatchReader, next() gives (x_s, x_t) or (x_s, y_list_s, x_t, y_list_t) if labels_list is given
+    '''
+    return PairedMinibatchReader(images, source_batch_size, target_batch_size, exp_config, source_sampler,
+                                 target_sampler, labels_list=labels_list, augmentation_function=augmentation_function,
+                                 map_labels_to_standard_range=map_labels_to_standard_range,
+                                 buffer_ring_size=buffer_ring_size, max_bulk_megabytes=max_bulk_megabytes)
+
+
+
+def epoch_batch_indices(n_images_total, batch_size, selection_indices=None, shuffle_data=True, skip_remainder=True,
+                        block_size=None):
+    '''
+    Generates the indices of the batches of one epoch
+    :param n_images_total: number of images in the dataset
     :param selection_indices: indices from which images are selected. If this is None the selection is from all images
-    :param augment_batch: should batch be augmented?
     :param skip_remainder: skip the last images if the batch size is larger than their number
-    :return: mini batches
+    :param block_size: if not None the data is shuffled in blocks of neighbouring images (see block_shuffle_indices)
+    :return: numpy arrays with the indices of a batch in increasing order
     '''
     if selection_indices is None:
-        random_indices = np.arange(images.shape[0])
+        random_indices = np.arange(n_images_total)
     else:
         random_indices = selection_indices
     if shuffle_data:
-        np.random.shuffle(random_indices)
+        if block_size is None:
+            np.random.shuffle(random_indices)
+        else:
+            random_indices = block_shuffle_indices(random_indices, block_size)
 
     n_images = len(random_indices)
 
@@ -113,10 +402,40 @@ def iterate_minibatches(images,
                 end_of_batch = n_images
 
         # HDF5 requires indices to be in increasing order
-        batch_indices = np.sort(random_indices[b_i:end_of_batch])
+        yield np.sort(random_indices[b_i:end_of_batch])
+
+
+def iterate_minibatches(images,
+                        labels_list,
+                        batch_size,
+                        exp_config,
+                        selection_indices=None,
+                        augmentation_function=None,
+                        map_labels_to_standard_range=True,
+                        shuffle_data=True,
+                        skip_remainder=True,
+                        buffer_ring_size=3,
+                        block_size=None):
+    '''
+    Function to create mini batches from the dataset of a certain batch size
+    :param images: hdf5 dataset
+    :param labels: hdf5 dataset
+    :param batch_size: batch size
+    :param selection_indices: indices from which images are selected. If this is None the selection is from all images
+    :param augment_batch: should batch be augmented?
+    :param skip_remainder: skip the last images if the batch size is larger than their number
+    :param buffer_ring_size: number of preallocated image batches. A yielded image batch gets overwritten
+    buffer_ring_size batches later
+    :param block_size: if not None the data is shuffled in blocks of neighbouring images (see block_shuffle_indices)
+    :return: mini batches
+    '''
+    buffer_ring = BatchBufferRing(batch_size, exp_config.image_size, ring_size=buffer_ring_size)
+
+    for batch_indices in epoch_batch_indices(images.shape[0], batch_size, selection_indices=selection_indices,
+                                             shuffle_data=shuffle_data, skip_remainder=skip_remainder,
+                                             block_size=block_size):
 
-        X = images[batch_indices, ...]
-        # y = labels[batch_indices, ...]
+        X = read_images_into(images, batch_indices, buffer_ring.next_buffer(len(batch_indices)))
 
         y_list = [y_ll[batch_indices,...] for y_ll in labels_list]
 
@@ -126,10 +445,7 @@ def iterate_minibatches(images,
         if map_labels_to_standard_range:
             # This puts the labels in a range from 0 to nlabels.
             # E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
-            y_list[0] = np.asarray([np.argwhere(i==np.asarray(exp_config.label_list)) for i in y_list[0]]).flatten()
-
-        image_tensor_shape = [X.shape[0]] + list(exp_config.image_size) + [1]
-        X = np.reshape(X, image_tensor_shape)
+            y_list[0] = labels_to_standard_range(y_list[0], exp_config.label_list)
 
         if augmentation_function:
             X, y_list = augmentation_function(X, y_list)
@@ -5,6 +5,8 @@
 
 import numpy as np
 import logging
+from batch_generator_list import BatchBufferRing, read_images_into, block_shuffle_indices
+from label_encodings import labels_to_standard_range
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 def iterate_minibatches(images,
@@ -13,22 +15,32 @@ def iterate_minibatches(images,
                         exp_config,
                         augmentation_function=None,
                         map_labels_to_standard_range=True,
-                        shuffle_data=True):
+                        shuffle_data=True,
+                        buffer_ring_size=3,
+                        block_size=None):
     '''
     Function to create mini batches from the dataset of a certain batch size
     :param images: hdf5 dataset
     :param labels: hdf5 dataset
     :param batch_size: batch size
     :param augment_batch: should batch be augmented?
+    :param buffer_ring_size: number of preallocated image batches. A yielded image batch gets overwritten
+    buffer_ring_size batches later
+    :param block_size: if not None the data is shuffled in blocks of neighbouring images (see block_shuffle_indices)
     :return: mini batches
     '''
 
     random_indices = np.arange(images.shape[0])
     if shuffle_data:
-        np.random.shuffle(random_indices)
+        if block_size is None:
+            np.random.shuffle(random_indices)
+        else:
+            random_indices = block_shuffle_indices(random_indices, block_size)
 
     n_images = images.shape[0]
 
+    buffer_ring = BatchBufferRing(batch_size, exp_config.image_size, ring_size=buffer_ring_size)
+
     for b_i in range(0,n_images,batch_size):
 
         if b_i + batch_size > n_images:
@@ -37,8 +49,7 @@ def iterate_minibatches(images,
         # HDF5 requires indices to be in increasing order
         batch_indices = np.sort(random_indices[b_i:b_i+batch_size])
 
-        X = images[batch_indices, ...]
-        # y = labels[batch_indices, ...]
+        X = read_images_into(images, batch_indices, buffer_ring.next_buffer())
 
         y_list = [y_ll[batch_indices,...] for y_ll in labels_list]
 
@@ -48,10 +59,7 @@ def iterate_minibatches(images,
         if map_labels_to_standard_range:
             # This puts the labels in a range from 0 to nlabels.
             # E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
-            y_list[0] = np.asarray([np.argwhere(i==np.asarray(exp_config.fs_label_list)) for i in y_list[0]]).flatten()
-
-        image_tensor_shape = [X.shape[0]] + list(exp_config.image_size) + [1]
-        X = np.reshape(X, image_tensor_shape)
+            y_list[0] = labels_to_standard_range(y_list[0], exp_config.fs_label_list)
 
         if augmentation_function:
             X, y_list = augmentation_function(X, y_list, do_fliplr=exp_config.do_fliplr)
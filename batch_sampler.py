@@ -0,0 +1,245 @@
+# Authors:
+# Jonathan Dietrich
+
+# stratified index sampler for the minibatch iterators and the DataSampler
+
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+
+from batch_generator_list import block_shuffle_indices
+
+
+def stratify_indices(selection_indices, label_arrays):
+    '''
+    Splits the selected indices into strata with the same combination of labels (e.g. diagnosis x field strength)
+    :param selection_indices: indices of the images that can be sampled
+    :param label_arrays: list of label arrays (or hdf5 datasets) with one label per image
+    :return: dict with tuples of labels as keys and numpy arrays of indices as values
+    '''
+    selection_indices = np.asarray(selection_indices)
+    # read the (small) label datasets only once
+    labels = np.stack([np.asarray(label_array)[selection_indices] for label_array in label_arrays], axis=1)
+    keys, stratum_of_index = np.unique(labels, axis=0, return_inverse=True)
+    stratum_of_index = stratum_of_index.reshape(-1)
+    return {tuple(key.tolist()): selection_indices[stratum_of_index == stratum_nr]
+            for stratum_nr, key in enumerate(keys)}
+
+
+class StratifiedSampler(object):
+    '''
+    Draws batches of indices from strata of images (see stratify_indices).
+    Every stratum is iterated in epochs without replacement. The permutation of an epoch is generated from
+    (seed, stratum number, epoch), so a stratum only keeps its epoch and cursor.
+    The number of images per stratum in a batch is given by the target count of the stratum after the batch
+    (its weight times the number of indices drawn in total) minus the number of indices already drawn from it. The
+    counts are rounded down and the rest of the batch goes to the strata with the largest remainders, so a batch always
+    has batch_size indices, the counts are deterministic and over many batches exactly follow the weights of the strata.
+    Drawing a batch costs O(batch_size + number of strata), plus O(stratum size) once per epoch of a stratum.
+    mode:
+        'proportional': strata are sampled according to their size (same statistics as a global shuffle)
+        'balanced': every stratum gets the same share of the batch
+    '''
+    def __init__(self, strata, mode='proportional', block_size=None, shuffle_data=True, seed=None):
+        if mode not in ('proportional', 'balanced'):
+            raise ValueError('Unknown sampling mode: %s' % mode)
+        if not isinstance(strata, dict):
+            strata = {None: strata}
+        # empty strata are left out
+        self.stratum_keys = [key for key in sorted(strata.keys(), key=str) if len(strata[key]) > 0]
+        self.strata = [np.sort(np.asarray(strata[key])) for key in self.stratum_keys]
+        if not self.strata:
+            raise ValueError('No indices to sample from')
+
+        self.mode = mode
+        self.block_size = block_size
+        self.shuffle_data = shuffle_data
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+        self.seed = seed
+
+        if mode == 'balanced':
+            weights = np.ones(len(self.strata))
+        else:
+            weights = np.asarray([len(stratum) for stratum in self.strata], dtype=np.float64)
+        self.weights = weights / np.sum(weights)
+
+        # state
+        self.n_drawn = 0  # number of indices drawn in total
+        self.epochs = np.zeros(len(self.strata), dtype=np.int64)
+        self.cursors = np.zeros(len(self.strata), dtype=np.int64)
+        self.permutations = [None]*len(self.strata)
+
+    @classmethod
+    def from_labels(cls, selection_indices, label_arrays, **kwargs):
+        return cls(stratify_indices(selection_indices, label_arrays), **kwargs)
+
+    def __len__(self):
+        return int(sum(len(stratum) for stratum in self.strata))
+
+    def _epoch_permutation(self, stratum_nr):
+        stratum = self.strata[stratum_nr]
+        if not self.shuffle_data:
+            return stratum
+        random_state = np.random.RandomState([self.seed, stratum_nr, int(self.epochs[stratum_nr])])
+        if self.block_size is None:
+            return stratum[random_state.permutation(len(stratum))]
+        return block_shuffle_indices(stratum, self.block_size, random_state=random_state)
+
+    def _draw_from_stratum(self, stratum_nr, n_draw):
+        drawn = []
+        while n_draw > 0:
+            if self.permutations[stratum_nr] is None:
+                self.permutations[stratum_nr] = self._epoch_permutation(stratum_nr)
+            permutation = self.permutations[stratum_nr]
+            cursor = self.cursors[stratum_nr]
+            n_take = min(n_draw, len(permutation) - cursor)
+            drawn.append(permutation[cursor:cursor + n_take])
+            n_draw -= n_take
+            self.cursors[stratum_nr] += n_take
+            if self.cursors[stratum_nr] == len(permutation):
+                # start a new epoch of this stratum
+                self.epochs[stratum_nr] += 1
+                self.cursors[stratum_nr] = 0
+                self.permutations[stratum_nr] = None
+        return drawn
+
+    def counts_per_stratum(self, batch_size):
+        '''
+        Number of indices drawn from each stratum for the next batch
+        :return: numpy array with non-negative counts that sum up to batch_size
+        '''
+        # indices drawn from every stratum so far (full epochs plus the cursor in the current epoch)
+        drawn = self.epochs * np.asarray([len(stratum) for stratum in self.strata]) + self.cursors
+        missing = self.weights * (self.n_drawn + batch_size) - drawn
+        counts = np.maximum(np.floor(missing + 1e-9).astype(np.int64), 0)
+        remainders = missing - counts
+        n_left = batch_size - int(np.sum(counts))
+        if n_left > 0:
+            # stable sort, so ties go to the first strata
+            counts[np.argsort(-remainders, kind='mergesort')[:n_left]] += 1
+        while n_left < 0:
+            # strata that are ahead of their target give back indices, the ones with the smallest remainder first
+            candidates = np.flatnonzero(counts > 0)
+            counts[candidates[np.argmin(remainders[candidates])]] -= 1
+            remainders = missing - counts
+            n_left += 1
+        return counts
+
+    def next_indices(self, batch_size):
+        '''
+        Draws the indices of the next batch
+        :param batch_size: number of indices
+        :return: numpy array with the indices in increasing order (as needed by HDF5). An index can occur more than
+        once if a stratum is smaller than its share of the batch or starts a new epoch inside the batch
+        '''
+        drawn = []
+        for stratum_nr, n_draw in enumerate(self.counts_per_stratum(batch_size)):
+            drawn += self._draw_from_stratum(stratum_nr, n_draw)
+        self.n_drawn += batch_size
+        indices = np.sort(np.concatenate(drawn))
+        assert len(indices) == batch_size
+        return indices
+
+    def get_state(self):
+        '''
+        State of the sampler as a dict of plain python types (can be saved as json). The epoch permutations are not
+        part of the state, they are generated again from the seed.
+        '''
+        return {'seed': int(self.seed),
+                'mode': self.mode,
+                'block_size': self.block_size,
+                'stratum_sizes': [len(stratum) for stratum in self.strata],
+                'n_drawn': int(self.n_drawn),
+                'epochs': self.epochs.tolist(),
+                'cursors': self.cursors.tolist()}
+
+    def set_state(self, state):
+        '''
+        Continues sampling from a state returned by get_state in O(1), without replaying the drawn batches.
+        The sampler has to be created with the same strata, mode and block size.
+        '''
+        if state['stratum_sizes'] != [len(stratum) for stratum in self.strata] or state['mode'] != self.mode \
+                or state['block_size'] != self.block_size:
+            raise ValueError('The saved sampler state belongs to different strata or sampling settings')
+        self.seed = state['seed']
+        self.n_drawn = state['n_drawn']
+        self.epochs = np.asarray(state['epochs'], dtype=np.int64)
+        self.cursors = np.asarray(state['cursors'], dtype=np.int64)
+        self.permutations = [None]*len(self.strata)
+
+
+def sampler_state_path(checkpoint_path):
+    return checkpoint_path + '.sampler_state.json'
+
+
+def sampler_states(samplers):
+    '''
+    :param samplers: dict with names and StratifiedSamplers
+    :return: dict with the names and the current states of the samplers
+    '''
+    return {name: sampler.get_state() for name, sampler in samplers.items()}
+
+
+def save_sampler_states(checkpoint_path, samplers=None, states=None):
+    '''
+    Saves the states of the samplers next to a checkpoint and removes the states of checkpoints that the
+    saver already deleted
+    :param checkpoint_path: path returned by saver.save (e.g. log_dir/model.ckpt-200)
+    :param samplers: dict with names and StratifiedSamplers
+    :param states: states taken earlier with sampler_states instead of the current states of samplers (e.g. for a
+    checkpoint that is written in the background, see checkpoint_writer.py)
+    '''
+    if states is None:
+        states = sampler_states(samplers)
+    state_path = sampler_state_path(checkpoint_path)
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump(states, state_file)
+    os.rename(state_path + '.tmp', state_path)
+
+    for old_state_path in glob.glob(sampler_state_path(checkpoint_path.rsplit('-', 1)[0] + '-*')):
+        if not os.path.exists(old_state_path.replace('.sampler_state.json', '.index')) \
+                and not os.path.exists(old_state_path.replace('.sampler_state.json', '.meta')):
+            os.remove(old_state_path)
+
+
+def restore_sampler_states(checkpoint_path, samplers):
+    '''
+    Restores the states of the samplers saved with a checkpoint. If there is no saved state (e.g. checkpoints of
+    older runs) the samplers keep their fresh state.
+    :param checkpoint_path: checkpoint that is restored (e.g. log_dir/model.ckpt-200)
+    :param samplers: dict with names and StratifiedSamplers
+    :return: True if the states were restored
+    '''
+    state_path = sampler_state_path(checkpoint_path)
+    if not os.path.exists(state_path):
+        logging.warning('No sampler state found for %s. The data order starts from a new permutation.' % checkpoint_path)
+        return False
+    with open(state_path, 'r') as state_file:
+        states = json.load(state_file)
+    for name, sampler in samplers.items():
+        sampler.set_state(states[name])
+    logging.info('Restored the sampler states from %s' % state_path)
+    return True
+
+
+if __name__ == '__main__':
+
+    # every batch has batch_size indices and the strata get their share, also with very uneven strata
+    for mode in ['proportional', 'balanced']:
+        for batch_size in [1, 2, 7, 9, 16]:
+            strata = {0: np.arange(135), 1: np.arange(135, 139), 2: np.arange(139, 261), 3: np.arange(261, 262)}
+            sampler = StratifiedSampler(strata, mode=mode, seed=0)
+            n_per_stratum = np.zeros(len(strata), dtype=np.int64)
+            n_batches = 2000
+            for _ in range(n_batches):
+                counts = sampler.counts_per_stratum(batch_size)
+                assert np.all(counts >= 0) and np.sum(counts) == batch_size, counts
+                assert len(sampler.next_indices(batch_size)) == batch_size
+                n_per_stratum += counts
+            deviation = np.max(np.abs(n_per_stratum - sampler.weights*n_batches*batch_size))
+            assert deviation < 1 + 1e-6, deviation
+            print('%s, batch size %d: ok (counts per stratum %s)' % (mode, batch_size, n_per_stratum.tolist()))
@@ -0,0 +1,186 @@
+# Authors:
+# Jonathan Dietrich
+
+# asynchronous checkpoints of the training
+# AsyncSaver.save copies the values of the variables in the training loop (one sess.run) and the background thread of
+# a CheckpointWriter writes them as a normal TensorFlow checkpoint (restorable with tf.train.Saver). So a training step
+# with a save only waits for the copy and not for the disk.
+# A checkpoint is written into a temporary folder next to it and then moved into place file by file with the .meta
+# file last. The checkpoints are found by their .meta file (utils.get_latest_model_checkpoint_path), so only complete
+# checkpoints are found, even if the training was killed while a checkpoint was written. Afterwards the 'checkpoint'
+# state file is updated (atomically) like tf.train.Saver does.
+# Like a tf.train.Saver every AsyncSaver keeps its max_to_keep latest checkpoints, the oldest one is deleted when a
+# newer one is complete.
+
+import atexit
+import glob
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import tensorflow as tf
+
+
+def _delete_checkpoint(checkpoint_path):
+    # the .meta file first, so the checkpoint is not found anymore while its other files are deleted
+    for path in [checkpoint_path + '.meta', checkpoint_path + '.index'] + glob.glob(checkpoint_path + '.data-*'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class CheckpointWriter(object):
+    '''
+    Background thread that writes the checkpoints of the AsyncSavers created with saver().
+    Has to be created in the training graph after all variables of the checkpoints were created. The writer has its own
+    graph and session on the CPU with a copy of the variables that is saved.
+    '''
+    def __init__(self, var_list=None, max_pending=2):
+        '''
+        :param var_list: variables in the checkpoints, all global variables (like tf.train.Saver) if None
+        :param max_pending: number of copies of the variables that can wait to be written. save blocks while this many
+        checkpoints are pending
+        '''
+        if var_list is None:
+            var_list = tf.global_variables()
+        self.variables = var_list
+        # saver in the training graph for restoring the checkpoints and for their meta graph
+        self.graph_saver = tf.train.Saver(var_list, max_to_keep=None)
+        self.meta_graph = self.graph_saver.export_meta_graph().SerializeToString()
+
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in var_list]
+            copies = [tf.Variable(placeholder, trainable=False, name='variable_copy')
+                      for placeholder in self.placeholders]
+            self.assign_op = tf.group(*[copy.initializer for copy in copies])
+            # the same names as the variables in the training graph
+            self.saver = tf.train.Saver({var.op.name: copy for var, copy in zip(var_list, copies)}, max_to_keep=None)
+        self.session = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.closed = False
+        self.n_written = 0
+        self.snapshot_time = 0.0  # time the training loop spent copying the variables
+        self.write_time = 0.0  # time the background thread spent writing
+        self.thread = threading.Thread(target=self._write_loop, name='checkpoint_writer', daemon=True)
+        self.thread.start()
+        # the pending checkpoints are written before the interpreter exits
+        atexit.register(self.close)
+
+    def saver(self, max_to_keep=5):
+        '''
+        :param max_to_keep: number of checkpoints that are kept, all if None or 0
+        :return: AsyncSaver that writes with this writer
+        '''
+        return AsyncSaver(self, max_to_keep=max_to_keep)
+
+    def submit(self, saver, sess, checkpoint_path, after_write=None):
+        self._raise_error()
+        start_time = time.time()
+        # sess.run returns new numpy arrays, so the values don't change in the next training steps while the checkpoint
+        # is written
+        values = sess.run(self.variables)
+        self.snapshot_time += time.time() - start_time
+        self.queue.put((saver, values, checkpoint_path, after_write))
+
+    def _write_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                saver, values, checkpoint_path, after_write = job
+                start_time = time.time()
+                self._write(values, checkpoint_path)
+                saver.written(checkpoint_path)
+                if after_write is not None:
+                    after_write(checkpoint_path)
+                self.write_time += time.time() - start_time
+                self.n_written += 1
+            except Exception as error:
+                logging.exception('Writing the checkpoint %s failed' % checkpoint_path)
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write(self, values, checkpoint_path):
+        save_dir, file_name = os.path.split(checkpoint_path)
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_%s_' % file_name, dir=save_dir)
+        try:
+            self.session.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+            tmp_path = os.path.join(tmp_dir, file_name)
+            self.saver.save(self.session, tmp_path, write_meta_graph=False, write_state=False)
+            with open(tmp_path + '.meta', 'wb') as meta_file:
+                meta_file.write(self.meta_graph)
+            # os.replace is atomic, the checkpoint is complete when the .meta file is in place
+            for tmp_file in sorted(glob.glob(tmp_path + '.data-*')) + [tmp_path + '.index', tmp_path + '.meta']:
+                os.replace(tmp_file, os.path.join(save_dir, os.path.basename(tmp_file)))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed: %s' % error)
+
+    def wait(self):
+        '''
+        Blocks until all pending checkpoints are written
+        '''
+        self.queue.join()
+        self._raise_error()
+
+    def log_stats(self):
+        logging.info('Checkpoints: %d written, %.2f s copying the variables in the training loop, %.1f s writing in the '
+                     'background' % (self.n_written, self.snapshot_time, self.write_time))
+
+    def close(self):
+        # writes the pending checkpoints
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.session.close()
+        self._raise_error()
+
+
+class AsyncSaver(object):
+    '''
+    Saves and restores checkpoints like tf.train.Saver, but the checkpoints are written in the background thread of a
+    CheckpointWriter
+    '''
+    def __init__(self, writer, max_to_keep=5):
+        self.writer = writer
+        self.max_to_keep = max_to_keep
+        self.checkpoints = []  # complete checkpoints of this saver, oldest first (changed in the writer thread)
+
+    def save(self, sess, save_path, global_step=None, after_write=None):
+        '''
+        :param sess: session of the training graph
+        :param save_path: e.g. log_dir/model.ckpt
+        :param after_write: function that is called with the checkpoint path in the writer thread when the checkpoint
+        is complete (e.g. to save additional state next to it)
+        :return: path of the checkpoint (e.g. log_dir/model.ckpt-200), the files exist when the checkpoint is written
+        '''
+        checkpoint_path = save_path if global_step is None else '%s-%d' % (save_path, global_step)
+        self.writer.submit(self, sess, checkpoint_path, after_write)
+        return checkpoint_path
+
+    def restore(self, sess, save_path):
+        self.writer.graph_saver.restore(sess, save_path)
+
+    def written(self, checkpoint_path):
+        # called by the writer thread when the checkpoint is complete
+        if checkpoint_path in self.checkpoints:
+            self.checkpoints.remove(checkpoint_path)
+        self.checkpoints.append(checkpoint_path)
+        while self.max_to_keep and len(self.checkpoints) > self.max_to_keep:
+            _delete_checkpoint(self.checkpoints.pop(0))
+        tf.train.update_checkpoint_state(os.path.dirname(checkpoint_path), checkpoint_path,
+                                         all_model_checkpoint_paths=self.checkpoints)
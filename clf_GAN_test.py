@@ -23,6 +23,9 @@ import adni_data_loader_all
 import data_utils
 import experiments.gan.standard_parameters as std_params
 from batch_generator_list import iterate_minibatches
+from metadata_index import get_metadata_index
+from translation_cache import open_translation_cache
+import histogram_translation
 import test_utils
 
 
@@ -53,6 +56,27 @@ def log_stats_fclf(prediction_count, source_label, target_label):
     return score
 
 
+def classifier_predictions(image_batch, classifiers, clf_config, checkpoint_path, session_config):
+    '''
+    Classifies an image batch with the restored classifier graph of its batch size. The graph of a batch size is built
+    and restored when the batch size occurs the first time (e.g. for the smaller last batch)
+    :param image_batch: numpy array with shape [N, x, y, z, 1]
+    :param classifiers: dict batch size -> (session, image placeholder, predictions), new batch sizes are added
+    :param checkpoint_path: classifier checkpoint
+    :return: predictions of build_clf_graph for the batch
+    '''
+    batch_size = image_batch.shape[0]
+    if batch_size not in classifiers:
+        graph_clf, image_pl, predictions_clf_op, init_clf_op, saver_clf = build_clf_graph(list(image_batch.shape),
+                                                                                          clf_config)
+        sess_clf = tf.Session(config=session_config, graph=graph_clf)
+        sess_clf.run(init_clf_op)
+        saver_clf.restore(sess_clf, checkpoint_path)
+        classifiers[batch_size] = (sess_clf, image_pl, predictions_clf_op)
+    sess_clf, image_pl, predictions_clf_op = classifiers[batch_size]
+    return sess_clf.run(predictions_clf_op, feed_dict={image_pl: image_batch})
+
+
 def build_gen_graph_old(img_tensor_shape, gan_config):
     generator = gan_config.generator
     graph_generator = tf.Graph()
@@ -72,7 +96,9 @@ def build_gen_graph_old(img_tensor_shape, gan_config):
 
 
 def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experiment_path, score_functions,
-                                            image_saving_indices=set(), image_saving_path=None, max_batch_size=np.inf):
+                                            image_saving_indices=set(), image_saving_path=None, max_batch_size=np.inf,
+                                            use_translation_cache=False, translation_noise_seed=0,
+                                            evaluate_histogram_baseline=False):
     """
 
     :param gan_experiment_path_list: list of GAN experiment paths to be evaluated. They must all have the same image settings and source/target field strengths as the classifier
@@ -81,6 +107,11 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
     :param verbose: boolean. log all image classifications
     :param image_saving_indices: set of indices of the images to be saved
     :param image_saving_path: where to save the images. They are saved in subfolders for each experiment
+    :param use_translation_cache: read the generated images from the translation cache of the GAN checkpoint if it
+    exists (see translation_cache.py) instead of running the generator
+    :param translation_noise_seed: noise seed of the cache for generators with input noise
+    :param evaluate_histogram_baseline: also evaluate the translation with the quantile mapping of the intensities
+    (see histogram_translation.py) fitted on the training data
     :return:
     """
 
@@ -107,7 +138,6 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
     batch_size = min(clf_config.batch_size, std_params.batch_size, max_batch_size)
     logging.info('batch size %d is used for everything' % batch_size)
     img_tensor_shape = [batch_size, im_s[0], im_s[1], im_s[2], 1]
-    clf_remainder_batch_size = images_test.shape[0] % batch_size
 
     # prevents ResourceExhaustError when a lot of memory is used
     config = tf.ConfigProto()
@@ -125,13 +155,11 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
     sess_clf.run(init_clf_op)
     saver_clf.restore(sess_clf, init_checkpoint_path_clf)
 
-    # make a separate graph for the last batch where the batchsize is smaller
-    if clf_remainder_batch_size > 0:
-        img_tensor_shape_gan_remainder = [clf_remainder_batch_size, im_s[0], im_s[1], im_s[2], 1]
-        graph_clf_rem, image_pl_rem, predictions_clf_op_rem, init_clf_op_rem, saver_clf_rem = build_clf_graph(img_tensor_shape_gan_remainder, clf_config)
-        sess_clf_rem = tf.Session(config=config, graph=graph_clf_rem)
-        sess_clf_rem.run(init_clf_op_rem)
-        saver_clf_rem.restore(sess_clf_rem, init_checkpoint_path_clf)
+    # the real, generated and baseline images are all classified with classify. The last batches can be smaller, they
+    # get separate graphs
+    classifiers = {batch_size: (sess_clf, image_pl, predictions_clf_op)}
+    classify = lambda image_batch: classifier_predictions(image_batch, classifiers, clf_config,
+                                                          init_checkpoint_path_clf, config)
 
     # classifiy all real test images
     logging.info('classify all original images')
@@ -146,11 +174,7 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
         # ignore the labels because data are in order, which means the label list in data can be used
         image_batch, [real_label, real_age] = batch
 
-        current_batch_size = image_batch.shape[0]
-        if current_batch_size < batch_size:
-            clf_prediction_real = sess_clf_rem.run(predictions_clf_op_rem, feed_dict={image_pl_rem: image_batch})
-        else:
-            clf_prediction_real = sess_clf.run(predictions_clf_op, feed_dict={image_pl: image_batch})
+        clf_prediction_real = classify(image_batch)
 
         real_pred = real_pred + list(clf_prediction_real['label'])
         logging.info('new image batch')
@@ -159,24 +183,19 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
 
     gan_config0, logdir_gan0 = utils.load_log_exp_config(gan_experiment_path_list[0])
 
-    source_indices = []
-    target_indices = []
-    source_true_labels = []
-    target_true_labels = []
-    for i, field_strength in enumerate(data['field_strength_test']):
-        if field_strength == gan_config0.source_field_strength:
-            source_indices.append(i)
-            source_true_labels.append(labels_test[i])
-        elif field_strength == gan_config0.target_field_strength:
-            target_indices.append(i)
-            target_true_labels.append(labels_test[i])
+    metadata = get_metadata_index(data)
+    source_indices, target_indices = [ind.tolist() for ind in metadata.domain_indices(
+        'test', gan_config0.source_field_strength, gan_config0.target_field_strength)]
+    source_true_labels = metadata['test']['diagnosis'][source_indices].tolist()
+    target_true_labels = metadata['test']['diagnosis'][target_indices].tolist()
 
     # balance the test set
     (source_indices, source_true_labels), (
     target_indices, target_true_labels) = utils.balance_source_target(
         (source_indices, source_true_labels), (target_indices, target_true_labels), random_seed=0)
-    source_pred = [pred for ind, pred in enumerate(real_pred) if ind in source_indices]
-    target_pred = [pred for ind, pred in enumerate(real_pred) if ind in target_indices]
+    # the balanced indices are sorted, so the predictions stay in the order of the labels
+    source_pred = np.asarray(real_pred)[source_indices].tolist()
+    target_pred = np.asarray(real_pred)[target_indices].tolist()
 
     assert len(source_pred) == len(source_true_labels)
     assert len(target_pred) == len(target_true_labels)
@@ -256,15 +275,21 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
         # open the latest GAN savepoint
         init_checkpoint_path_gan = get_latest_checkpoint_and_log(logdir_gan, 'model.ckpt')
 
-        # build a separate graph for the generator
-        graph_generator, generator_img_pl, x_fake_op, init_gan_op, saver_gan = test_utils.build_gen_graph(img_tensor_shape, gan_config)
+        translation_cache = None
+        if use_translation_cache:
+            noise_seed = translation_noise_seed if gan_config.use_generator_input_noise else None
+            translation_cache = open_translation_cache(data, init_checkpoint_path_gan, noise_seed)
 
-        # Create a session for running Ops on the Graph.
-        sess_gan = tf.Session(config=config, graph=graph_generator)
+        if translation_cache is None:
+            # build a separate graph for the generator
+            graph_generator, generator_img_pl, x_fake_op, init_gan_op, saver_gan = test_utils.build_gen_graph(img_tensor_shape, gan_config)
 
-        # Run the Op to initialize the variables.
-        sess_gan.run(init_gan_op)
-        saver_gan.restore(sess_gan, init_checkpoint_path_gan)
+            # Create a session for running Ops on the Graph.
+            sess_gan = tf.Session(config=config, graph=graph_generator)
+
+            # Run the Op to initialize the variables.
+            sess_gan.run(init_gan_op)
+            saver_gan.restore(sess_gan, init_checkpoint_path_gan)
 
         # path where the generated images are saved
         experiment_generate_path = os.path.join(image_saving_path, gan_experiment_name)
@@ -273,16 +298,9 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
         utils.makefolder(experiment_generate_path)
         utils.makefolder(experiment_generate_path2d)
 
-        # make separate graphs for the last batch where the batchsize is smaller
-        if clf_remainder_batch_size > 0:
+        # make a separate generator graph for the last batch where the batchsize is smaller
+        if gan_remainder_batch_size > 0 and translation_cache is None:
             img_tensor_shape_gan_remainder = [gan_remainder_batch_size, im_s[0], im_s[1], im_s[2], 1]
-            # classifier
-            graph_clf_rem, image_pl_rem, predictions_clf_op_rem, init_clf_op_rem, saver_clf_rem = build_clf_graph(img_tensor_shape_gan_remainder, clf_config)
-            sess_clf_rem = tf.Session(config=config, graph=graph_clf_rem)
-            sess_clf_rem.run(init_clf_op_rem)
-            saver_clf_rem.restore(sess_clf_rem, init_checkpoint_path_clf)
-
-            # generator
             graph_generator_rem, generator_img_rem_pl, x_fake_op_rem, init_gan_op_rem, saver_gan_rem = \
                 test_utils.build_gen_graph(img_tensor_shape_gan_remainder, gan_config)
             # Create a session for running Ops on the Graph.
@@ -307,14 +325,17 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
             image_batch, [real_label, real_age] = batch
 
             current_batch_size = image_batch.shape[0]
-            if current_batch_size < batch_size:
+            if translation_cache is not None:
+                # the images are iterated in the order of source_indices
+                fake_img = translation_cache.read('test', source_indices[batch_beginning_index:
+                                                                         batch_beginning_index + current_batch_size])
+            elif current_batch_size < batch_size:
                 fake_img = sess_gan_rem.run(x_fake_op_rem, feed_dict={generator_img_rem_pl: image_batch})
-                # classify fake image
-                clf_prediction_fake = sess_clf_rem.run(predictions_clf_op_rem, feed_dict={image_pl_rem: fake_img})
             else:
                 fake_img = sess_gan.run(x_fake_op, feed_dict={generator_img_pl: image_batch})
-                # classify fake image
-                clf_prediction_fake = sess_clf.run(predictions_clf_op, feed_dict={image_pl: fake_img})
+
+            # classify fake image
+            clf_prediction_fake = classify(fake_img)
 
             generated_pred = generated_pred + list(clf_prediction_fake['label'])
 
@@ -350,6 +371,31 @@ def generate_and_evaluate_ad_classification(gan_experiment_path_list, clf_experi
         logging.info('generated prediction for %s: %s' % (gan_experiment_name, str(generated_pred)))
         scores[gan_experiment_name] = evaluate_scores(source_true_labels, generated_pred, score_functions)
 
+    if evaluate_histogram_baseline:
+        baseline_name = 'quantile_mapping_%.1fT_to_%.1fT' % (gan_config0.source_field_strength,
+                                                             gan_config0.target_field_strength)
+        logging.info('\nBaseline: %s' % baseline_name)
+        # the source images are translated to the target field strength like by the GANs
+        translator, _ = histogram_translation.fit_quantile_mapping(data, gan_config0.source_field_strength,
+                                                                   gan_config0.target_field_strength, split='train')
+
+        baseline_pred = []
+        for batch in iterate_minibatches(images_test,
+                                         [labels_test, ages_test],
+                                         batch_size=batch_size,
+                                         exp_config=clf_config,
+                                         map_labels_to_standard_range=False,
+                                         selection_indices=source_indices,
+                                         shuffle_data=False,
+                                         skip_remainder=False):
+            image_batch, [real_label, real_age] = batch
+            clf_prediction_translated = classify(translator.translate(image_batch))
+            baseline_pred = baseline_pred + list(clf_prediction_translated['label'])
+
+        translator.log_throughput()
+        logging.info('prediction for %s: %s' % (baseline_name, str(baseline_pred)))
+        scores[baseline_name] = evaluate_scores(source_true_labels, baseline_pred, score_functions)
+
     logging.info('source prediction: ' + str(source_pred))
     logging.info('source ground truth: ' + str(source_true_labels))
     logging.info('target prediction: ' + str(target_pred))
@@ -526,6 +572,8 @@ if __name__ == '__main__':
     gan_log_root = os.path.join(sys_config.log_root, 'gan/final')  # <---------------------------------
     image_saving_path = os.path.join(sys_config.project_root,'data/generated_images/final/all_experiments')
     image_saving_indices = set(range(0, 220, 5))
+    use_translation_cache = True  # use the images of translation_cache.py if they exist # <---------------------------------
+    evaluate_histogram_baseline = True  # quantile mapping baseline (histogram_translation.py) # <------------------------
 
     # put paths for experiments together
     clf_log_path = os.path.join(clf_log_root, clf_experiment_name)
@@ -544,7 +592,9 @@ if __name__ == '__main__':
                                                          clf_experiment_path=clf_log_path,
                                                          score_functions=score_functions,
                                                          image_saving_indices=image_saving_indices,
-                                                         image_saving_path=image_saving_path, max_batch_size=np.inf)
+                                                         image_saving_path=image_saving_path, max_batch_size=np.inf,
+                                                         use_translation_cache=use_translation_cache,
+                                                         evaluate_histogram_baseline=evaluate_histogram_baseline)
 
     # function to get the f1 score from an element of clf_scores.items()
     get_f1_score = lambda dict_key: clf_scores[dict_key]['f1']
@@ -22,6 +22,9 @@ local_hostnames = ['brossa']
 
 log_root = os.path.join(project_root, 'log_dir')
 
+# folder in shared memory (tmpfs) where dataset_server.py puts the preprocessed data
+shared_memory_root = '/dev/shm/mri_domain_adapt'
+
 def setup_GPU_environment():
     hostname = socket.gethostname()
     print('Running on %s' % hostname)
@@ -0,0 +1,232 @@
+# Authors:
+# Jonathan Dietrich
+
+# data parallel training of the classifiers with several local worker processes (e.g. on CPU nodes)
+# Every worker builds its own graph and trains on its own shard of the training images. The gradients a worker
+# accumulated over n_accum_batches batches (GradientAccumulator with average_externally=True) are averaged over all
+# workers through shared memory and then applied by every worker, so the variables of the workers stay equal and the
+# effective batch size is n_workers * n_accum_batches * batch_size.
+# Worker 0 (the chief) evaluates the model and writes the summaries and the checkpoints. Decisions of the chief that
+# change the training (the learning rate schedule) are broadcast to the other workers.
+# The moving averages of batch normalization are not averaged, every worker keeps the ones of its shard (the ones of
+# the chief are saved).
+
+import ctypes
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+
+def _flatten(arrays):
+    return np.concatenate([np.asarray(array, dtype=np.float32).ravel() for array in arrays])
+
+
+def _unflatten(flat, templates):
+    arrays = []
+    start = 0
+    for template in templates:
+        template = np.asarray(template)
+        arrays.append(flat[start:start + template.size].reshape(template.shape).astype(template.dtype))
+        start += template.size
+    return arrays
+
+
+class SharedMemoryCollective(object):
+    '''
+    Allreduce and broadcast of numpy arrays between the worker processes through a shared float32 buffer.
+    The buffer has a row of chunk_size values for every worker and a row for the result, longer arrays are reduced in
+    chunks. The collective is created in the parent process and passed to the workers, which call attach with their
+    rank. All workers have to call the same operations in the same order.
+    '''
+    def __init__(self, n_workers, chunk_size, context):
+        self.n_workers = n_workers
+        self.chunk_size = chunk_size
+        self.shared_buffer = context.RawArray(ctypes.c_float, (n_workers + 1)*chunk_size)
+        self.barrier = context.Barrier(n_workers)
+        self.rank = None
+        self.buffer = None
+        self.wait_time = 0.0  # time spent in the barriers, mostly waiting for slower workers
+
+    def attach(self, rank):
+        self.rank = rank
+        self.buffer = np.frombuffer(self.shared_buffer, dtype=np.float32).reshape([self.n_workers + 1,
+                                                                                   self.chunk_size])
+
+    def _wait(self):
+        start_time = time.time()
+        self.barrier.wait()
+        self.wait_time += time.time() - start_time
+
+    def allreduce_mean(self, arrays):
+        '''
+        :param arrays: list of numpy arrays, the same shapes in all workers
+        :return: list with the mean of every array over the workers (identical in all workers)
+        '''
+        flat = _flatten(arrays)
+        averaged = np.empty_like(flat)
+        result_row = self.buffer[self.n_workers]
+        for start in range(0, flat.size, self.chunk_size):
+            size = min(self.chunk_size, flat.size - start)
+            self.buffer[self.rank, :size] = flat[start:start + size]
+            self._wait()
+            # every worker averages its segment of the chunk into the result row
+            segment_size = -(-size // self.n_workers)
+            begin = min(self.rank*segment_size, size)
+            end = min(begin + segment_size, size)
+            np.mean(self.buffer[:self.n_workers, begin:end], axis=0, out=result_row[begin:end])
+            self._wait()
+            # the result row is only written again after all workers passed the first barrier of the next chunk
+            averaged[start:start + size] = result_row[:size]
+        return _unflatten(averaged, arrays)
+
+    def broadcast(self, arrays, root=0):
+        '''
+        :param arrays: list of numpy arrays. Only the values of the root are used, the other workers pass arrays with
+        the same shapes and dtypes
+        :return: list with the arrays of the root
+        '''
+        flat = _flatten(arrays)
+        result_row = self.buffer[self.n_workers]
+        for start in range(0, flat.size, self.chunk_size):
+            size = min(self.chunk_size, flat.size - start)
+            # all workers have read the result row of the previous operation
+            self._wait()
+            if self.rank == root:
+                result_row[:size] = flat[start:start + size]
+            self._wait()
+            flat[start:start + size] = result_row[:size]
+        return _unflatten(flat, arrays)
+
+    def abort(self):
+        # wakes up the workers waiting in a barrier (with a BrokenBarrierError), e.g. after another worker failed
+        self.barrier.abort()
+
+
+def shard_indices(indices, rank, n_workers):
+    '''
+    Shard of the training images of a worker. All shards have the same size (up to n_workers - 1 images are left out),
+    so all workers have the same number of batches per epoch
+    :param indices: indices of the training images
+    :return: numpy array with the indices of the shard
+    '''
+    indices = np.sort(np.asarray(indices))
+    shard_size = len(indices) // n_workers
+    return indices[rank::n_workers][:shard_size].copy()
+
+
+class DataParallelWorker(object):
+    '''
+    The collective of a worker process and the data parallel operations of the training loop
+    '''
+    def __init__(self, collective, rank):
+        self.collective = collective
+        self.rank = rank
+        self.n_workers = collective.n_workers
+        self.is_chief = rank == 0
+        self.n_applied = 0
+        self.allreduce_time = 0.0
+
+    def configure_session(self, config):
+        '''
+        Splits the cores of the node between the workers
+        :param config: tf.ConfigProto of the session of the worker
+        '''
+        n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+        config.intra_op_parallelism_threads = max(1, n_cores // self.n_workers)
+        config.inter_op_parallelism_threads = 2
+        return config
+
+    def sync_variables(self, sess, variables):
+        '''
+        Sets the variables of all workers to the values of the chief (after the initialization or the restore of a
+        checkpoint)
+        '''
+        import tensorflow as tf
+
+        if self.is_chief:
+            values = sess.run(variables)
+        else:
+            values = [np.zeros(var.get_shape().as_list(), dtype=var.dtype.base_dtype.as_numpy_dtype)
+                      for var in variables]
+        values = self.collective.broadcast(values)
+        if not self.is_chief:
+            placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape()) for var in variables]
+            assign_op = tf.group(*[var.assign(placeholder) for var, placeholder in zip(variables, placeholders)])
+            sess.run(assign_op, feed_dict=dict(zip(placeholders, values)))
+        logging.info('Worker %d: synchronized %d variables with the chief' % (self.rank, len(variables)))
+
+    def broadcast_scalar(self, value):
+        '''
+        :return: the value of the chief
+        '''
+        return float(self.collective.broadcast([np.float32(value)])[0])
+
+    def train_step(self, sess, accumulator, fetches, feed_dict, apply_feed_dict):
+        '''
+        Accumulates the gradients of the fed batch. On every n_accum_batches-th batch the accumulated gradients are
+        averaged over the workers and applied.
+        :param accumulator: GradientAccumulator with average_externally=True
+        :param fetches: fetched with the accumulation (e.g. the loss)
+        :param feed_dict: feed_dict of the batch
+        :param apply_feed_dict: feed_dict for applying the gradients (e.g. the learning rate)
+        :return: True if the gradients were applied, the fetched values
+        '''
+        count, fetched = sess.run([accumulator.accum_op, fetches], feed_dict=feed_dict)
+        if count < accumulator.n_accum_batches:
+            return False, fetched
+
+        start_time = time.time()
+        mean_gradients = sess.run(accumulator.mean_gradients)
+        averaged_gradients = self.collective.allreduce_mean(mean_gradients)
+        self.allreduce_time += time.time() - start_time
+
+        apply_feed_dict = dict(apply_feed_dict)
+        apply_feed_dict.update(zip(accumulator.gradient_placeholders, averaged_gradients))
+        sess.run(accumulator.apply_op, feed_dict=apply_feed_dict)
+        self.n_applied += 1
+        return True, fetched
+
+    def log_stats(self):
+        logging.info('Worker %d: %d averaged updates, %.1f s averaging gradients (%.1f s waiting for other workers)'
+                     % (self.rank, self.n_applied, self.allreduce_time, self.collective.wait_time))
+
+
+def _run_worker(training_function, collective, rank, args):
+    # runs in the worker process
+    collective.attach(rank)
+    training_function(*args, worker=DataParallelWorker(collective, rank))
+
+
+def run_workers(training_function, n_workers, args=(), chunk_size=2**24, poll_interval=5.0):
+    '''
+    Runs the training in n_workers local processes (spawned, so the workers have their own TensorFlow runtime)
+    :param training_function: picklable function (e.g. run_training of the training script) that is called as
+    training_function(*args, worker=DataParallelWorker)
+    :param chunk_size: number of float32 values that are reduced at once (the shared buffer has
+    (n_workers + 1)*chunk_size values)
+    :param poll_interval: seconds between the checks whether a worker failed
+    '''
+    context = multiprocessing.get_context('spawn')
+    collective = SharedMemoryCollective(n_workers, chunk_size, context)
+    processes = [context.Process(target=_run_worker, args=(training_function, collective, rank, args),
+                                 name='data_parallel_worker_%d' % rank)
+                 for rank in range(n_workers)]
+    for process in processes:
+        process.start()
+    logging.info('Started %d data parallel workers' % n_workers)
+
+    # a failed worker would block the others in the next barrier, so they are stopped as well
+    failed = False
+    while any(process.is_alive() for process in processes):
+        for process in processes:
+            process.join(timeout=poll_interval / n_workers)
+            if process.exitcode not in (None, 0) and not failed:
+                logging.error('%s failed with exit code %d, stopping the other workers'
+                              % (process.name, process.exitcode))
+                failed = True
+                collective.abort()
+    if failed:
+        raise RuntimeError('Data parallel training failed')
@@ -21,6 +21,9 @@ import gan_model
 from tfwrapper import utils as tf_utils
 import utils
 import adni_data_loader
+from batch_generator_list import read_images_into
+from batch_sampler import StratifiedSampler
+from metadata_index import get_metadata_index
 
 
 # TODO: return image dict and index dict, including test data indices. This requires changing many modules.
@@ -39,69 +42,61 @@ def get_images_and_fieldstrength_indices(data, source_field_strength, target_fie
     images_train = data['images_train']
     images_val = data['images_val']
 
-    source_images_train_ind = []
-    target_images_train_ind = []
-    source_images_val_ind = []
-    target_images_val_ind = []
-
-    for train_ind, _ in enumerate(images_train):
-        field_str = data['field_strength_train'][train_ind]
-        if field_str == source_field_strength:
-            source_images_train_ind.append(train_ind)
-        elif field_str == target_field_strength:
-            target_images_train_ind.append(train_ind)
-
-    for val_ind, _ in enumerate(images_val):
-        field_str = data['field_strength_val'][val_ind]
-        if field_str == source_field_strength:
-            source_images_val_ind.append(val_ind)
-        elif field_str == target_field_strength:
-            target_images_val_ind.append(val_ind)
+    # the field strengths come from the metadata index, the images are not read
+    index = get_metadata_index(data)
+    source_images_train_ind, target_images_train_ind = [ind.tolist() for ind in index.domain_indices(
+        'train', source_field_strength, target_field_strength)]
+    source_images_val_ind, target_images_val_ind = [ind.tolist() for ind in index.domain_indices(
+        'val', source_field_strength, target_field_strength)]
 
     return images_train, source_images_train_ind, target_images_train_ind, \
            images_val, source_images_val_ind, target_images_val_ind
 
 
 def data_summary(data):
-    labels = {'train': data['diagnosis_train'], 'val': data['diagnosis_val']}
-    images_train, source_images_train_ind, target_images_train_ind, \
-    images_val, source_images_val_ind, target_images_val_ind = get_images_and_fieldstrength_indices(data,
-                                                                                                    exp_config.source_field_strength,
-                                                                                                    exp_config.target_field_strength)
-
-    domain_dict = {'train': {'source': source_images_train_ind, 'target': target_images_train_ind},
-                   'val': {'source': source_images_val_ind, 'target': target_images_val_ind}}
-    cathegory_dict ={}
-    for outer_key in domain_dict:
-        cathegory_dict[outer_key] = {}
-        for inner_key, image_indices in domain_dict[outer_key].items():
-            # count how many of each label are in each cathegory in the domain_dict
-            domain_indices = domain_dict[outer_key][inner_key]
-            cathegory_dict[outer_key][inner_key] = Counter([label for index, label in enumerate(labels[outer_key]) if index in domain_indices])
+    index = get_metadata_index(data)
+    cathegory_dict = {}
+    for split in ['train', 'val']:
+        cathegory_dict[split] = {}
+        for domain, field_strength in [('source', exp_config.source_field_strength),
+                                       ('target', exp_config.target_field_strength)]:
+            # count how many of each label are in each cathegory
+            domain_labels = index[split]['diagnosis'][index.mask(split, field_strength=field_strength)]
+            cathegory_dict[split][domain] = Counter(domain_labels.tolist())
 
     return cathegory_dict
 
 
 
 class DataSampler(object):
-    def __init__(self, train_images, images_train_indices, validation_images, images_val_indices):
+    def __init__(self, train_images, images_train_indices, validation_images, images_val_indices,
+                 train_sampler=None, val_sampler=None):
         self.shape = list(exp_config.image_size) + [exp_config.n_channels]  # [x, y, z, #channels]
         self.train_data = train_images
         self.train_subset_ind = images_train_indices  # indices of the subset of the training data that gets sampled
         self.validation_data = validation_images
         self.val_subset_ind = images_val_indices  # indices of the subset of the training data that gets sampled
+        # samplers for the indices, by default epochs without replacement over the whole subset
+        if train_sampler is None:
+            train_sampler = StratifiedSampler(images_train_indices)
+        if val_sampler is None:
+            val_sampler = StratifiedSampler(images_val_indices)
+        self.train_sampler = train_sampler
+        self.val_sampler = val_sampler
 
     # get batch of random images out of the images with index in train_subset_ind
     def __call__(self, batch_size):
-        batch_indices = sorted(random.sample(self.train_subset_ind, batch_size))
-        batch = self.train_data[batch_indices]
-        return self.data2img(batch)
+        batch_indices = self.train_sampler.next_indices(batch_size)
+        return self.read_batch(self.train_data, batch_indices)
 
     # get batch of random images out of the images with index in val_subset_ind
     def get_validation_batch(self, batch_size):
-        batch_indices = sorted(random.sample(self.val_subset_ind, batch_size))
-        batch = self.train_data[batch_indices]
-        return self.data2img(batch)
+        batch_indices = self.val_sampler.next_indices(batch_size)
+        return self.read_batch(self.validation_data, batch_indices)
+
+    def read_batch(self, images, batch_indices):
+        batch = np.empty([len(batch_indices)] + self.shape, dtype=np.float32)
+        return read_images_into(images, batch_indices, batch)
 
     def data2img(self, data):
         return np.reshape(data, [data.shape[0]] + self.shape)
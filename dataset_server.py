@@ -0,0 +1,157 @@
+# Authors:
+# Jonathan Dietrich
+
+# Local dataset server for running several experiments on one node.
+# The server copies the datasets of a preprocessed HDF5 file once into .npy files in shared memory (tmpfs).
+# Training processes attach to them with memory maps (see attach_dataset), so all processes read the same pages
+# without copying the data into their own memory and without opening the HDF5 file.
+#
+# usage: python dataset_server.py <preprocessed hdf5 file> [<preprocessed hdf5 file> ...] [--keep]
+# The served data is removed when the server is stopped (Ctrl+C), unless --keep is given. Processes that are
+# attached at that time keep their memory maps until they exit.
+
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import time
+
+import numpy as np
+import h5py
+
+import config.system as sys_config
+import hdf5_handles
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def dataset_key(data_file_path):
+    # the preprocessed file names contain all preprocessing settings, so they are used as key
+    return os.path.splitext(os.path.basename(data_file_path))[0]
+
+
+def served_folder(data_file_path):
+    return os.path.join(sys_config.shared_memory_root, dataset_key(data_file_path))
+
+
+def source_signature(data_file_path):
+    # served data of an older version of the preprocessed file is not used
+    stat = os.stat(data_file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def serve_dataset(data_file_path):
+    '''
+    Copies all datasets of the HDF5 file into shared memory if they are not served yet
+    :param data_file_path: path of the preprocessed HDF5 file
+    :return: folder of the served data
+    '''
+    folder = served_folder(data_file_path)
+    if attach_dataset(data_file_path) is not None:
+        logging.info('%s is already served from %s' % (dataset_key(data_file_path), folder))
+        return folder
+
+    # write into a temporary folder and rename it when complete, so processes never attach to partial data
+    tmp_folder = folder + '.tmp%d' % os.getpid()
+    os.makedirs(tmp_folder)
+    manifest = {'source': os.path.abspath(data_file_path), 'signature': source_signature(data_file_path),
+                'datasets': []}
+    with h5py.File(data_file_path, 'r') as data:
+        for name, dataset in data.items():
+            if not isinstance(dataset, h5py.Dataset) or dataset.dtype.kind not in 'biuf':
+                logging.warning('%s is not served (no numeric dataset), it is read from the HDF5 file' % name)
+                continue
+            array = np.lib.format.open_memmap(os.path.join(tmp_folder, name + '.npy'), mode='w+',
+                                              dtype=dataset.dtype, shape=dataset.shape)
+            if dataset.size > 0:
+                dataset.read_direct(array)
+            array.flush()
+            del array
+            manifest['datasets'].append(name)
+            logging.info('served %s %s' % (name, str(dataset.shape)))
+    with open(os.path.join(tmp_folder, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    if os.path.exists(folder):
+        # outdated data of an older version of the file
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+    return folder
+
+
+class SharedDataset(object):
+    '''
+    Read-only view of a served HDF5 file. Indexing with a dataset name returns a numpy memory map of the shared data,
+    datasets that are not served are read from the HDF5 file. Can be used instead of the h5py.File returned by
+    adni_data_loader_all.load_and_maybe_process_data.
+    '''
+    def __init__(self, data_file_path, folder, dataset_names):
+        self.filename = data_file_path
+        self.folder = folder
+        self.arrays = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r') for name in dataset_names}
+        # fallback for the datasets that are not served
+        self.h5_file = hdf5_handles.ForkSafeFile(data_file_path)
+
+    def __getitem__(self, name):
+        if name in self.arrays:
+            return self.arrays[name]
+        return self.h5_file[name]
+
+    def __contains__(self, name):
+        return name in self.arrays or name in self.h5_file
+
+    def keys(self):
+        return self.h5_file.keys()
+
+    def close(self):
+        self.h5_file.close()
+
+
+def attach_dataset(data_file_path):
+    '''
+    Attaches to the shared memory copy of a preprocessed file
+    :param data_file_path: path of the preprocessed HDF5 file
+    :return: SharedDataset or None if the file is not served (or the served data is outdated)
+    '''
+    folder = served_folder(data_file_path)
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['signature'] != source_signature(data_file_path):
+        logging.warning('The served data in %s is outdated' % folder)
+        return None
+    return SharedDataset(data_file_path, folder, manifest['datasets'])
+
+
+def remove_served_dataset(data_file_path):
+    folder = served_folder(data_file_path)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+        logging.info('removed %s' % folder)
+
+
+if __name__ == '__main__':
+
+    keep = '--keep' in sys.argv[1:]
+    data_file_paths = [arg for arg in sys.argv[1:] if arg != '--keep']
+
+    for data_file_path in data_file_paths:
+        serve_dataset(data_file_path)
+    logging.info('Serving %d file(s) from %s' % (len(data_file_paths), sys_config.shared_memory_root))
+
+    def stop_serving(signum, frame):
+        if not keep:
+            for data_file_path in data_file_paths:
+                remove_served_dataset(data_file_path)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_serving)
+    signal.signal(signal.SIGINT, stop_serving)
+    while True:
+        time.sleep(3600)
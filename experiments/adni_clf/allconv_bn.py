@@ -1,3 +1,5 @@
+import functools
+
 import model_zoo
 import config.system as sys_config
 import tensorflow as tf
@@ -13,7 +15,8 @@ generator_path = '/scratch_net/brossa/jdietric/PycharmProjects/mri_domain_adapt/
                  + 'residual_gen_n8b4_disc_n8_bn_dropout_keep0.9_no_noise_all_small_data_1e4l1_s15_final_i1'
 
 # Model settings
-clf_model_handle = model_zoo.FCN_multitask_ordinal_bn
+recompute_activations = False  # recompute the activations in the backward pass to save memory (gradient checkpointing)
+clf_model_handle = functools.partial(model_zoo.FCN_multitask_ordinal_bn, recompute=recompute_activations)
 multi_task_model = True
 
 # Data settings
@@ -47,6 +50,11 @@ weight_decay = 0.0  #5e-4  #0.00000
 age_ordinal_regression = True
 batch_size = 20
 n_accum_batches = 1
+data_parallel_workers = 0  # >1: number of local worker processes that average their gradients (data_parallel.py)
+sampling_block_size = None  # shuffle in blocks of neighbouring images for faster HDF5 reads, None shuffles globally
+use_tf_data_pipeline = False  # read the training batches with a tf.data pipeline instead of feeding them
+pipeline_parallel_reads = 4  # number of batches read in parallel by the tf.data pipeline
+pipeline_prefetch_batches = 2
 learning_rate = 1e-4
 optimizer_handle = tf.train.AdamOptimizer
 schedule_lr = False
@@ -59,6 +67,17 @@ augmentation_function = lambda generator, X, y_list: batch_augmentors.generator_
 # generator as augmentation
 use_generator = True # load the generator # <------------------------------------------------------------------------
 translation_fraction = 0.5 # what fraction of the images in a batch go through the generator
+use_translation_cache = False  # read the translated images from the cache of translation_cache.py instead of running the generator
+translation_noise_seed = 0  # noise seed of the cache, only used for generators with input noise
+# augmentation in the graph, in addition to the generator augmentation
+use_graph_augmentation = False  # augment the training batches in the graph (tfwrapper/augmentation.py) instead of in python
+do_rotations = False
+do_scaleaug = False
+do_intensityaug = False
+do_fliplr = True
+augmentation_workers = 0  # >0 augments the batches in a pool of workers (augmentation_pool.py) ahead of the training
+augmentation_queue_size = 4  # number of batches that are augmented ahead
+augmentation_use_processes = False  # worker processes instead of threads, not possible with the generator
 
 
 # Rarely changed settings
@@ -69,3 +88,5 @@ schedule_gradient_threshold = 0.00001  # When the gradient of the learning curve
 
 train_eval_frequency = 500
 val_eval_frequency = 100
+profile_log_frequency = 100  # steps between the logs of the time per training phase (step_profiler.py), 0 = off
+trace_frequency = 0  # >0: Chrome trace timelines of the session runs every trace_frequency steps (log_dir/timelines)
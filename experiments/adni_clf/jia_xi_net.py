@@ -34,6 +34,11 @@ weight_decay = 0.00000  # L2 regularisatino of weights 0.0 turns it off
 age_ordinal_regression = True
 batch_size = 3
 n_accum_batches = 1   # Accumulate the gradients over multiple batches (does not seem to help much).
+data_parallel_workers = 0  # >1: number of local worker processes that average their gradients (data_parallel.py)
+sampling_block_size = None  # shuffle in blocks of neighbouring images for faster HDF5 reads, None shuffles globally
+use_tf_data_pipeline = False  # read the training batches with a tf.data pipeline instead of feeding them
+pipeline_parallel_reads = 4  # number of batches read in parallel by the tf.data pipeline
+pipeline_prefetch_batches = 2
 learning_rate = 0.0001
 optimizer_handle = tf.train.AdamOptimizer
 schedule_lr = False
@@ -42,10 +47,16 @@ momentum = None
 bn_momentum = 0.99
 
 # Augmentation settings
-augmentation_function = batch_augmentors.flip_augment
+use_graph_augmentation = False  # augment the training batches in the graph (tfwrapper/augmentation.py) instead of in python
 do_rotations = False
 do_scaleaug = False
+do_intensityaug = False
 do_fliplr = True
+augmentation_function = batch_augmentors.BatchAugmentor(do_fliplr=do_fliplr, do_rotations=do_rotations,
+                                                        do_scaleaug=do_scaleaug, do_intensityaug=do_intensityaug)
+augmentation_workers = 0  # >0 augments the batches in a pool of workers (augmentation_pool.py) ahead of the training
+augmentation_queue_size = 4  # number of batches that are augmented ahead
+augmentation_use_processes = False  # worker processes instead of threads, needs a picklable augmentation_function
 
 # Rarely changed settings
 use_data_fraction = False
@@ -55,3 +66,5 @@ schedule_gradient_threshold = 0.00001  # When the gradient of the learning curve
 
 train_eval_frequency = 200
 val_eval_frequency = 100
+profile_log_frequency = 100  # steps between the logs of the time per training phase (step_profiler.py), 0 = off
+trace_frequency = 0  # >0: Chrome trace timelines of the session runs every trace_frequency steps (log_dir/timelines)
@@ -39,6 +39,12 @@ diff_threshold = 1  # maximum absolute value for visualization of difference bet
 batch_size = 20
 num_val_batches = 5 # of batches used for validation. Validation happens with a set of size batch_size*num_val_batches
 learning_rate = 1e-4
+sampling_block_size = None  # shuffle in blocks of neighbouring images for faster HDF5 reads, None shuffles globally
+use_tf_data_pipeline = False  # read the training batches with a tf.data pipeline instead of feeding them
+pipeline_parallel_reads = 4  # number of batches read in parallel by the tf.data pipeline
+pipeline_prefetch_batches = 2
+max_bulk_read_megabytes = 1024  # memory cap of the bulk read of the batches of all critic iterations of a step
+fuse_critic_iterations = False  # run all critic iterations of a step in one session call, requires use_tf_data_pipeline
 optimizer_handle = tf.train.AdamOptimizer
 
 # Improved training settings
@@ -61,4 +67,6 @@ max_iterations = 100000
 save_frequency = 200
 validation_frequency = 100
 update_tensorboard_frequency = 10
+profile_log_frequency = 100  # steps between the logs of the time per training phase (step_profiler.py), 0 = off
+trace_frequency = 0  # >0: Chrome trace timelines of the session runs every trace_frequency steps (log_dir/timelines)
 max_epochs = 20000
@@ -1,3 +1,5 @@
+import functools
+
 import model_zoo
 import config.system as sys_config
 import tensorflow as tf
@@ -10,7 +12,8 @@ experiment_name = 'joint_genval_gan_residual_gen_n8b4_disc_n8_dropout_keep0.9_10
 log_folder = 'joint/final'
 
 # Model settings
-clf_model_handle = model_zoo.FCN_multitask_ordinal_bn
+recompute_activations = False  # recompute the activations in the backward pass to save memory (gradient checkpointing)
+clf_model_handle = functools.partial(model_zoo.FCN_multitask_ordinal_bn, recompute=recompute_activations)
 multi_task_model = True
 
 # Data settings
@@ -47,7 +50,14 @@ weight_decay = 0.0  # 5e-4  #0.00000
 # Training settings
 age_ordinal_regression = True
 batch_size = 6
-n_accum_batches = 1  # currently not implemented
+n_accum_batches = 1  # accumulate the gradients of all updates over multiple batches (effective batch size n_accum_batches*batch_size)
+sampling_block_size = None  # shuffle in blocks of neighbouring images for faster HDF5 reads, None shuffles globally
+use_tf_data_pipeline = False  # read the training batches with a tf.data pipeline instead of feeding them
+pipeline_parallel_reads = 4  # number of batches read in parallel by the tf.data pipeline
+pipeline_prefetch_batches = 2
+max_bulk_read_megabytes = 1024  # memory cap of the bulk read of the batches of all critic iterations of a step
+fuse_critic_iterations = False  # run the critic-only iterations of a step in one session call, requires use_tf_data_pipeline
+sampling_strata_mode = None  # 'balanced' or 'proportional' stratifies the training batches by diagnosis, None doesnt
 learning_rate_clf = 1e-4
 optimizer_handle = tf.train.AdamOptimizer
 schedule_lr = False
@@ -58,6 +68,11 @@ bn_momentum = 0.99
 # Augmentation settings
 use_augmentation = False
 augmentation_function = None
+use_graph_augmentation = False  # augment the training batches in the graph (tfwrapper/augmentation.py) instead of in python
+do_rotations = False
+do_scaleaug = False
+do_intensityaug = False
+do_fliplr = False
 
 
 # Rarely changed settings
@@ -99,6 +114,8 @@ max_iterations = 100000
 save_frequency = 200
 validation_frequency = 100
 update_tensorboard_frequency = 10
+profile_log_frequency = 100  # steps between the logs of the time per training phase (step_profiler.py), 0 = off
+trace_frequency = 0  # >0: Chrome trace timelines of the session runs every trace_frequency steps (log_dir/timelines)
 
 # Model settings
 batch_normalization = True
@@ -7,6 +7,8 @@
 
 import tensorflow as tf
 import logging
+import threading
+import time
 from tfwrapper import losses
 from math import sqrt
 from importlib.machinery import SourceFileLoader
@@ -25,16 +27,12 @@ def gan_loss(logits_real, logits_fake, l1_img_dist, w_reg_img_dist_l1, w_reg_gen
     tf.summary.scalar('generator_loss', gen_loss)
 
     gen_weights = [v for v in tf.get_collection('weight_variables') if v.name.startswith('generator')]
-    disc_weights = [v for v in tf.get_collection('weight_variables') if v.name.startswith('discriminator')]
+    disc_weights = discriminator_weights()
 
     with tf.variable_scope('weights_norm') as scope:
 
         # Discriminator regularisation
-        l1_regularizer_disc = tf.contrib.layers.l1_regularizer(scale=w_reg_disc_l1, scope=None)
-        l2_regularizer_disc = tf.contrib.layers.l2_regularizer(scale=w_reg_disc_l2, scope=None)
-        reg_disc_l1 = tf.contrib.layers.apply_regularization(l1_regularizer_disc, disc_weights)
-        reg_disc_l2 = tf.contrib.layers.apply_regularization(l2_regularizer_disc, disc_weights)
-        reg_disc = reg_disc_l1 + reg_disc_l2
+        reg_disc = discriminator_regularization(disc_weights, w_reg_disc_l1, w_reg_disc_l2)
 
         # Generator regularisation
         l1_regularizer_gen = tf.contrib.layers.l1_regularizer(scale=w_reg_gen_l1, scope=None)
@@ -67,15 +65,49 @@ def gan_loss(logits_real, logits_fake, l1_img_dist, w_reg_img_dist_l1, w_reg_gen
     return total_disc_loss, total_gen_loss, disc_loss, gen_loss
 
 
-def train_step(loss_val, var_list, optimizer_handle, learning_rate):
+def discriminator_weights():
+    # weights of the discriminator layers that are regularized
+    return [v for v in tf.get_collection('weight_variables') if v.name.startswith('discriminator')]
 
+
+def discriminator_regularization(disc_weights, w_reg_disc_l1, w_reg_disc_l2):
+    l1_regularizer_disc = tf.contrib.layers.l1_regularizer(scale=w_reg_disc_l1, scope=None)
+    l2_regularizer_disc = tf.contrib.layers.l2_regularizer(scale=w_reg_disc_l2, scope=None)
+    reg_disc_l1 = tf.contrib.layers.apply_regularization(l1_regularizer_disc, disc_weights)
+    reg_disc_l2 = tf.contrib.layers.apply_regularization(l2_regularizer_disc, disc_weights)
+    return reg_disc_l1 + reg_disc_l2
+
+
+def critic_loss(logits_real, logits_fake, disc_weights, w_reg_disc_l1=2.5e-5, w_reg_disc_l2=0.0, d_hat=None,
+                x_hat=None, scale=10.0):
+    '''
+    discriminator loss of gan_loss and training_ops (with regularization and the gradient penalty of the improved
+    training) without summaries, e.g. for the body of fused_critic_op
+    :param disc_weights: regularized weights (discriminator_weights() of the graph before the loop)
+    '''
+    disc_loss = tf.reduce_mean(logits_real) - tf.reduce_mean(logits_fake)
+    disc_loss += discriminator_regularization(disc_weights, w_reg_disc_l1, w_reg_disc_l2)
+    if d_hat is not None and x_hat is not None:
+        disc_loss += improved_training_regularization(d_hat, x_hat, scale)
+    return disc_loss
+
+
+def make_optimizer(optimizer_handle, learning_rate):
+    if optimizer_handle == tf.train.AdamOptimizer:
+        return optimizer_handle(learning_rate=learning_rate, beta1=0.5, beta2=0.9)
+    return optimizer_handle(learning_rate=learning_rate)
+
+
+def train_step(loss_val, var_list, optimizer_handle, learning_rate, optimizer=None):
+    '''
+    :param optimizer: optimizer instance to use (e.g. to share its slots with fused_critic_op), created with
+    optimizer_handle and learning_rate if None
+    '''
     # The with statement is needed to make sure batch norm properly performs its updates
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     with tf.control_dependencies(update_ops):
-        if optimizer_handle == tf.train.AdamOptimizer:
-            optimizer = optimizer_handle(learning_rate=learning_rate, beta1=0.5, beta2=0.9)
-        else:
-            optimizer = optimizer_handle(learning_rate=learning_rate)
+        if optimizer is None:
+            optimizer = make_optimizer(optimizer_handle, learning_rate)
 
         train_op = optimizer.minimize(loss_val, var_list=var_list)
 
@@ -97,6 +129,80 @@ def clip_op():
 
     return d_clip_op
 
+def accumulated_train_step(loss_val, var_list, optimizer, n_accum_batches, name='gradient_accumulation'):
+    '''
+    train_step with the gradients accumulated over n_accum_batches micro batches of the same size, so the effective
+    batch size is n_accum_batches times the batch size of the graph. Every loss term (including the gradient penalty)
+    is computed on the micro batch that is fed, and the update uses the mean of the micro batch gradients.
+    The accumulators are local variables (not saved in the checkpoints) and have to be initialized with
+    tf.local_variables_initializer().
+    :return: accum_op (adds the gradients of the fed micro batch, runs the batch norm updates) and train_op (applies
+    the mean of the accumulated gradients and resets the accumulators)
+    '''
+    # The with statement is needed to make sure batch norm properly performs its updates
+    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    with tf.control_dependencies(update_ops):
+        grads_vars = [(grad, var) for grad, var in optimizer.compute_gradients(loss_val, var_list=var_list)
+                      if grad is not None]
+
+    with tf.variable_scope(name):
+        accum_vars = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES], name=var.op.name.replace('/', '_'))
+                      for _, var in grads_vars]
+
+        accum_op = tf.group(*[accum_var.assign_add(grad) for accum_var, (grad, _) in zip(accum_vars, grads_vars)])
+
+        apply_op = optimizer.apply_gradients([(accum_var / float(n_accum_batches), var)
+                                              for accum_var, (_, var) in zip(accum_vars, grads_vars)])
+        with tf.control_dependencies([apply_op]):
+            train_op = tf.group(*[accum_var.assign(tf.zeros_like(accum_var)) for accum_var in accum_vars])
+
+    return accum_op, train_op
+
+
+def fused_critic_op(critic_loss_function, optimizer, n_iterations, clip_weights=False):
+    '''
+    Runs n_iterations critic updates in one session call with a tf.while_loop. Every iteration builds the critic loss
+    with critic_loss_function, which has to read its own batch (e.g. from a tf.data iterator with get_next) and call
+    the networks with scope_reuse=True, since tensors computed outside of the loop have the same value in every
+    iteration. The batch norm updates of the iteration run before the update and the weight clipping of the plain
+    WGAN runs after it (control dependencies), so one iteration equals a sess.run of the discriminator train op
+    followed by a sess.run of clip_op.
+    :param critic_loss_function: function without arguments that builds the discriminator loss of one iteration
+    :param optimizer: optimizer of the discriminator train op (its slots must exist already, see train_step)
+    :param n_iterations: int32 scalar tensor (e.g. placeholder) with the number of iterations of a call
+    :param clip_weights: clip the discriminator weights after every update (WGAN without improved training)
+    :return: op that runs the iterations (returns the number of iterations)
+    '''
+    graph = tf.get_default_graph()
+    discriminator_variables = [v for v in tf.trainable_variables() if v.name.startswith("discriminator")]
+
+    def body(iteration):
+        collection_sizes = {key: len(graph.get_collection(key)) for key in graph.get_all_collection_keys()}
+        loss = critic_loss_function()
+
+        # The with statement is needed to make sure batch norm properly performs its updates
+        update_ops = graph.get_collection(tf.GraphKeys.UPDATE_OPS)[collection_sizes.get(tf.GraphKeys.UPDATE_OPS, 0):]
+        with tf.control_dependencies(update_ops):
+            train_op = optimizer.minimize(loss, var_list=discriminator_variables)
+        dependencies = [train_op]
+        if clip_weights:
+            with tf.control_dependencies([train_op]):
+                dependencies = clip_op()
+
+        # summaries, weight lists and batch norm updates added by the networks in the loop can't be used outside of it
+        for key in graph.get_all_collection_keys():
+            if key not in (tf.GraphKeys.WHILE_CONTEXT, tf.GraphKeys.COND_CONTEXT):
+                del graph.get_collection_ref(key)[collection_sizes.get(key, 0):]
+
+        with tf.control_dependencies(dependencies):
+            return iteration + 1
+
+    with tf.name_scope('fused_critic'):
+        return tf.while_loop(lambda iteration: iteration < n_iterations, body, [tf.constant(0)],
+                             parallel_iterations=1, back_prop=False)
+
+
 def improved_training_regularization(d_hat, x_hat, scale):
     ddx = tf.gradients(d_hat, x_hat)[0]
     ddx = tf.sqrt(tf.reduce_sum(tf.square(ddx), axis=1))
@@ -115,7 +221,8 @@ def training_ops(logits_real,
                  w_reg_disc_l2=0.0,
                  d_hat=None,
                  x_hat=None,
-                 scale=10.0):
+                 scale=10.0,
+                 discriminator_optimizer=None):
 
     train_variables = tf.trainable_variables()
 
@@ -147,7 +254,8 @@ def training_ops(logits_real,
 
 
     generator_train_op = train_step(gen_loss, generator_variables, optimizer_handle, learning_rate)
-    discriminator_train_op = train_step(discriminator_loss, discriminator_variables, optimizer_handle, learning_rate)
+    discriminator_train_op = train_step(discriminator_loss, discriminator_variables, optimizer_handle, learning_rate,
+                                        optimizer=discriminator_optimizer)
 
     return discriminator_train_op, generator_train_op, discriminator_loss, gen_loss, discriminator_loss_no_reg, gen_loss_no_reg
 
@@ -156,7 +264,8 @@ class Generator:
     def __init__(self, exp_config_path, batch_size=1, scope_name='generator', reuse_variables=False):
         """
         builds the graph of the generator specified in the exp_config_path
-        :param batch_size:
+        :param batch_size: micro batch size of the graph. translate accepts any number of images and translates them
+        in micro batches of this size
         """
         self.build_new_graph(exp_config_path, batch_size=batch_size, scope_name=scope_name, reuse_variables=reuse_variables)
 
@@ -166,7 +275,12 @@ class Generator:
         self.exp_config, _ = utils.load_log_exp_config(experiment_file_path)
         self.log_dir = os.path.join(sys_config.log_root, self.exp_config.log_folder, self.exp_config.experiment_name)
         self.graph = tf.Graph()
+        self.batch_size = batch_size
         self.image_tensor_shape = [batch_size] + list(self.exp_config.image_size) + [self.exp_config.n_channels]
+        # throughput statistics (translate can be called from several threads, e.g. by an AugmentationPool)
+        self.n_translated = 0
+        self.translation_time = 0.0
+        self.statistics_lock = threading.Lock()
         with self.graph.as_default():
             self.training_pl = tf.placeholder(tf.bool, name='training_phase')
             # source image batch
@@ -187,19 +301,61 @@ class Generator:
             self.saver = tf.train.Saver()
 
     def translate(self, input_images, noise_in=None):
-        if not np.array_equal(input_images.shape, self.image_tensor_shape):
+        """
+        translates any number of images in micro batches of the batch size of the graph. The last micro batch is
+        padded if it is incomplete (the generator is in inference mode, so the padding does not change the results).
+        Can be called from several threads at the same time, every call has its own buffers
+        :param input_images: numpy array with shape [N, x, y, z, n_channels]
+        :param noise_in: generator input noise for all images with shape [N, ...] (only if the generator uses noise).
+        Uniform noise in [-1, 1] is used if it is None
+        :return: numpy array with the translated images with shape [N, x, y, z, n_channels]
+        """
+        if not np.array_equal(input_images.shape[1:], self.image_tensor_shape[1:]):
             raise ValueError('expected images with shape %s but got images with shape %s instead'
-                             % (str(self.image_tensor_shape), str(input_images.shape)))
-        feed_dict = {self.input_images_pl: input_images, self.training_pl: False}
+                             % (str([None] + self.image_tensor_shape[1:]), str(input_images.shape)))
+        n_images = input_images.shape[0]
         if self.exp_config.use_generator_input_noise:
+            noise_images_shape = [n_images] + list(self.noise_shape[1:])
             if noise_in is None:
-                noise_in = np.random.uniform(low=-1.0, high=1.0, size=tuple(self.noise_shape))
-            if not np.array_equal(noise_in.shape, self.noise_shape):
+                noise_in = np.random.uniform(low=-1.0, high=1.0, size=tuple(noise_images_shape))
+            if not np.array_equal(noise_in.shape, noise_images_shape):
                 raise ValueError('expected noise with shape %s but got noise with shape %s instead'
-                                 % (str(self.noise_shape), str(noise_in.shape)))
-            feed_dict_noise = {self.noise_in_gen_pl: noise_in}
-            feed_dict.update(feed_dict_noise)
-        return self.session.run(self.generated_images, feed_dict=feed_dict)
+                                 % (str(noise_images_shape), str(noise_in.shape)))
+
+        start_time = time.time()
+        translated_images = np.empty(input_images.shape, dtype=np.float32)
+        for start in range(0, n_images, self.batch_size):
+            stop = min(start + self.batch_size, n_images)
+            n_micro = stop - start
+            if n_micro == self.batch_size:
+                micro_batch = input_images[start:stop, ...]
+            else:
+                micro_batch = np.zeros(self.image_tensor_shape, dtype=np.float32)
+                micro_batch[:n_micro, ...] = input_images[start:stop, ...]
+            feed_dict = {self.input_images_pl: micro_batch, self.training_pl: False}
+            if self.exp_config.use_generator_input_noise:
+                micro_noise = np.zeros(self.noise_shape, dtype=np.float32)
+                micro_noise[:n_micro, ...] = noise_in[start:stop, ...]
+                feed_dict[self.noise_in_gen_pl] = micro_noise
+            translated_images[start:stop, ...] = self.session.run(self.generated_images, feed_dict=feed_dict)[:n_micro, ...]
+
+        with self.statistics_lock:
+            self.translation_time += time.time() - start_time
+            self.n_translated += n_images
+        return translated_images
+
+    def throughput(self):
+        """
+        :return: number of translated images per second and seconds per translated image so far
+        """
+        if self.n_translated == 0 or self.translation_time == 0:
+            return 0.0, 0.0
+        return self.n_translated / self.translation_time, self.translation_time / self.n_translated
+
+    def log_throughput(self):
+        images_per_sec, sec_per_image = self.throughput()
+        logging.info('Generator: %d images translated, %.2f images/s (%.1f ms per image, micro batch size %d)'
+                     % (self.n_translated, images_per_sec, 1000*sec_per_image, self.batch_size))
 
     def restore_variables(self, log_dir=None, file_name='model.ckpt'):
         if log_dir is None:
@@ -208,6 +364,7 @@ class Generator:
         init_checkpoint_path, last_step = utils.get_latest_checkpoint_and_step(log_dir, file_name)
         # Create a session for running Ops on the Graph.
         self.saver.restore(self.session, init_checkpoint_path)
+        return init_checkpoint_path
 
     def initialize_variables(self):
         self.session.run(self.init_op)
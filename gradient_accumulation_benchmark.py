@@ -0,0 +1,106 @@
+# Authors:
+# Jonathan Dietrich
+
+# Throughput comparison of the gradient accumulation schemes of the classifier training with random batches
+# separate: the former scheme with separate runs to average the accumulated gradients and to apply them (which fed the
+#           last image batch again)
+# fused: tfwrapper.gradient_accumulation.GradientAccumulator, one run per batch that applies the gradients in the graph
+#        on every n_accum_batches-th batch
+
+import logging
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import clf_model_multitask as model_mt
+from tfwrapper.gradient_accumulation import GradientAccumulator
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+#######################################################################
+from experiments.adni_clf import allconv_bn as exp_config
+#######################################################################
+
+
+def build_loss():
+    images_pl = tf.placeholder(tf.float32, [exp_config.batch_size] + list(exp_config.image_size) + [1], name='images')
+    diag_pl = tf.placeholder(tf.uint8, [exp_config.batch_size], name='labels')
+    ages_pl = tf.placeholder(tf.uint8, [exp_config.batch_size], name='ages')
+    training_pl = tf.placeholder(tf.bool, shape=[], name='training_time')
+    diag_logits, ages_logits = exp_config.clf_model_handle(images_pl,
+                                                           nlabels=exp_config.nlabels,
+                                                           training=training_pl,
+                                                           n_age_thresholds=len(exp_config.age_bins),
+                                                           bn_momentum=exp_config.bn_momentum)
+    loss = model_mt.loss(diag_logits, ages_logits, diag_pl, ages_pl, nlabels=exp_config.nlabels,
+                         weight_decay=exp_config.weight_decay, diag_weight=exp_config.diag_weight,
+                         age_weight=exp_config.age_weight, use_ordinal_reg=False)[0]
+    return loss, [images_pl, diag_pl, ages_pl, training_pl]
+
+
+def random_feed_dict(placeholders, random_state):
+    images_pl, diag_pl, ages_pl, training_pl = placeholders
+    return {images_pl: random_state.uniform(-1, 1, images_pl.get_shape().as_list()).astype(np.float32),
+            diag_pl: random_state.randint(0, exp_config.nlabels, exp_config.batch_size),
+            ages_pl: random_state.randint(0, len(exp_config.age_bins), exp_config.batch_size),
+            training_pl: True}
+
+
+def run_separate(n_accum_batches, n_batches, random_state):
+    with tf.Graph().as_default():
+        loss, placeholders = build_loss()
+        optimizer = exp_config.optimizer_handle(learning_rate=exp_config.learning_rate)
+        t_vars = tf.trainable_variables()
+        accum_tvars = [tf.Variable(tf.zeros_like(tv.initialized_value()), trainable=False) for tv in t_vars]
+        zero_ops = [tv.assign(tf.zeros_like(tv)) for tv in accum_tvars]
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            batch_grads_vars = optimizer.compute_gradients(loss, t_vars)
+            accum_ops = [accum_tvar.assign_add(grad) for accum_tvar, (grad, _) in zip(accum_tvars, batch_grads_vars)]
+            accum_normaliser_pl = tf.placeholder(dtype=tf.float32, name='accum_normaliser')
+            accum_mean_op = [accum_tvar.assign(tf.divide(accum_tvar, accum_normaliser_pl)) for accum_tvar in accum_tvars]
+            train_op = optimizer.apply_gradients([(accum_tvar, var) for accum_tvar, (_, var)
+                                                  in zip(accum_tvars, batch_grads_vars)])
+        feed_dicts = [random_feed_dict(placeholders, random_state) for _ in range(n_accum_batches)]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # the first accumulation is not timed (warm up of the session)
+            for batch_nr in range(n_batches + n_accum_batches):
+                if batch_nr == n_accum_batches:
+                    start_time = time.time()
+                feed_dict = feed_dicts[batch_nr % n_accum_batches]
+                sess.run([accum_ops, loss], feed_dict=feed_dict)
+                if (batch_nr + 1) % n_accum_batches == 0:
+                    sess.run(accum_mean_op, feed_dict={accum_normaliser_pl: float(n_accum_batches)})
+                    sess.run(train_op, feed_dict=feed_dict)
+                    sess.run(zero_ops)
+            return n_batches / (time.time() - start_time)
+
+
+def run_fused(n_accum_batches, n_batches, random_state):
+    with tf.Graph().as_default():
+        loss, placeholders = build_loss()
+        optimizer = exp_config.optimizer_handle(learning_rate=exp_config.learning_rate)
+        accumulator = GradientAccumulator(optimizer, loss, tf.trainable_variables(), n_accum_batches=n_accum_batches)
+        feed_dicts = [random_feed_dict(placeholders, random_state) for _ in range(n_accum_batches)]
+        with tf.Session() as sess:
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            # the first accumulation is not timed (warm up of the session)
+            for batch_nr in range(n_batches + n_accum_batches):
+                if batch_nr == n_accum_batches:
+                    start_time = time.time()
+                sess.run([accumulator.train_op, loss], feed_dict=feed_dicts[batch_nr % n_accum_batches])
+            return n_batches / (time.time() - start_time)
+
+
+if __name__ == '__main__':
+
+    n_batches = 96  # multiple of all n_accum_batches # <----------------------------------------------------------------
+    n_accum_batches_list = [1, 2, 4]
+    random_state = np.random.RandomState(0)
+
+    for n_accum_batches in n_accum_batches_list:
+        for name, run_function in [('separate', run_separate), ('fused', run_fused)]:
+            batches_per_sec = run_function(n_accum_batches, n_batches, random_state)
+            logging.info('%s accumulation over %d batches: %.2f batches/s (%.1f images/s)'
+                         % (name, n_accum_batches, batches_per_sec, batches_per_sec*exp_config.batch_size))
@@ -0,0 +1,122 @@
+# Authors:
+# Jonathan Dietrich
+
+# fork-safe access to the preprocessed HDF5 files
+# An open h5py.File must not be used by several processes (e.g. forked data loading or evaluation workers).
+# Every process therefore opens its own read-only handle of a file the first time it reads from it. The handles are
+# kept per process id and closed when the process exits. ForkSafeFile and ForkSafeDataset can be used like
+# h5py.File and h5py.Dataset and always read through the handle of the current process.
+
+import atexit
+import logging
+import os
+
+import numpy as np
+import h5py
+
+# open read-only handles {(process id, absolute file path): h5py.File}
+_handles = {}
+
+
+def get_handle(data_file_path):
+    '''
+    Returns the read-only handle of the file for the current process, which is opened the first time
+    :param data_file_path: path of the HDF5 file
+    :return: h5py.File
+    '''
+    key = (os.getpid(), os.path.abspath(data_file_path))
+    if key not in _handles:
+        _handles[key] = h5py.File(data_file_path, 'r')
+    return _handles[key]
+
+
+def close_handles(data_file_path=None):
+    '''
+    Closes the handles of the current process. The handles inherited from the parent process are only forgotten,
+    closing them could affect the parent.
+    :param data_file_path: only close the handle of this file. None closes all handles
+    '''
+    pid = os.getpid()
+    for key in list(_handles.keys()):
+        if data_file_path is not None and key[1] != os.path.abspath(data_file_path):
+            continue
+        handle = _handles.pop(key)
+        if key[0] == pid:
+            try:
+                handle.close()
+            except (ValueError, RuntimeError):
+                logging.warning('Could not close the handle of %s' % key[1])
+
+
+atexit.register(close_handles)
+
+
+class ForkSafeDataset(object):
+    '''
+    Dataset of a ForkSafeFile. Shape and dtype are known without reading, every read goes through the handle of the
+    current process (see get_handle).
+    '''
+    def __init__(self, data_file_path, name):
+        self.filename = data_file_path
+        self.name = name
+        dataset = self.dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+
+    @property
+    def dataset(self):
+        return get_handle(self.filename)[self.name]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, selection):
+        return self.dataset[selection]
+
+    def __iter__(self):
+        return iter(self.dataset)
+
+    def __array__(self, dtype=None):
+        array = self.dataset[()]
+        return array if dtype is None else array.astype(dtype)
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        self.dataset.read_direct(dest, source_sel=source_sel, dest_sel=dest_sel)
+
+    def __getattr__(self, name):
+        # other attributes of h5py.Dataset (e.g. chunks, attrs)
+        if name.startswith('__') or name in ('filename', 'name'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+class ForkSafeFile(object):
+    '''
+    Read-only HDF5 file that can be passed to forked processes. Can be used instead of the h5py.File returned by
+    adni_data_loader_all.load_and_maybe_process_data, indexing with a dataset name returns a ForkSafeDataset.
+    '''
+    def __init__(self, data_file_path):
+        self.filename = data_file_path
+        self.datasets = {}
+
+    def __getitem__(self, name):
+        if name not in self.datasets:
+            self.datasets[name] = ForkSafeDataset(self.filename, name)
+        return self.datasets[name]
+
+    def __contains__(self, name):
+        return name in get_handle(self.filename)
+
+    def keys(self):
+        return list(get_handle(self.filename).keys())
+
+    def close(self):
+        close_handles(self.filename)
@@ -0,0 +1,119 @@
+# Authors:
+# Jonathan Dietrich
+
+# Quantile mapping between the intensity distributions of the field strengths, a non-learned baseline for the GAN
+# The quantiles of the foreground intensities of the source and the target domain are estimated on the training split,
+# they give the mappings in both directions (e.g. 1.5 T to 3 T and 3 T to 1.5 T).
+# An image is translated by mapping every quantile of its domain to the quantile of the other domain with the same rank
+# (piecewise linear between the quantiles), which is one vectorised pass over the batch.
+
+import logging
+import time
+
+import numpy as np
+
+from batch_generator_list import read_images_into
+from metadata_index import get_metadata_index
+
+
+def sample_foreground_intensities(images, indices, n_samples_per_image=20000, batch_size=8, random_state=np.random):
+    '''
+    Random sample of the foreground intensities of the images. The background is the minimum value of every image
+    (skull stripped images).
+    :param images: hdf5 dataset or numpy array with shape [N, x, y, z]
+    :param indices: indices of the images (increasing)
+    :return: 1D numpy array with the sampled intensities
+    '''
+    samples = []
+    batch = np.empty([batch_size] + list(images.shape[1:]) + [1], dtype=np.float32)
+    for start in range(0, len(indices), batch_size):
+        batch_indices = indices[start:start + batch_size]
+        X = read_images_into(images, batch_indices, batch[:len(batch_indices)])
+        X = X.reshape([len(batch_indices), -1])
+        foreground = X > X.min(axis=1, keepdims=True)
+        for image, image_foreground in zip(X, foreground):
+            image_foreground_values = image[image_foreground]
+            if image_foreground_values.size == 0:
+                continue
+            # drawn with replacement, a sample without replacement would permute the whole foreground of the volume
+            positions = random_state.randint(0, image_foreground_values.size, n_samples_per_image)
+            samples.append(image_foreground_values[positions])
+    return np.concatenate(samples)
+
+
+class QuantileMappingTranslator(object):
+    '''
+    Translates images from one field strength to the other with the quantiles of the foreground intensities.
+    Has the same translate interface as gan_model.Generator, so it can be used instead of a GAN (e.g. in
+    generator_augment or clf_GAN_test).
+    '''
+    def __init__(self, source_quantiles, target_quantiles):
+        # quantiles with the same value in the source domain (e.g. saturated intensities) are merged
+        self.source_quantiles, unique_positions = np.unique(np.asarray(source_quantiles, dtype=np.float32),
+                                                            return_index=True)
+        self.target_quantiles = np.asarray(target_quantiles, dtype=np.float32)[unique_positions]
+        # throughput statistics
+        self.n_translated = 0
+        self.translation_time = 0.0
+
+    def translate(self, input_images, noise_in=None):
+        '''
+        :param input_images: numpy array with shape [N, x, y, z, 1]
+        :param noise_in: not used, for compatibility with gan_model.Generator
+        :return: translated images with the same shape. The background (minimum of every image) is not changed
+        '''
+        start_time = time.time()
+        n_images = input_images.shape[0]
+        flat_images = input_images.reshape([n_images, -1])
+        background = flat_images <= flat_images.min(axis=1, keepdims=True)
+        translated_images = np.interp(flat_images, self.source_quantiles, self.target_quantiles).astype(np.float32)
+        translated_images[background] = flat_images[background]
+
+        self.translation_time += time.time() - start_time
+        self.n_translated += n_images
+        return translated_images.reshape(input_images.shape)
+
+    def throughput(self):
+        '''
+        :return: number of translated images per second and seconds per translated image so far
+        '''
+        if self.n_translated == 0 or self.translation_time == 0:
+            return 0.0, 0.0
+        return self.n_translated / self.translation_time, self.translation_time / self.n_translated
+
+    def log_throughput(self):
+        images_per_sec, sec_per_image = self.throughput()
+        logging.info('Quantile mapping: %d images translated, %.2f images/s (%.1f ms per image)'
+                     % (self.n_translated, images_per_sec, 1000*sec_per_image))
+
+    def save(self, path):
+        np.savez(path, source_quantiles=self.source_quantiles, target_quantiles=self.target_quantiles)
+
+    @classmethod
+    def load(cls, path):
+        quantiles = np.load(path)
+        return cls(quantiles['source_quantiles'], quantiles['target_quantiles'])
+
+
+def fit_quantile_mapping(data, source_field_strength, target_field_strength, split='train', n_quantiles=1000,
+                         n_samples_per_image=20000, seed=0):
+    '''
+    Estimates the quantile mappings between the source and the target field strength on a split of the preprocessed data
+    :param data: h5py file (or ForkSafeFile, SharedDataset) of the preprocessed data
+    :param n_quantiles: number of quantiles of the mappings
+    :param n_samples_per_image: number of foreground voxels per image used for the quantiles
+    :return: QuantileMappingTranslators from the source to the target and from the target to the source field strength
+    '''
+    random_state = np.random.RandomState(seed)
+    images = data['images_%s' % split]
+    source_indices, target_indices = get_metadata_index(data).domain_indices(split, source_field_strength,
+                                                                             target_field_strength)
+    ranks = np.linspace(0, 1, n_quantiles)
+    quantiles = []
+    for indices in [source_indices, target_indices]:
+        intensities = sample_foreground_intensities(images, indices, n_samples_per_image=n_samples_per_image,
+                                                    random_state=random_state)
+        quantiles.append(np.percentile(intensities, 100*ranks))  # np.quantile needs numpy >= 1.15
+    logging.info('Fitted the quantile mappings between %.1f T and %.1f T on %d + %d %s images'
+                 % (source_field_strength, target_field_strength, len(source_indices), len(target_indices), split))
+    return QuantileMappingTranslator(quantiles[0], quantiles[1]), QuantileMappingTranslator(quantiles[1], quantiles[0])
@@ -0,0 +1,185 @@
+# Authors:
+# Jonathan Dietrich
+
+# tf.data input pipeline that reads the minibatches in parallel and consumes them in the graph instead of feeding them
+
+import collections
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from batch_generator_list import read_images_into, read_labels, read_paired_batch, epoch_batch_indices
+from batch_sampler import sampler_states
+from label_encodings import labels_to_standard_range
+
+
+class SamplerStateHistory(object):
+    '''
+    States of the index samplers before every batch the pipeline draws.
+    The indices are drawn ahead of the training (parallel reads and prefetching), so the current states of the samplers
+    are ahead of the batches that were trained on. The state before the first batch that was not consumed yet is the
+    point to continue from, it is saved with the checkpoints instead of the current states.
+    '''
+    def __init__(self, samplers):
+        '''
+        :param samplers: dict with names and StratifiedSamplers (as for batch_sampler.save_sampler_states)
+        '''
+        self.samplers = samplers
+        self.states = collections.deque()
+        self.lock = threading.Lock()
+
+    def record(self):
+        # called by the index generator of the pipeline before it draws a batch
+        with self.lock:
+            self.states.append(sampler_states(self.samplers))
+
+    def consumed(self, n_batches=1):
+        with self.lock:
+            for _ in range(n_batches):
+                self.states.popleft()
+
+    def resume_states(self):
+        '''
+        :return: dict with the names and the states of the samplers after the consumed batches
+        '''
+        with self.lock:
+            if self.states:
+                return self.states[0]
+            # no batch is in flight, the generator does not draw while the lock is held
+            return sampler_states(self.samplers)
+
+
+class PipelineInput(object):
+    '''
+    Consumes a tf.data dataset of batches directly in the graph.
+    The graph reads the batch from self.tensors, which are placeholders with the next element of the dataset as
+    default value. Every sess.run that evaluates them without feeding them takes the next batch, all fetches of the run
+    see the same batch. So every training run consumes one batch and needs no extra session call for the input.
+    The batches are read by tf.py_func in the threads of the dataset (one copy from python into the tensors), they are
+    not fed.
+    Feeding self.tensors still works as before (no batch is taken then), which is used for the evaluation.
+    '''
+    def __init__(self, dataset, names, batches_per_epoch=None, sampler_history=None):
+        '''
+        :param batches_per_epoch: number of batches of a dataset of one epoch (for iterate_batches)
+        :param sampler_history: SamplerStateHistory of the index generator of the dataset
+        '''
+        self.iterator = dataset.make_initializable_iterator()
+        next_batch = self.iterator.get_next()
+        self.tensors = [tf.placeholder_with_default(batch_tensor, batch_tensor.get_shape(), name=name)
+                        for name, batch_tensor in zip(names, next_batch)]
+        self.initializer = self.iterator.initializer
+        self.batches_per_epoch = batches_per_epoch
+        self.sampler_history = sampler_history
+
+    def iterate_batches(self, sess):
+        '''
+        Restarts the dataset (e.g. a new epoch). The training run after every yield consumes one batch
+        :param sess: session
+        :return: yields None batches_per_epoch times
+        '''
+        sess.run(self.iterator.initializer)
+        for _ in range(self.batches_per_epoch):
+            yield None
+
+    def consumed(self, n_batches=1):
+        '''
+        Has to be called for every batch the training runs take from the dataset (e.g. d_iters for the fused critic op)
+        '''
+        if self.sampler_history is not None:
+            self.sampler_history.consumed(n_batches)
+
+    def sampler_states(self):
+        '''
+        :return: states of the samplers after the consumed batches (to save with a checkpoint)
+        '''
+        return self.sampler_history.resume_states()
+
+
+def _batch_dataset(index_generator, read_function, output_types, output_shapes, num_parallel_calls, prefetch_batches):
+    # the indices are drawn sequentially in python, the batches are read in num_parallel_calls threads
+    dataset = tf.data.Dataset.from_generator(index_generator, tf.int64, tf.TensorShape([None]))
+    dataset = dataset.map(lambda indices: tuple(tf.py_func(read_function, [indices], output_types, stateful=True)),
+                          num_parallel_calls=num_parallel_calls)
+    dataset = dataset.map(lambda *batch: tuple(tf.reshape(tensor, shape) for tensor, shape in zip(batch, output_shapes)))
+    return dataset.prefetch(prefetch_batches)
+
+
+def paired_dataset(images, source_batch_size, target_batch_size, exp_config, source_sampler, target_sampler,
+                   labels_list=None, label_dtypes=None, augmentation_function=None, map_labels_to_standard_range=True,
+                   num_parallel_calls=4, prefetch_batches=2, sampler_history=None):
+    '''
+    Endless dataset of source and target batches, the tf.data version of iterate_paired_minibatches_endlessly.
+    The samplers are ahead of the training by the batches that are being read and prefetched.
+    :param label_dtypes: numpy dtypes of the labels in labels_list (the dtypes of the placeholders)
+    :param sampler_history: SamplerStateHistory of the samplers that records their state before every batch
+    :return: tf.data dataset with elements (x_s, x_t) or (x_s, *labels_s, x_t, *labels_t)
+    '''
+    image_shape = list(exp_config.image_size) + [1]
+    label_dtypes = [] if label_dtypes is None else label_dtypes
+
+    def index_generator():
+        while True:
+            if sampler_history is not None:
+                sampler_history.record()
+            yield np.concatenate((source_sampler.next_indices(source_batch_size),
+                                  target_sampler.next_indices(target_batch_size)))
+
+    def read_function(indices):
+        X_s, y_list_s, X_t, y_list_t = read_paired_batch(images, indices[:source_batch_size],
+                                                         indices[source_batch_size:], exp_config,
+                                                         labels_list=labels_list,
+                                                         map_labels_to_standard_range=map_labels_to_standard_range)
+        if labels_list is None:
+            if augmentation_function:
+                X_s = augmentation_function(X_s, do_fliplr=exp_config.do_fliplr)
+                X_t = augmentation_function(X_t, do_fliplr=exp_config.do_fliplr)
+            return [X_s, X_t]
+        if augmentation_function:
+            X_s, y_list_s = augmentation_function(X_s, y_list_s, do_fliplr=exp_config.do_fliplr)
+            X_t, y_list_t = augmentation_function(X_t, y_list_t, do_fliplr=exp_config.do_fliplr)
+        y_list_s = [np.asarray(y, dtype=dtype) for y, dtype in zip(y_list_s, label_dtypes)]
+        y_list_t = [np.asarray(y, dtype=dtype) for y, dtype in zip(y_list_t, label_dtypes)]
+        return [X_s] + y_list_s + [X_t] + y_list_t
+
+    label_shapes = [] if labels_list is None else [list(y_ll.shape[1:]) for y_ll in labels_list]
+    output_types = [tf.float32] + [tf.as_dtype(dtype) for dtype in label_dtypes]
+    output_types = output_types + output_types
+    output_shapes = [[source_batch_size] + image_shape] + [[source_batch_size] + shape for shape in label_shapes] \
+                    + [[target_batch_size] + image_shape] + [[target_batch_size] + shape for shape in label_shapes]
+
+    return _batch_dataset(index_generator, read_function, output_types, output_shapes, num_parallel_calls,
+                          prefetch_batches)
+
+
+def epoch_dataset(images, labels_list, batch_size, exp_config, label_dtypes, selection_indices=None,
+                  augmentation_function=None, map_labels_to_standard_range=True, block_size=None, num_parallel_calls=4,
+                  prefetch_batches=2):
+    '''
+    Dataset of the batches of one epoch, the tf.data version of iterate_minibatches (incomplete last batch skipped).
+    Every initialization of the iterator starts a new, newly shuffled epoch.
+    :param label_dtypes: numpy dtypes of the labels in labels_list (the dtypes of the placeholders)
+    :return: tf.data dataset with elements (x, *labels)
+    '''
+    image_shape = list(exp_config.image_size) + [1]
+
+    def index_generator():
+        return epoch_batch_indices(images.shape[0], batch_size, selection_indices=selection_indices,
+                                   block_size=block_size)
+
+    def read_function(batch_indices):
+        X = read_images_into(images, batch_indices, np.empty([len(batch_indices)] + image_shape, dtype=np.float32))
+        y_list = [read_labels(y_ll, batch_indices) for y_ll in labels_list]
+        if map_labels_to_standard_range:
+            # This puts the labels in a range from 0 to nlabels.
+            y_list[0] = labels_to_standard_range(y_list[0], exp_config.label_list)
+        if augmentation_function:
+            X, y_list = augmentation_function(X, y_list)
+        return [X] + [np.asarray(y, dtype=dtype) for y, dtype in zip(y_list, label_dtypes)]
+
+    output_types = [tf.float32] + [tf.as_dtype(dtype) for dtype in label_dtypes]
+    output_shapes = [[batch_size] + image_shape] + [[batch_size] + list(y_ll.shape[1:]) for y_ll in labels_list]
+
+    return _batch_dataset(index_generator, read_function, output_types, output_shapes, num_parallel_calls,
+                          prefetch_batches)
@@ -0,0 +1,108 @@
+# Authors:
+# Jonathan Dietrich
+
+# Throughput comparison of the feed_dict input path and the tf.data input pipeline (see input_pipeline.py).
+# Both read paired source/target batches from the preprocessed data like train_gan. The consumer is either only the
+# mean of the batches (pure input throughput) or the discriminator of the GAN experiment (input overlapped with compute).
+
+import logging
+import time
+
+import tensorflow as tf
+
+import adni_data_loader_all
+import data_utils
+import input_pipeline
+from batch_generator_list import iterate_paired_minibatches_endlessly
+from batch_sampler import StratifiedSampler
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+#######################################################################
+from experiments.gan import bousmalis_bn as exp_config
+#######################################################################
+
+
+def consumer_op(x_s, x_t, use_discriminator):
+    if use_discriminator:
+        training = tf.constant(True)
+        return [exp_config.discriminator(x_s, training, scope_reuse=False),
+                exp_config.discriminator(x_t, training, scope_reuse=True)]
+    return [tf.reduce_mean(x_s), tf.reduce_mean(x_t)]
+
+
+def run_feed_dict(images, source_ind, target_ind, n_steps, use_discriminator):
+    sampler_train = iterate_paired_minibatches_endlessly(images,
+                                                         source_batch_size=exp_config.batch_size,
+                                                         target_batch_size=exp_config.batch_size,
+                                                         exp_config=exp_config,
+                                                         source_sampler=StratifiedSampler(source_ind),
+                                                         target_sampler=StratifiedSampler(target_ind))
+    with tf.Graph().as_default():
+        image_shape = [exp_config.batch_size] + list(exp_config.image_size) + [exp_config.n_channels]
+        xs_pl = tf.placeholder(tf.float32, image_shape, name='x_source')
+        xt_pl = tf.placeholder(tf.float32, image_shape, name='x_target')
+        op = consumer_op(xs_pl, xt_pl, use_discriminator)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            start_time = time.time()
+            for _ in range(n_steps):
+                x_s, x_t = next(sampler_train)
+                sess.run(op, feed_dict={xs_pl: x_s, xt_pl: x_t})
+            return n_steps / (time.time() - start_time)
+
+
+def run_tf_data(images, source_ind, target_ind, n_steps, use_discriminator, num_parallel_calls, prefetch_batches):
+    with tf.Graph().as_default():
+        dataset = input_pipeline.paired_dataset(images,
+                                                source_batch_size=exp_config.batch_size,
+                                                target_batch_size=exp_config.batch_size,
+                                                exp_config=exp_config,
+                                                source_sampler=StratifiedSampler(source_ind),
+                                                target_sampler=StratifiedSampler(target_ind),
+                                                num_parallel_calls=num_parallel_calls,
+                                                prefetch_batches=prefetch_batches)
+        train_input = input_pipeline.PipelineInput(dataset, names=['x_source', 'x_target'])
+        op = consumer_op(train_input.tensors[0], train_input.tensors[1], use_discriminator)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(train_input.initializer)
+            # fill the prefetch buffer before measuring
+            sess.run(op)
+            start_time = time.time()
+            for _ in range(n_steps):
+                # every run takes the next batch of the pipeline
+                sess.run(op)
+            return n_steps / (time.time() - start_time)
+
+
+if __name__ == '__main__':
+
+    n_steps = 200
+    use_discriminator = False  # <--------------------------------------------------------------------------------------
+    parallel_calls_list = [1, 2, 4, 8]
+    prefetch_batches = 2
+
+    data = adni_data_loader_all.load_and_maybe_process_data(
+        input_folder=exp_config.data_root,
+        preprocessing_folder=exp_config.preproc_folder,
+        size=exp_config.image_size,
+        target_resolution=exp_config.target_resolution,
+        label_list=exp_config.label_list,
+        offset=exp_config.offset,
+        rescale_to_one=exp_config.rescale_to_one,
+        force_overwrite=False
+    )
+    images_train, source_images_train_ind, target_images_train_ind, _, _, _ = \
+        data_utils.get_images_and_fieldstrength_indices(data, exp_config.source_field_strength,
+                                                        exp_config.target_field_strength)
+
+    steps_per_sec = run_feed_dict(images_train, source_images_train_ind, target_images_train_ind, n_steps,
+                                  use_discriminator)
+    logging.info('feed_dict: %.2f steps/s (%.1f images/s)' % (steps_per_sec, steps_per_sec*2*exp_config.batch_size))
+
+    for num_parallel_calls in parallel_calls_list:
+        steps_per_sec = run_tf_data(images_train, source_images_train_ind, target_images_train_ind, n_steps,
+                                    use_discriminator, num_parallel_calls, prefetch_batches)
+        logging.info('tf.data with %d parallel reads: %.2f steps/s (%.1f images/s)'
+                     % (num_parallel_calls, steps_per_sec, steps_per_sec*2*exp_config.batch_size))
@@ -26,7 +26,14 @@ def training_ops(logits_real,
                  w_reg_disc_l2=0.0,
                  d_hat=None,
                  x_hat=None,
-                 scale=10.0):
+                 scale=10.0,
+                 discriminator_optimizer=None,
+                 n_accum_batches=1):
+    '''
+    :param n_accum_batches: number of micro batches the gradients are accumulated over. If it is larger than 1,
+    train_ops additionally contains the accumulation ops 'gen_accum', 'disc_accum' and 'clf_accum', which have to be
+    run for every micro batch before train_ops 'gen', 'disc' and 'clf' apply the mean gradients
+    '''
 
     inner_dict = {'nr': None, 'reg': None}
     losses = {network: inner_dict.copy() for network in ['disc', 'gen']}
@@ -66,8 +73,22 @@ def training_ops(logits_real,
         print(v.name)
 
     train_ops = {}
-    train_ops['gen'] = gan_model.train_step(losses['gen']['joint'], generator_variables, optimizer_handle, learning_rate_gan)
-    train_ops['disc'] = gan_model.train_step(losses['disc']['joint'], discriminator_variables, optimizer_handle, learning_rate_gan)
-    train_ops['clf'] = gan_model.train_step(classifier_loss, classifier_variables, optimizer_handle, learning_rate_clf)
+    if n_accum_batches == 1:
+        train_ops['gen'] = gan_model.train_step(losses['gen']['joint'], generator_variables, optimizer_handle, learning_rate_gan)
+        train_ops['disc'] = gan_model.train_step(losses['disc']['joint'], discriminator_variables, optimizer_handle, learning_rate_gan,
+                                                 optimizer=discriminator_optimizer)
+        train_ops['clf'] = gan_model.train_step(classifier_loss, classifier_variables, optimizer_handle, learning_rate_clf)
+    else:
+        if discriminator_optimizer is None:
+            discriminator_optimizer = gan_model.make_optimizer(optimizer_handle, learning_rate_gan)
+        train_ops['gen_accum'], train_ops['gen'] = gan_model.accumulated_train_step(
+            losses['gen']['joint'], generator_variables, gan_model.make_optimizer(optimizer_handle, learning_rate_gan),
+            n_accum_batches, name='accumulation_generator')
+        train_ops['disc_accum'], train_ops['disc'] = gan_model.accumulated_train_step(
+            losses['disc']['joint'], discriminator_variables, discriminator_optimizer,
+            n_accum_batches, name='accumulation_discriminator')
+        train_ops['clf_accum'], train_ops['clf'] = gan_model.accumulated_train_step(
+            classifier_loss, classifier_variables, gan_model.make_optimizer(optimizer_handle, learning_rate_clf),
+            n_accum_batches, name='accumulation_classifier')
 
     return train_ops, losses
@@ -5,6 +5,7 @@
 # train WGAN image-to-image translator and AD classifier jointly
 
 
+import functools
 import logging
 import time
 
@@ -17,10 +18,18 @@ from sklearn.metrics import f1_score
 import config.system as sys_config
 import gan_model
 from tfwrapper import utils as tf_utils
+from tfwrapper import augmentation
 import utils
+import label_encodings
 import adni_data_loader_all
 import data_utils
-from batch_generator_list import iterate_minibatches_endlessly, iterate_minibatches
+from batch_generator_list import iterate_minibatches, iterate_paired_minibatches_endlessly
+import batch_sampler
+from checkpoint_writer import CheckpointWriter
+from step_profiler import StepProfiler
+from resident_eval_set import ResidentEvalSet
+import input_pipeline
+from batch_sampler import StratifiedSampler
 import clf_model_multitask as clf_model_mt
 import joint_model
 
@@ -84,41 +93,68 @@ def run_training(continue_run, log_dir):
         data, exp_config.source_field_strength, exp_config.target_field_strength)
 
     # get labels
-    # the following are HDF5 datasets, not numpy arrays
-    labels_train = data['diagnosis_train']
-    ages_train = data['age_train']
-    labels_val = data['diagnosis_val']
-    ages_val = data['age_val']
+    # the diagnoses are precomputed in the standard range of label_list (see label_encodings), so the batches are not
+    # mapped again
+    labels_train = label_encodings.diagnosis_labels(data, 'train', exp_config.label_list)
+    labels_val = label_encodings.diagnosis_labels(data, 'val', exp_config.label_list)
 
     if exp_config.age_ordinal_regression:
-        ages_train = utils.age_to_ordinal_reg_format(ages_train, bins=exp_config.age_bins)
+        ages_train = label_encodings.age_labels(data, 'train', exp_config.age_bins, ordinal_regression=True)
         ordinal_reg_weights = utils.get_ordinal_reg_weights(ages_train)
     else:
-        ages_train = utils.age_to_bins(ages_train, bins=exp_config.age_bins)
+        ages_train = label_encodings.age_labels(data, 'train', exp_config.age_bins, ordinal_regression=False)
         ordinal_reg_weights = None
 
     if exp_config.age_ordinal_regression:
-        ages_val = utils.age_to_ordinal_reg_format(ages_val, bins=exp_config.age_bins)
+        ages_val = label_encodings.age_labels(data, 'val', exp_config.age_bins, ordinal_regression=True)
     else:
-        ages_val= utils.age_to_bins(ages_val, bins=exp_config.age_bins)
+        ages_val = label_encodings.age_labels(data, 'val', exp_config.age_bins, ordinal_regression=False)
+
+    # the validation sets are read once and evaluated in the same order every time.
+    # The classifier is validated on all source images, the GAN on the first num_val_batches source batches of the
+    # classifier set and as many target batches
+    clf_val_set = ResidentEvalSet(images_val, 2*exp_config.batch_size, exp_config, labels_list=[labels_val, ages_val],
+                                  selection_indices=source_images_val_ind, map_labels_to_standard_range=False,
+                                  name='source validation')
+    target_val_set = ResidentEvalSet(images_val, exp_config.batch_size, exp_config,
+                                     selection_indices=target_images_val_ind,
+                                     max_images=exp_config.num_val_batches*exp_config.batch_size,
+                                     name='target validation')
 
     generator = exp_config.generator
     discriminator = exp_config.discriminator
-    augmentation_function = exp_config.augmentation_function if exp_config.use_augmentation else None
-
-    s_sampler_train = iterate_minibatches_endlessly(images_train,
-                                                    batch_size=2*exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    labels_list=[labels_train, ages_train],
-                                                    selection_indices=source_images_train_ind,
-                                                    augmentation_function=augmentation_function)
-
-    t_sampler_train = iterate_minibatches_endlessly(images_train,
-                                                    batch_size=exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    labels_list=[labels_train, ages_train],
-                                                    selection_indices=target_images_train_ind,
-                                                    augmentation_function=augmentation_function)
+    # with use_graph_augmentation the batches are augmented in the graph instead of in python
+    if exp_config.use_augmentation and not exp_config.use_graph_augmentation:
+        augmentation_function = exp_config.augmentation_function
+    else:
+        augmentation_function = None
+
+    # the source and target indices only contain one field strength each, so stratifying them by diagnosis
+    # gives batches stratified by diagnosis x field strength.
+    # The state of the index samplers is saved with the checkpoints to continue with the same data order
+    if exp_config.sampling_strata_mode is None:
+        s_index_sampler = StratifiedSampler(source_images_train_ind, block_size=exp_config.sampling_block_size)
+        t_index_sampler = StratifiedSampler(target_images_train_ind, block_size=exp_config.sampling_block_size)
+    else:
+        s_index_sampler = StratifiedSampler.from_labels(source_images_train_ind, [labels_train],
+                                                        mode=exp_config.sampling_strata_mode,
+                                                        block_size=exp_config.sampling_block_size)
+        t_index_sampler = StratifiedSampler.from_labels(target_images_train_ind, [labels_train],
+                                                        mode=exp_config.sampling_strata_mode,
+                                                        block_size=exp_config.sampling_block_size)
+    index_samplers = {'s': s_index_sampler, 't': t_index_sampler}
+
+    # source batch (twice the batch size) and target batch are read together with one HDF5 read per step
+    st_sampler_train = iterate_paired_minibatches_endlessly(images_train,
+                                                            source_batch_size=2*exp_config.batch_size,
+                                                            target_batch_size=exp_config.batch_size,
+                                                            exp_config=exp_config,
+                                                            source_sampler=s_index_sampler,
+                                                            target_sampler=t_index_sampler,
+                                                            labels_list=[labels_train, ages_train],
+                                                            augmentation_function=augmentation_function,
+                                                            map_labels_to_standard_range=False,
+                                                            max_bulk_megabytes=exp_config.max_bulk_read_megabytes)
 
 
     with tf.Graph().as_default():
@@ -133,17 +169,48 @@ def run_training(continue_run, log_dir):
         else:
             noise_in_gen_pl = None
 
-        # target image batch
-        xt_pl = tf.placeholder(tf.float32, image_tensor_shape(exp_config.batch_size), name='x_target')
-
         # the classifier uses 2 times the batch size of the GAN
         clf_batch_size = 2 * exp_config.batch_size
 
-        # source image batch
-        xs_pl, diag_s_pl, ages_s_pl = placeholders_clf(clf_batch_size, 'source')
+        if exp_config.use_tf_data_pipeline:
+            # the training batches are read by a tf.data pipeline, every training run takes the next batch.
+            # The tensors can still be fed (e.g. for the evaluation)
+            sampler_history = input_pipeline.SamplerStateHistory(index_samplers)
+            train_dataset = input_pipeline.paired_dataset(images_train,
+                                                          source_batch_size=clf_batch_size,
+                                                          target_batch_size=exp_config.batch_size,
+                                                          exp_config=exp_config,
+                                                          source_sampler=s_index_sampler,
+                                                          target_sampler=t_index_sampler,
+                                                          labels_list=[labels_train, ages_train],
+                                                          label_dtypes=[np.uint8, np.uint8],
+                                                          augmentation_function=augmentation_function,
+                                                          map_labels_to_standard_range=False,
+                                                          num_parallel_calls=exp_config.pipeline_parallel_reads,
+                                                          prefetch_batches=exp_config.pipeline_prefetch_batches,
+                                                          sampler_history=sampler_history)
+            train_input = input_pipeline.PipelineInput(train_dataset,
+                                                       names=['x_source', 'diag_source', 'ages_source',
+                                                              'x_target', 'diag_target', 'ages_target'],
+                                                       sampler_history=sampler_history)
+            xs_pl, diag_s_pl, ages_s_pl, xt_pl = train_input.tensors[:4]
+        else:
+            train_input = None
+
+            # target image batch
+            xt_pl = tf.placeholder(tf.float32, image_tensor_shape(exp_config.batch_size), name='x_target')
+
+            # source image batch
+            xs_pl, diag_s_pl, ages_s_pl = placeholders_clf(clf_batch_size, 'source')
+
+        # random augmentation of the training batches in the graph (identity when training_time_placeholder is False).
+        # xs_pl and xt_pl stay the (feedable) inputs of the graph
+        xs_in = augmentation.augment_images_with_config(xs_pl, training_time_placeholder, exp_config)
+        xt_in = augmentation.augment_images_with_config(xt_pl, training_time_placeholder, exp_config)
+
         # split source batch into 1 to be translated to xf and 2 for the classifier
         # for the discriminator train op half 2 of the batch is not used
-        xs1_pl, xs2_pl = tf.split(xs_pl, 2, axis=0)
+        xs1_pl, xs2_pl = tf.split(xs_in, 2, axis=0)
 
         # generated fake image batch
         xf_pl = generator(xs1_pl, noise_in_gen_pl, training_time_placeholder)
@@ -156,7 +223,7 @@ def run_training(continue_run, log_dir):
                                                                           exp_config.cut_index, rescale_mode='manual',
                                                                           input_range=exp_config.image_range))
 
-        tf.summary.image('sample_xt', tf_utils.put_kernels_on_grid3d(xt_pl, exp_config.cut_axis,
+        tf.summary.image('sample_xt', tf_utils.put_kernels_on_grid3d(xt_in, exp_config.cut_axis,
                                                                           exp_config.cut_index, rescale_mode='manual',
                                                                           input_range=exp_config.image_range))
 
@@ -169,7 +236,7 @@ def run_training(continue_run, log_dir):
                                                                           cutoff_abs=exp_config.diff_threshold))
 
         # output of the discriminator for real image
-        d_pl = discriminator(xt_pl, training_time_placeholder, scope_reuse=False)
+        d_pl = discriminator(xt_in, training_time_placeholder, scope_reuse=False)
 
         # output of the discriminator for fake image
         d_pl_ = discriminator(xf_pl, training_time_placeholder, scope_reuse=True)
@@ -179,7 +246,7 @@ def run_training(continue_run, log_dir):
         if exp_config.improved_training:
 
             epsilon = tf.random_uniform([], 0.0, 1.0)
-            x_hat = epsilon * xt_pl + (1 - epsilon) * xf_pl
+            x_hat = epsilon * xt_in + (1 - epsilon) * xf_pl
             d_hat = discriminator(x_hat, training_time_placeholder, scope_reuse=True)
 
         dist_l1 = tf.reduce_mean(tf.abs(diff_img_pl))
@@ -193,6 +260,18 @@ def run_training(continue_run, log_dir):
         else:
             optimizer_handle = lambda learning_rate: exp_config.optimizer_handle(learning_rate=learning_rate)
 
+        # the critic-only iterations of a step run in one session call, reading their batches directly from the pipeline
+        fuse_critic_iterations = exp_config.fuse_critic_iterations and train_input is not None \
+                                 and exp_config.n_accum_batches == 1
+        if exp_config.fuse_critic_iterations and not fuse_critic_iterations:
+            logging.warning('fuse_critic_iterations requires use_tf_data_pipeline and n_accum_batches = 1, '
+                            'running the critic iterations one by one')
+        if fuse_critic_iterations:
+            # shared by the discriminator train op and the fused critic op
+            discriminator_optimizer = gan_model.make_optimizer(optimizer_handle, learning_rate_gan_pl)
+        else:
+            discriminator_optimizer = None
+
         # Build the operation for clipping the discriminator weights
         d_clip_op = gan_model.clip_op()
 
@@ -248,7 +327,42 @@ def run_training(continue_run, log_dir):
                                                              w_reg_disc_l1=exp_config.w_reg_disc_l1,
                                                              w_reg_gen_l2=exp_config.w_reg_gen_l2,
                                                              w_reg_disc_l2=exp_config.w_reg_disc_l2,
-                                                             d_hat=d_hat, x_hat=x_hat, scale=exp_config.scale)
+                                                             d_hat=d_hat, x_hat=x_hat, scale=exp_config.scale,
+                                                             discriminator_optimizer=discriminator_optimizer,
+                                                             n_accum_batches=exp_config.n_accum_batches)
+
+        if fuse_critic_iterations:
+            disc_weights = gan_model.discriminator_weights()
+
+            def critic_loss_function():
+                # one critic iteration with the next batch of the pipeline (only the images are used)
+                next_batch = train_input.iterator.get_next()
+                xs_iteration = augmentation.augment_images_with_config(next_batch[0], training_time_placeholder, exp_config)
+                xt_iteration = augmentation.augment_images_with_config(next_batch[3], training_time_placeholder, exp_config)
+                xs1_iteration, _ = tf.split(xs_iteration, 2, axis=0)
+                if exp_config.use_generator_input_noise:
+                    noise_in_gen = tf.random_uniform(shape=exp_config.generator_input_noise_shape, minval=-1, maxval=1)
+                else:
+                    noise_in_gen = None
+                xf_iteration = generator(xs1_iteration, noise_in_gen, training_time_placeholder, scope_reuse=True)
+                d_real = discriminator(xt_iteration, training_time_placeholder, scope_reuse=True)
+                d_fake = discriminator(xf_iteration, training_time_placeholder, scope_reuse=True)
+                d_hat_iteration = None
+                x_hat_iteration = None
+                if exp_config.improved_training:
+                    epsilon_iteration = tf.random_uniform([], 0.0, 1.0)
+                    x_hat_iteration = epsilon_iteration * xt_iteration + (1 - epsilon_iteration) * xf_iteration
+                    d_hat_iteration = discriminator(x_hat_iteration, training_time_placeholder, scope_reuse=True)
+                return exp_config.gan_loss_weight*gan_model.critic_loss(d_real, d_fake, disc_weights,
+                                                                        w_reg_disc_l1=exp_config.w_reg_disc_l1,
+                                                                        w_reg_disc_l2=exp_config.w_reg_disc_l2,
+                                                                        d_hat=d_hat_iteration, x_hat=x_hat_iteration,
+                                                                        scale=exp_config.scale)
+
+            n_critic_iterations_pl = tf.placeholder(tf.int32, shape=[], name='n_critic_iterations')
+            fused_critic_train_op = gan_model.fused_critic_op(critic_loss_function, discriminator_optimizer,
+                                                              n_critic_iterations_pl,
+                                                              clip_weights=not exp_config.improved_training)
 
 
         tf.summary.scalar('classifier loss', classifier_loss)
@@ -271,15 +385,17 @@ def run_training(continue_run, log_dir):
         summary = tf.summary.merge_all()
 
 
-        # Add the variable initializer Op.
-        init = tf.global_variables_initializer()
+        # Add the variable initializer Op (the local variables are the gradient accumulators)
+        init = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
 
         # Create a savers for writing training checkpoints.
-        saver_latest = tf.train.Saver(max_to_keep=2)
-        saver_best_disc = tf.train.Saver(max_to_keep=2)  # disc loss is scaled negative EM distance
-        saver_best_diag_f1 = tf.train.Saver(max_to_keep=5)
-        saver_best_ages_f1 = tf.train.Saver(max_to_keep=1)
-        saver_best_xent = tf.train.Saver(max_to_keep=5)
+        # the checkpoints are written in a background thread
+        checkpoint_writer = CheckpointWriter()
+        saver_latest = checkpoint_writer.saver(max_to_keep=2)
+        saver_best_disc = checkpoint_writer.saver(max_to_keep=2)  # disc loss is scaled negative EM distance
+        saver_best_diag_f1 = checkpoint_writer.saver(max_to_keep=5)
+        saver_best_ages_f1 = checkpoint_writer.saver(max_to_keep=1)
+        saver_best_xent = checkpoint_writer.saver(max_to_keep=5)
 
         # validation summaries gan
         val_disc_loss_pl = tf.placeholder(tf.float32, shape=[], name='disc_val_loss')
@@ -332,6 +448,48 @@ def run_training(continue_run, log_dir):
         if continue_run:
             # Restore session
             saver_latest.restore(sess, init_checkpoint_path)
+            batch_sampler.restore_sampler_states(init_checkpoint_path, index_samplers)
+
+        if train_input is not None:
+            # start the input pipeline after the sampler states are restored
+            sess.run(train_input.initializer)
+
+        def next_train_feed_dict(feed_dict, batch=None):
+            # adds the next training batch (or the given batch) to the feed_dict. With the pipeline the run takes the
+            # next batch itself
+            if train_input is not None:
+                train_input.consumed()
+            else:
+                x_s, [diag_s, age_s], x_t, [diag_t, age_t] = next(st_sampler_train) if batch is None else batch
+                feed_dict.update({xs_pl: x_s, xt_pl: x_t, diag_s_pl: diag_s, ages_s_pl: age_s})
+            return feed_dict
+
+        # time of the phases of the steps, optionally with Chrome trace timelines of the session runs
+        profiler = StepProfiler(log_frequency=exp_config.profile_log_frequency,
+                                trace_frequency=exp_config.trace_frequency,
+                                trace_dir=os.path.join(log_dir, 'timelines'))
+        phase_names = {'gen': 'generator', 'disc': 'critic', 'clf': 'classifier'}
+
+        def run_train_ops(networks, feed_dict, batches):
+            # one update of the networks ('gen', 'disc', 'clf') with the training batches (None means the next batch).
+            # With gradient accumulation the gradients of the n_accum_batches micro batches are summed up first
+            phase_name = '+'.join(phase_names[network] for network in networks)
+            if exp_config.n_accum_batches == 1:
+                with profiler.phase('data'):
+                    batch_feed_dict = next_train_feed_dict(dict(feed_dict), batches[0])
+                profiler.run(sess, phase_name, [train_ops_dict[network] for network in networks],
+                             feed_dict=batch_feed_dict)
+            else:
+                for batch in batches:
+                    with profiler.phase('data'):
+                        batch_feed_dict = next_train_feed_dict(dict(feed_dict), batch)
+                    profiler.run(sess, phase_name, [train_ops_dict[network + '_accum'] for network in networks],
+                                 feed_dict=batch_feed_dict)
+                profiler.run(sess, phase_name, [train_ops_dict[network] for network in networks], feed_dict=feed_dict)
+
+        logging.info('Effective batch size: %d source and %d target images (%d micro batches)'
+                     % (clf_batch_size*exp_config.n_accum_batches, exp_config.batch_size*exp_config.n_accum_batches,
+                        exp_config.n_accum_batches))
 
         curr_lr_gan = exp_config.learning_rate_gan
         curr_lr_clf = exp_config.learning_rate_clf
@@ -349,96 +507,94 @@ def run_training(continue_run, log_dir):
         for step in range(init_step, exp_config.max_steps):
 
             start_time = time.time()
+            profiler.start_step(step)
 
             # discriminator and classifier (task) training iterations
             d_iters = 5
             t_iters = 1
             if step % 500 == 0 or step < 25:
                 d_iters = 100
-            for iteration in range(max(d_iters, t_iters)):
-
-                x_t, [diag_t, age_t] = next(t_sampler_train)
-                x_s, [diag_s, age_s] = next(s_sampler_train)
-
-                feed_dict_dc = {xs_pl: x_s,
-                                xt_pl: x_t,
-                                learning_rate_gan_pl: curr_lr_gan,
-                                learning_rate_clf_pl: curr_lr_clf,
-                                diag_s_pl: diag_s,
-                                ages_s_pl: age_s,
-                                training_time_placeholder: True,
-                                directly_feed_clf_pl: False}
-                train_ops_list_dc = []
+            feed_dict_train = {learning_rate_gan_pl: curr_lr_gan,
+                               learning_rate_clf_pl: curr_lr_clf,
+                               training_time_placeholder: True,
+                               directly_feed_clf_pl: False}
+
+            if fuse_critic_iterations:
+                # the iterations with the classifier as before, the critic-only iterations in one call
+                n_iterations = t_iters
+            else:
+                n_iterations = max(d_iters, t_iters)
+            # every iteration uses n_accum_batches (micro) batches. The batches of all critic iterations are read with
+            # one bulk read (the pipeline reads in parallel)
+            n_accum = exp_config.n_accum_batches
+            if train_input is None:
+                with profiler.phase('data'):
+                    critic_batches = st_sampler_train.next_batches(n_iterations*n_accum)
+            else:
+                critic_batches = [None]*(n_iterations*n_accum)
+
+            for iteration in range(n_iterations):
+
+                networks = []
                 if iteration < t_iters:
                     # train classifier
-                    train_ops_list_dc.append(train_ops_dict['clf'])
+                    networks.append('clf')
 
                 if iteration < d_iters:
                     # train discriminator
-                    train_ops_list_dc.append(train_ops_dict['disc'])
+                    networks.append('disc')
 
-                sess.run(train_ops_list_dc, feed_dict=feed_dict_dc)
+                run_train_ops(networks, feed_dict_train, critic_batches[iteration*n_accum:(iteration + 1)*n_accum])
 
                 if not exp_config.improved_training:
-                    sess.run(d_clip_op)
+                    profiler.run(sess, 'critic', d_clip_op)
+
+            if fuse_critic_iterations and d_iters > t_iters:
+                profiler.run(sess, 'critic', fused_critic_train_op, feed_dict={n_critic_iterations_pl: d_iters - t_iters,
+                                                                               learning_rate_gan_pl: curr_lr_gan,
+                                                                               training_time_placeholder: True})
+                train_input.consumed(d_iters - t_iters)
 
             elapsed_time = time.time() - start_time
 
             # train generator
-            x_t, [diag_t, age_t] = next(t_sampler_train)
-            x_s, [diag_s, age_s] = next(s_sampler_train)
-            sess.run(train_ops_dict['gen'],
-                     feed_dict={xs_pl: x_s,
-                                xt_pl: x_t,
-                                learning_rate_gan_pl: curr_lr_gan,
-                                learning_rate_clf_pl: curr_lr_clf,
-                                diag_s_pl: diag_s,
-                                ages_s_pl: age_s,
-                                training_time_placeholder: True,
-                                directly_feed_clf_pl: False
-                                })
+            run_train_ops(['gen'], feed_dict_train, [None]*n_accum)
 
             if step % exp_config.update_tensorboard_frequency == 0:
-                x_t, [diag_t, age_t] = next(t_sampler_train)
-                x_s, [diag_s, age_s] = next(s_sampler_train)
-
-                feed_dict_summary={xs_pl: x_s,
-                                    xt_pl: x_t,
-                                    learning_rate_gan_pl: curr_lr_gan,
-                                    learning_rate_clf_pl: curr_lr_clf,
-                                    diag_s_pl: diag_s,
-                                    ages_s_pl: age_s,
-                                    training_time_placeholder: True,
-                                    directly_feed_clf_pl: False
-                                    }
-
-                c_loss_one_batch, gan_losses_one_batch_dict, summary_str = sess.run(
-                        [classifier_loss, losses_gan_dict, summary], feed_dict=feed_dict_summary)
-
-                summary_writer.add_summary(summary_str, step)
-                summary_writer.flush()
+                with profiler.phase('summaries'):
+                    feed_dict_summary = next_train_feed_dict({learning_rate_gan_pl: curr_lr_gan,
+                                                              learning_rate_clf_pl: curr_lr_clf,
+                                                              training_time_placeholder: True,
+                                                              directly_feed_clf_pl: False})
 
-                logging.info("[Step: %d], classifier_loss: %g, GAN losses: %s" % (step, c_loss_one_batch, str(gan_losses_one_batch_dict)))
-                logging.info(" - elapsed time for one step: %f secs" % elapsed_time)
+                    c_loss_one_batch, gan_losses_one_batch_dict, summary_str = sess.run(
+                            [classifier_loss, losses_gan_dict, summary], feed_dict=feed_dict_summary)
+
+                    summary_writer.add_summary(summary_str, step)
+                    summary_writer.flush()
+
+                    logging.info("[Step: %d], classifier_loss: %g, GAN losses: %s" % (step, c_loss_one_batch, str(gan_losses_one_batch_dict)))
+                    logging.info(" - elapsed time for one step: %f secs" % elapsed_time)
 
             if (step + 1) % exp_config.train_eval_frequency == 0:
 
                 # Evaluate against the training set
                 logging.info('Training data eval for classifier (target domain):')
-                [train_loss, train_diag_f1, train_ages_f1] = do_eval_classifier(sess, eval_diag_loss,
-                                                                                eval_ages_loss,
-                                                                                pred_labels,
-                                                                                ages_softmaxs,
-                                                                                xs_pl,
-                                                                                diag_s_pl,
-                                                                                ages_s_pl,
-                                                                                training_time_placeholder,
-                                                                                directly_feed_clf_pl,
-                                                                                images_train,
-                                                                                [labels_train, ages_train],
-                                                                                clf_batch_size=clf_batch_size,
-                                                                                do_ordinal_reg=exp_config.age_ordinal_regression,
-                                                                                selection_indices=source_images_train_ind)
+                with profiler.phase('evaluation'):
+                    [train_loss, train_diag_f1, train_ages_f1] = do_eval_classifier(sess, eval_diag_loss,
+                                                                                    eval_ages_loss,
+                                                                                    pred_labels,
+                                                                                    ages_softmaxs,
+                                                                                    xs_pl,
+                                                                                    diag_s_pl,
+                                                                                    ages_s_pl,
+                                                                                    training_time_placeholder,
+                                                                                    directly_feed_clf_pl,
+                                                                                    images_train,
+                                                                                    [labels_train, ages_train],
+                                                                                    clf_batch_size=clf_batch_size,
+                                                                                    do_ordinal_reg=exp_config.age_ordinal_regression,
+                                                                                    selection_indices=source_images_train_ind)
 
                 train_summary_msg = sess.run(train_summary, feed_dict={train_error_clf_: train_loss,
                                                                        train_diag_f1_score_: train_diag_f1,
@@ -472,32 +628,32 @@ def run_training(continue_run, log_dir):
 
             if (step + 1) % exp_config.validation_frequency == 0:
 
-                # evaluate gan losses
-                g_loss_val_avg, d_loss_val_avg = do_eval_gan(sess=sess,
-                                                             losses=[losses_gan_dict['gen']['nr'], losses_gan_dict['disc']['nr']],
-                                                             images_s_pl=xs_pl,
-                                                             images_t_pl=xt_pl,
-                                                             training_time_placeholder=training_time_placeholder,
-                                                             images=images_val,
-                                                             source_images_ind=source_images_val_ind,
-                                                             target_images_ind=target_images_val_ind)
-
-                # evaluate classifier losses
-                [val_loss, val_diag_f1, val_ages_f1] = do_eval_classifier(sess,
-                                                                          eval_diag_loss,
-                                                                          eval_ages_loss,
-                                                                          pred_labels,
-                                                                          ages_softmaxs,
-                                                                          xs_pl,
-                                                                          diag_s_pl,
-                                                                          ages_s_pl,
-                                                                          training_time_pl=training_time_placeholder,
-                                                                          directly_feed_clf_pl=directly_feed_clf_pl,
-                                                                          images=images_val,
-                                                                          labels_list=[labels_val, ages_val],
-                                                                          clf_batch_size=clf_batch_size,
-                                                                          do_ordinal_reg=exp_config.age_ordinal_regression,
-                                                                          selection_indices=source_images_val_ind)
+                with profiler.phase('validation'):
+                    # evaluate gan losses
+                    g_loss_val_avg, d_loss_val_avg = do_eval_gan(sess=sess,
+                                                                 losses=[losses_gan_dict['gen']['nr'], losses_gan_dict['disc']['nr']],
+                                                                 images_s_pl=xs_pl,
+                                                                 images_t_pl=xt_pl,
+                                                                 training_time_placeholder=training_time_placeholder,
+                                                                 source_val_set=clf_val_set,
+                                                                 target_val_set=target_val_set)
+
+                    # evaluate classifier losses
+                    [val_loss, val_diag_f1, val_ages_f1] = do_eval_classifier(sess,
+                                                                              eval_diag_loss,
+                                                                              eval_ages_loss,
+                                                                              pred_labels,
+                                                                              ages_softmaxs,
+                                                                              xs_pl,
+                                                                              diag_s_pl,
+                                                                              ages_s_pl,
+                                                                              training_time_pl=training_time_placeholder,
+                                                                              directly_feed_clf_pl=directly_feed_clf_pl,
+                                                                              images=None,
+                                                                              labels_list=None,
+                                                                              clf_batch_size=clf_batch_size,
+                                                                              do_ordinal_reg=exp_config.age_ordinal_regression,
+                                                                              eval_set=clf_val_set)
 
 
                 feed_dict_val = {
@@ -516,27 +672,31 @@ def run_training(continue_run, log_dir):
                 if d_loss_val_avg <= best_d_loss:
                     best_d_loss = d_loss_val_avg
                     best_file = os.path.join(log_dir, 'model_best_d_loss.ckpt')
-                    saver_best_disc.save(sess, best_file, global_step=step)
+                    with profiler.phase('checkpoint'):
+                        saver_best_disc.save(sess, best_file, global_step=step)
                     logging.info('Found new best discriminator loss on validation set! - %f -  Saving model_best_d_loss.ckpt' % best_d_loss)
 
                 if val_diag_f1 >= best_diag_f1_score:
                     best_diag_f1_score = val_diag_f1
                     best_file = os.path.join(log_dir, 'model_best_diag_f1.ckpt')
-                    saver_best_diag_f1.save(sess, best_file, global_step=step)
+                    with profiler.phase('checkpoint'):
+                        saver_best_diag_f1.save(sess, best_file, global_step=step)
                     logging.info(
                         'Found new best DIAGNOSIS F1 score on validation set! - %f -  Saving model_best_diag_f1.ckpt' % val_diag_f1)
 
                 if val_ages_f1 >= best_ages_f1_score:
                     best_ages_f1_score = val_ages_f1
                     best_file = os.path.join(log_dir, 'model_best_ages_f1.ckpt')
-                    saver_best_ages_f1.save(sess, best_file, global_step=step)
+                    with profiler.phase('checkpoint'):
+                        saver_best_ages_f1.save(sess, best_file, global_step=step)
                     logging.info(
                         'Found new best AGES F1 score on validation set! - %f -  Saving model_best_ages_f1.ckpt' % val_ages_f1)
 
                 if val_loss <= best_val:
                     best_val = val_loss
                     best_file = os.path.join(log_dir, 'model_best_xent.ckpt')
-                    saver_best_xent.save(sess, best_file, global_step=step)
+                    with profiler.phase('checkpoint'):
+                        saver_best_xent.save(sess, best_file, global_step=step)
                     logging.info(
                         'Found new best crossentropy on validation set! - %f -  Saving model_best_xent.ckpt' % val_loss)
 
@@ -545,8 +705,20 @@ def run_training(continue_run, log_dir):
             # Write the summaries and print an overview fairly often.
             if step % exp_config.save_frequency == 0:
 
-                saver_latest.save(sess, os.path.join(log_dir, 'model.ckpt'), global_step=step)
+                with profiler.phase('checkpoint'):
+                    # the sampler states of this step are saved when the checkpoint is complete. The pipeline draws
+                    # ahead, its states after the batches that were trained on are saved
+                    if train_input is not None:
+                        states = train_input.sampler_states()
+                    else:
+                        states = batch_sampler.sampler_states(index_samplers)
+                    saver_latest.save(sess, os.path.join(log_dir, 'model.ckpt'), global_step=step,
+                                      after_write=functools.partial(batch_sampler.save_sampler_states, states=states))
+                    checkpoint_writer.log_stats()
+
+            profiler.end_step()
 
+        checkpoint_writer.close()
         sess.close()
 
 
@@ -582,43 +754,35 @@ def concatenate_clf_input(images_list, diag_list, ages_list, scope_name='fs_conc
 
 
 
-def do_eval_gan(sess, losses, images_s_pl, images_t_pl, training_time_placeholder, images, source_images_ind,
-                target_images_ind, batch_size=exp_config.batch_size, num_batches=exp_config.num_val_batches):
+def do_eval_gan(sess, losses, images_s_pl, images_t_pl, training_time_placeholder, source_val_set, target_val_set,
+                num_batches=exp_config.num_val_batches):
     '''
-    Function for running the evaluations of the gan every X iterations on the training and validation sets.
+    Function for running the evaluations of the gan every X iterations on the validation set.
     :param sess: The current tf session
     :param losses: list of loss placeholders
-    :param images_placeholder: Placeholder for the images
-    :param labels_placeholder: Placeholder for the masks
+    :param images_s_pl: Placeholder for the source images
+    :param images_t_pl: Placeholder for the target images
     :param training_time_placeholder: Placeholder toggling the training/testing mode.
-    :param images: A numpy array or h5py dataset containing the images
-    :param batch_size: The batch_size to use.
-    :return: The average loss (as defined in the experiment), and the average dice over all `images`.
+    :param source_val_set: ResidentEvalSet with the source batches (batch size of images_s_pl)
+    :param target_val_set: ResidentEvalSet with the target batches (batch size of images_t_pl)
+    :param num_batches: maximal number of batches that are evaluated
+    :return: The average losses over the batches.
     '''
 
-    s_sampler_val = iterate_minibatches_endlessly(images,
-                                                  batch_size=2*batch_size,
-                                                  exp_config=exp_config,
-                                                  selection_indices=source_images_ind)
-    t_sampler_val = iterate_minibatches_endlessly(images,
-                                                  batch_size=batch_size,
-                                                  exp_config=exp_config,
-                                                  selection_indices=target_images_ind)
-
     # evaluate the validation batch with batch_size images (from each domain) at a time
-    loss_val_array = np.empty((num_batches, len(losses)), dtype=np.float32)
-    for batch_ind in range(exp_config.num_val_batches):
-        x_t = next(t_sampler_val)
-        x_s = next(s_sampler_val)
+    loss_val_list = []
+    for (x_s, _), x_t in zip(source_val_set.batches(), target_val_set.batches()):
+        if len(loss_val_list) == num_batches:
+            break
         loss_val = sess.run(
             losses, feed_dict={images_s_pl: x_s,
                                images_t_pl: x_t,
                                training_time_placeholder: False})
-        loss_val_array[batch_ind, :] = np.array(loss_val)
+        loss_val_list.append(loss_val)
 
-    loss_val_avg = np.mean(loss_val_array, axis=0)
+    loss_val_avg = np.mean(np.array(loss_val_list, dtype=np.float32), axis=0)
     logging.info(losses)
-    logging.info(num_batches)
+    logging.info(len(loss_val_list))
     logging.info('average val loss: ' + str(loss_val_avg.tolist()))
 
     return loss_val_avg.tolist()
@@ -626,7 +790,7 @@ def do_eval_gan(sess, losses, images_s_pl, images_t_pl, training_time_placeholde
 
 def do_eval_classifier(sess, eval_diag_loss, eval_ages_loss, pred_labels, ages_softmaxs, images_s_pl, diag_labels_pl,
                        ages_pl, training_time_pl, directly_feed_clf_pl, images, labels_list, clf_batch_size, do_ordinal_reg,
-                       selection_indices=None):
+                       selection_indices=None, eval_set=None):
 
     '''
     Function for running the evaluations every X iterations on the training and validation sets.
@@ -636,8 +800,9 @@ def do_eval_classifier(sess, eval_diag_loss, eval_ages_loss, pred_labels, ages_s
     :param labels_placeholder: Placeholder for the masks
     :param training_time_pl: Placeholder toggling the training/testing mode.
     :param images: A numpy array or h5py dataset containing the images
-    :param labels_list: A numpy array or h45py dataset containing the corresponding labels
+    :param labels_list: diagnoses in the standard range of label_list (see label_encodings.diagnosis_labels) and ages
     :param clf_batch_size: The batch_size to use.
+    :param eval_set: ResidentEvalSet (with labels) that is evaluated instead of images and labels_list
     :return: The average loss (as defined in the experiment), and the average dice over all `images`.
     '''
 
@@ -649,12 +814,18 @@ def do_eval_classifier(sess, eval_diag_loss, eval_ages_loss, pred_labels, ages_s
     predictions_ages = []
     predictions_ages_gt = []
 
-    for batch in iterate_minibatches(images,
-                                     labels_list,
-                                     batch_size=clf_batch_size,
-                                     selection_indices=selection_indices,
-                                     augmentation_function=None,
-                                     exp_config=exp_config):  # No aug in evaluation
+    if eval_set is not None:
+        batches = eval_set.batches()
+    else:
+        batches = iterate_minibatches(images,
+                                      labels_list,
+                                      batch_size=clf_batch_size,
+                                      selection_indices=selection_indices,
+                                      augmentation_function=None,
+                                      map_labels_to_standard_range=False,
+                                      exp_config=exp_config)  # No aug in evaluation
+
+    for batch in batches:
         # As before you can wrap the iterate_minibatches function in the BackgroundGenerator class for speed improvements
         # but at the risk of not catching exceptions
 
@@ -0,0 +1,133 @@
+# Authors:
+# Jonathan Dietrich
+
+# precomputed label encodings stored in a sidecar HDF5 file next to the preprocessed data
+#
+# The sidecar <preprocessed file>_labels.hdf5 contains one group per encoding, named by its parameters, e.g.
+#   diagnosis_lbl_0_2/train            diagnoses mapped to the standard range of label_list (0 .. nlabels-1)
+#   age_ordinal_bins_65_70_75_80_85/val ages in the ordinal regression format
+#   age_binned_bins_65_70_75_80_85/val  ages as bin numbers
+#   field_strength_fs_1.5_3.0_lbl_0_1/test field strength class labels
+# An encoding is computed (vectorised) the first time it is requested and read from the sidecar afterwards.
+
+import logging
+import os
+
+import numpy as np
+import h5py
+
+# encodings that were already loaded by this process
+_cache = {}
+
+
+def labels_to_standard_range(labels, label_list):
+    '''
+    This puts the labels in a range from 0 to nlabels. E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
+    The label gets the position of its value in label_list, computed with integer indexing instead of a search per label.
+    :param labels: numpy array with labels that are all in label_list
+    :param label_list: list of the possible label values
+    :return: numpy array with the positions of the labels in label_list
+    '''
+    labels = np.asarray(labels)
+    label_list = np.asarray(label_list)
+    order = np.argsort(label_list, kind='mergesort')
+    sorted_label_list = label_list[order]
+    positions = np.clip(np.searchsorted(sorted_label_list, labels), 0, len(label_list) - 1)
+    if not np.all(sorted_label_list[positions] == labels):
+        raise ValueError('unexpected labels: %s' % str(np.unique(labels[sorted_label_list[positions] != labels])))
+    return order[positions]
+
+
+def sidecar_path(data_file_path):
+    return os.path.splitext(data_file_path)[0] + '_labels.hdf5'
+
+
+def _parameter_string(values):
+    return '_'.join([str(value) for value in values])
+
+
+def _load_or_compute(data, split, group_name, compute_function):
+    data_file_path = data.filename
+    key = (data_file_path, group_name, split)
+    if key in _cache:
+        return _cache[key]
+
+    path = sidecar_path(data_file_path)
+    dataset_name = '%s/%s' % (group_name, split)
+    encoded = None
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(data_file_path):
+        with h5py.File(path, 'r') as sidecar:
+            if dataset_name in sidecar:
+                encoded = sidecar[dataset_name][()]
+
+    if encoded is None:
+        encoded = compute_function()
+        try:
+            if os.path.exists(path) and os.path.getmtime(path) < os.path.getmtime(data_file_path):
+                # encodings of an older version of the preprocessed file
+                os.remove(path)
+            with h5py.File(path, 'a') as sidecar:
+                if dataset_name not in sidecar:
+                    sidecar.create_dataset(dataset_name, data=encoded)
+            logging.info('Added %s to the label sidecar %s' % (dataset_name, path))
+        except (IOError, OSError):
+            # e.g. another process writes the sidecar at the same time, the encoding is written by a later run
+            logging.warning('Could not write %s to the label sidecar %s' % (dataset_name, path))
+
+    _cache[key] = encoded
+    return encoded
+
+
+def diagnosis_labels(data, split, label_list):
+    '''
+    Diagnoses of the split mapped to the standard range of label_list
+    :param data: h5py file (or SharedDataset) of the preprocessed data
+    :param split: 'train', 'val' or 'test'
+    :return: uint8 numpy array
+    '''
+    return _load_or_compute(data, split, 'diagnosis_lbl_%s' % _parameter_string(label_list),
+                            lambda: labels_to_standard_range(data['diagnosis_%s' % split][()],
+                                                             label_list).astype(np.uint8))
+
+
+def age_labels(data, split, age_bins, ordinal_regression):
+    '''
+    Ages of the split in the ordinal regression format ([N, len(age_bins)]) or as bin numbers ([N])
+    :param data: h5py file (or SharedDataset) of the preprocessed data
+    :param split: 'train', 'val' or 'test'
+    :return: uint8 numpy array
+    '''
+    if ordinal_regression:
+        group_name = 'age_ordinal_bins_%s' % _parameter_string(age_bins)
+        compute_function = lambda: age_to_ordinal_reg_format(data['age_%s' % split][()], age_bins)
+    else:
+        group_name = 'age_binned_bins_%s' % _parameter_string(age_bins)
+        compute_function = lambda: age_to_bins(data['age_%s' % split][()], age_bins)
+    return _load_or_compute(data, split, group_name, compute_function)
+
+
+def field_strength_labels(data, split, field_strength_list, label_list):
+    '''
+    Field strengths of the split mapped to the class labels in label_list (see utils.fstr_to_label)
+    :param data: h5py file (or SharedDataset) of the preprocessed data
+    :param split: 'train', 'val' or 'test'
+    :return: int16 numpy array
+    '''
+    group_name = 'field_strength_fs_%s_lbl_%s' % (_parameter_string(field_strength_list), _parameter_string(label_list))
+    return _load_or_compute(data, split, group_name,
+                            lambda: fstr_to_label(data['field_strength_%s' % split][()], field_strength_list,
+                                                  label_list))
+
+
+def age_to_ordinal_reg_format(ages, bins):
+    return np.asarray(np.asarray(ages)[:, np.newaxis] > np.asarray(bins)[np.newaxis, :], dtype=np.uint8)
+
+
+def age_to_bins(ages, bins):
+    return np.sum(age_to_ordinal_reg_format(ages, bins), axis=-1, dtype=np.uint8)
+
+
+def fstr_to_label(fieldstrengths, field_strength_list, label_list):
+    assert len(label_list) == len(field_strength_list)
+    fs_positions = labels_to_standard_range(fieldstrengths, field_strength_list)
+    return np.asarray(label_list, dtype=np.int16)[fs_positions]
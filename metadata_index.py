@@ -0,0 +1,85 @@
+# Authors:
+# Jonathan Dietrich
+
+# in-memory index of the metadata of a preprocessed file (rid, viscode, diagnosis, field strength, age per split)
+# Queries for the images of a domain or with certain labels are boolean masks over these arrays, so they never read
+# the image datasets and every metadata dataset is read from the HDF5 file only once per process.
+
+import os
+
+import numpy as np
+
+SPLITS = ('train', 'val', 'test')
+FIELDS = ('rid', 'viscode', 'diagnosis', 'field_strength', 'age')
+
+# indices that were already loaded by this process, by file name and modification time of the file
+_cache = {}
+
+
+class MetadataIndex(object):
+    '''
+    Metadata arrays of all splits of a preprocessed file. self.arrays[split][field] is a numpy array with one entry
+    per image of the split, e.g. self.arrays['train']['field_strength'].
+    '''
+    def __init__(self, data):
+        self.filename = data.filename
+        self.arrays = {}
+        for split in SPLITS:
+            if 'images_%s' % split not in data:
+                continue
+            self.arrays[split] = {field: np.asarray(data['%s_%s' % (field, split)][()]) for field in FIELDS
+                                  if '%s_%s' % (field, split) in data}
+
+    def __getitem__(self, split):
+        return self.arrays[split]
+
+    def size(self, split):
+        return len(self.arrays[split]['diagnosis'])
+
+    def mask(self, split, **conditions):
+        '''
+        Boolean mask of the images of a split that fulfill all conditions
+        e.g. mask('train', field_strength=3.0, diagnosis=(0, 2))
+        :param split: 'train', 'val' or 'test'
+        :param conditions: field=value or field=(value1, value2, ...) for any of the FIELDS. None is no condition
+        :return: boolean numpy array with one entry per image of the split
+        '''
+        mask = np.ones(self.size(split), dtype=np.bool_)
+        for field, values in conditions.items():
+            if values is None:
+                continue
+            if field not in FIELDS:
+                raise ValueError('Unknown metadata field: %s' % field)
+            mask &= np.isin(self.arrays[split][field], np.asarray(values))
+        return mask
+
+    def indices(self, split, **conditions):
+        '''
+        Indices of the images of a split that fulfill all conditions (see mask)
+        :return: numpy array with the indices in increasing order
+        '''
+        return np.flatnonzero(self.mask(split, **conditions))
+
+    def domain_indices(self, split, source_field_strength, target_field_strength, **conditions):
+        '''
+        Indices of the source and target images of a split
+        :return: source indices, target indices as numpy arrays in increasing order
+        '''
+        return self.indices(split, field_strength=source_field_strength, **conditions), \
+               self.indices(split, field_strength=target_field_strength, **conditions)
+
+
+def get_metadata_index(data):
+    '''
+    Returns the MetadataIndex of a preprocessed file, which is only built the first time. It is built again if the file
+    was written again (e.g. preprocessed with force_overwrite)
+    :param data: h5py file (or SharedDataset) of the preprocessed data
+    :return: MetadataIndex
+    '''
+    key = (data.filename, os.path.getmtime(data.filename))
+    if key not in _cache:
+        # the index of an older version of the file is not used anymore
+        for old_key in [cached_key for cached_key in _cache if cached_key[0] == data.filename]:
+            del _cache[old_key]
+        _cache[key] = MetadataIndex(data)
+    return _cache[key]
@@ -207,13 +207,17 @@ def pool_fc_discriminator_bs1(x, training, scope_name='discriminator', scope_reu
 
         return dense2
 
-def residual_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, scope_name='generator', scope_reuse=False):
-    additive_term = bousmalis_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, last_activation=tf.identity, scope_name=scope_name, scope_reuse=scope_reuse)
+def residual_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, scope_name='generator', scope_reuse=False,
+                       recompute=False):
+    additive_term = bousmalis_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, last_activation=tf.identity, scope_name=scope_name, scope_reuse=scope_reuse,
+                                        recompute=recompute)
     return x + additive_term
 
 # Bousmalis Netzwerke
 # can only be used with images in [-1, 1]
-def bousmalis_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, last_activation=tf.nn.tanh, scope_name='generator', scope_reuse=False):
+# with recompute the activations inside the residual blocks are recomputed in the backward pass (gradient checkpointing)
+def bousmalis_generator(x, z_noise, training, batch_normalization, residual_blocks, nfilters, last_activation=tf.nn.tanh, scope_name='generator', scope_reuse=False,
+                        recompute=False):
     kernel_size = (3, 3, 3)
     strides = (1, 1, 1)
     # define layer for the residual blocks
@@ -243,34 +247,38 @@ def bousmalis_generator(x, z_noise, training, batch_normalization, residual_bloc
 
         # place residual blocks
         for block_num in range(1, 1 + residual_blocks):
-            previous_layer = layers.residual_block_original(previous_layer, 'res_block_' + str(block_num), conv_layer,
-                                                            activation=tf.nn.relu, nlayers=2)
+            residual_block = lambda bottom, block_num=block_num: layers.residual_block_original(
+                bottom, 'res_block_' + str(block_num), conv_layer, activation=tf.nn.relu, nlayers=2)
+            previous_layer = layers.recomputed_block(residual_block, previous_layer, recompute=recompute)
 
         conv_out = layers.conv3D_layer(previous_layer, 'conv_out', kernel_size=kernel_size, num_filters=1, strides=strides,
                         activation=last_activation)
         return conv_out
 
-def bousmalis_discriminator(x, training, batch_normalization, middle_layers, initial_filters, dropout_start=3, scope_name='discriminator', scope_reuse=False):
+# with recompute only the outputs of the convolutional layers are kept for the backward pass, the activations inside a
+# layer (convolution, batch norm) are recomputed (gradient checkpointing). Dropout stays outside of the recomputation
+def bousmalis_discriminator(x, training, batch_normalization, middle_layers, initial_filters, dropout_start=3, scope_name='discriminator', scope_reuse=False,
+                            recompute=False):
     # leaky relu has the same parameter as in the paper
     leaky_relu = lambda x: layers.leaky_relu(x, alpha=0.2)
     with tf.variable_scope(scope_name) as scope:
         if scope_reuse:
             scope.reuse_variables()
         if batch_normalization:
-            previous_layer = layers.conv3D_layer_bn(x, 'convs1_1', kernel_size=(3,3,3), num_filters=initial_filters, strides=(1,1,1),
+            conv_layer = lambda bottom, name, num_filters, strides: layers.conv3D_layer_bn(bottom, name, kernel_size=(3,3,3), num_filters=num_filters, strides=strides,
                         activation=leaky_relu, training=training)
         else:
-            previous_layer = layers.conv3D_layer(x, 'convs1_1', kernel_size=(3,3,3), num_filters=initial_filters, strides=(1,1,1),
+            conv_layer = lambda bottom, name, num_filters, strides: layers.conv3D_layer(bottom, name, kernel_size=(3,3,3), num_filters=num_filters, strides=strides,
                         activation=leaky_relu)
 
+        previous_layer = layers.recomputed_block(lambda bottom: conv_layer(bottom, 'convs1_1', initial_filters, (1,1,1)),
+                                                 x, recompute=recompute)
+
         for current_layer in range(2, 2 + middle_layers):
             num_filters = initial_filters*(2**(current_layer-1))
-            if batch_normalization:
-                previous_layer = layers.conv3D_layer_bn(previous_layer, 'convs2_' + str(current_layer), kernel_size=(3,3,3), num_filters=num_filters, strides=(2,2,2),
-                            activation=leaky_relu, training=training)
-            else:
-                previous_layer = layers.conv3D_layer(previous_layer, 'convs2_' + str(current_layer), kernel_size=(3,3,3), num_filters=num_filters, strides=(2,2,2),
-                            activation=leaky_relu)
+            layer = lambda bottom, current_layer=current_layer, num_filters=num_filters: conv_layer(
+                bottom, 'convs2_' + str(current_layer), num_filters, (2,2,2))
+            previous_layer = layers.recomputed_block(layer, previous_layer, recompute=recompute)
             if current_layer >= dropout_start:
                 previous_layer = layers.dropout_layer(previous_layer, 'dropout_' + str(current_layer), training, keep_prob=0.9)
 
@@ -455,28 +463,31 @@ def FCN_disc_bn(images, training, nlabels, bn_momentum=0.99, scope_name='discrim
 
         return diag_logits
 
+# with recompute only the outputs of the pooling layers are kept for the backward pass, the activations of the
+# convolutional layers in between are recomputed (gradient checkpointing)
 def  FCN_multitask_ordinal_bn(images, training, nlabels, n_age_thresholds=5, bn_momentum=0.99, scope_name='classifier',
-                             scope_reuse=False):
+                             scope_reuse=False, recompute=False):
     with tf.variable_scope(scope_name) as scope:
         if scope_reuse:
             scope.reuse_variables()
-        conv1_1 = layers.conv3D_layer_bn(images, 'conv1_1', num_filters=32, training=training, bn_momentum=bn_momentum)
-
-        pool1 = layers.max_pool_layer3d(conv1_1)
-
-        conv2_1 = layers.conv3D_layer_bn(pool1, 'conv2_1', num_filters=64, training=training, bn_momentum=bn_momentum)
 
-        pool2 = layers.max_pool_layer3d(conv2_1)
+        def conv_group(bottom, names, num_filters):
+            # convolutional layers followed by max pooling
+            previous_layer = bottom
+            for name in names:
+                previous_layer = layers.conv3D_layer_bn(previous_layer, name, num_filters=num_filters, training=training,
+                                                        bn_momentum=bn_momentum)
+            return layers.max_pool_layer3d(previous_layer)
 
-        conv3_1 = layers.conv3D_layer_bn(pool2, 'conv3_1', num_filters=128, training=training, bn_momentum=bn_momentum)
-        conv3_2 = layers.conv3D_layer_bn(conv3_1, 'conv3_2', num_filters=128, training=training, bn_momentum=bn_momentum)
+        pool1 = layers.recomputed_block(lambda bottom: conv_group(bottom, ['conv1_1'], 32), images, recompute=recompute)
 
-        pool3 = layers.max_pool_layer3d(conv3_2)
+        pool2 = layers.recomputed_block(lambda bottom: conv_group(bottom, ['conv2_1'], 64), pool1, recompute=recompute)
 
-        conv4_1 = layers.conv3D_layer_bn(pool3, 'conv4_1', num_filters=256, training=training, bn_momentum=bn_momentum)
-        conv4_2 = layers.conv3D_layer_bn(conv4_1, 'conv4_2', num_filters=256, training=training, bn_momentum=bn_momentum)
+        pool3 = layers.recomputed_block(lambda bottom: conv_group(bottom, ['conv3_1', 'conv3_2'], 128), pool2,
+                                        recompute=recompute)
 
-        pool4 = layers.max_pool_layer3d(conv4_2)
+        pool4 = layers.recomputed_block(lambda bottom: conv_group(bottom, ['conv4_1', 'conv4_2'], 256), pool3,
+                                        recompute=recompute)
 
         conv5_1 = layers.conv3D_layer_bn(pool4, 'conv5_1', num_filters=256, training=training, bn_momentum=bn_momentum)
         conv5_2 = layers.conv3D_layer_bn(conv5_1, 'conv5_2', num_filters=256, training=training, bn_momentum=bn_momentum)
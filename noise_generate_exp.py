@@ -13,6 +13,7 @@ import config.system as sys_config
 import utils
 import adni_data_loader_all
 import experiments.gan.standard_parameters as std_params
+from metadata_index import get_metadata_index
 
 
 def build_gen_graph(img_tensor_shape, gan_config):
@@ -96,13 +97,8 @@ def generate_with_noise(gan_experiment_path_list, noise_list,
         config.gpu_options.allow_growth = True  # Do not assign whole gpu memory, just use it on the go
         config.allow_soft_placement = True  # If a operation is not defined in the default device, let it execute in another.
 
-        source_indices = []
-        target_indices = []
-        for i, field_strength in enumerate(data['field_strength_test']):
-            if field_strength == gan_config.source_field_strength:
-                source_indices.append(i)
-            elif field_strength == gan_config.target_field_strength:
-                target_indices.append(i)
+        source_indices, target_indices = [ind.tolist() for ind in get_metadata_index(data).domain_indices(
+            'test', gan_config.source_field_strength, gan_config.target_field_strength)]
 
         num_source_images = len(source_indices)
         num_target_images = len(target_indices)
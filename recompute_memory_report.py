@@ -0,0 +1,127 @@
+# Authors:
+# Jonathan Dietrich
+
+# Peak GPU memory and training step time of the 3D networks with and without recomputed activations (recompute
+# argument of the networks in model_zoo, see layers.recomputed_block) for the image sizes of the preprocessed data.
+# Every measurement runs in its own process, since the peak memory of the GPU allocator can't be reset.
+# The training step is an Adam update of the network with a batch of random images:
+#   generators: mean of the generated images as loss
+#   discriminator: WGAN loss with gradient penalty (three forward passes like in train_gan)
+#   classifier: mean of the diagnosis and age logits as loss
+# The report is written to results/final/recompute_memory_report.csv
+# The GAN configs don't use the recomputation of the generators and the discriminator until it is verified with this
+# report on a GPU.
+
+import csv
+import logging
+import multiprocessing
+import os
+import time
+
+import config.system as sys_config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+MODELS = ['bousmalis_generator', 'residual_generator', 'bousmalis_discriminator', 'FCN_multitask_ordinal_bn']
+
+
+def build_loss(model_name, images, training, recompute):
+    import tensorflow as tf
+    import gan_model
+    import model_zoo
+
+    if model_name in ('bousmalis_generator', 'residual_generator'):
+        # architecture of the GAN experiments (residual blocks with 8 filters, batch normalization, no input noise)
+        generator = getattr(model_zoo, model_name)
+        generated = generator(images, None, training, batch_normalization=True, residual_blocks=4, nfilters=8,
+                              recompute=recompute)
+        return tf.reduce_mean(generated)
+    if model_name == 'bousmalis_discriminator':
+        discriminator = lambda x, scope_reuse: model_zoo.bousmalis_discriminator(
+            x, training, batch_normalization=True, middle_layers=5, initial_filters=8, scope_reuse=scope_reuse,
+            recompute=recompute)
+        fake_images = tf.random_uniform(images.get_shape(), -1, 1)
+        x_hat = 0.5*images + 0.5*fake_images
+        disc_loss = tf.reduce_mean(discriminator(images, False)) - tf.reduce_mean(discriminator(fake_images, True))
+        return disc_loss + gan_model.improved_training_regularization(discriminator(x_hat, True), x_hat, 10.0)
+    if model_name == 'FCN_multitask_ordinal_bn':
+        diag_logits, ages_logits = model_zoo.FCN_multitask_ordinal_bn(images, training, nlabels=2, recompute=recompute)
+        return tf.reduce_mean(diag_logits) + tf.add_n([tf.reduce_mean(logits) for logits in ages_logits])
+    raise ValueError('Unknown model %s' % model_name)
+
+
+def measure(model_name, image_size, batch_size, recompute, n_steps):
+    '''
+    Runs in a new process
+    :return: dict with the peak memory [MB] and the mean step time [s] (None if the step ran out of memory)
+    '''
+    import tensorflow as tf
+
+    result = {'model': model_name, 'image_size': 'x'.join(str(size) for size in image_size),
+              'batch_size': batch_size, 'recompute': recompute, 'peak_memory_mb': None, 'step_time_s': None,
+              'status': 'ok'}
+    with tf.Graph().as_default():
+        images = tf.random_uniform([batch_size] + list(image_size) + [1], -1, 1)
+        training = tf.constant(True)
+        loss = build_loss(model_name, images, training, recompute)
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            train_op = tf.train.AdamOptimizer(learning_rate=1e-4, beta1=0.5, beta2=0.9).minimize(loss)
+        max_bytes_in_use = tf.contrib.memory_stats.MaxBytesInUse()
+
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            try:
+                # the first step is not timed (memory allocation, autotuning of the convolutions)
+                sess.run(train_op)
+                start_time = time.time()
+                for _ in range(n_steps):
+                    sess.run(train_op)
+                result['step_time_s'] = (time.time() - start_time) / n_steps
+                result['peak_memory_mb'] = sess.run(max_bytes_in_use) / 2**20
+            except tf.errors.ResourceExhaustedError:
+                result['status'] = 'out of memory'
+    return result
+
+
+if __name__ == '__main__':
+
+    image_sizes = [(64, 80, 64), (128, 160, 112)]
+    batch_size = 4  # <--------------------------------------------------------------------------------------------------
+    n_steps = 10
+    report_path = os.path.join(sys_config.project_root, 'results/final/recompute_memory_report.csv')
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for model_name in MODELS:
+        for image_size in image_sizes:
+            for recompute in [False, True]:
+                with context.Pool(processes=1) as pool:
+                    result = pool.apply(measure, (model_name, image_size, batch_size, recompute, n_steps))
+                results.append(result)
+                if result['status'] == 'ok':
+                    logging.info('%s %s recompute=%s: %.0f MB peak memory, %.3f s per step'
+                                 % (model_name, result['image_size'], recompute, result['peak_memory_mb'],
+                                    result['step_time_s']))
+                else:
+                    logging.info('%s %s recompute=%s: %s' % (model_name, result['image_size'], recompute,
+                                                            result['status']))
+
+    # relative memory and time of the recomputation compared to the normal training step
+    for result in results:
+        if result['recompute'] and result['status'] == 'ok':
+            baseline = [other for other in results if other['model'] == result['model'] and not other['recompute']
+                        and other['image_size'] == result['image_size']][0]
+            if baseline['status'] == 'ok':
+                logging.info('%s %s: recompute uses %.0f%% of the memory in %.0f%% of the step time'
+                             % (result['model'], result['image_size'],
+                                100*result['peak_memory_mb']/baseline['peak_memory_mb'],
+                                100*result['step_time_s']/baseline['step_time_s']))
+
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    logging.info('Report written to %s' % report_path)
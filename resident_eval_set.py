@@ -0,0 +1,93 @@
+# Authors:
+# Jonathan Dietrich
+
+# evaluation sets that are read into memory once per run
+# The periodic validation of the training scripts read (and shuffled) the validation images from the HDF5 file again
+# at every evaluation. A ResidentEvalSet reads the selected images and labels once in increasing index order and yields
+# the same batches in the same order at every evaluation, so the validation losses of different steps are computed on
+# exactly the same images and every evaluation only needs one sess.run per batch.
+# Only full batches are kept, since the placeholders have a fixed batch size (the remaining images are skipped like in
+# iterate_minibatches).
+
+import logging
+
+import numpy as np
+
+from batch_generator_list import read_images_into, read_labels
+from label_encodings import labels_to_standard_range
+
+
+class ResidentEvalSet(object):
+    '''
+    Fixed batches of images (and labels) in memory, e.g.
+        val_set = ResidentEvalSet(images_val, batch_size, exp_config, labels_list=[labels_val, ages_val])
+        for x, [y, a] in val_set.batches():
+            ...
+    '''
+    def __init__(self, images, batch_size, exp_config, labels_list=None, selection_indices=None, max_images=None,
+                 augmentation_function=None, map_labels_to_standard_range=True, random_seed=0, name='evaluation'):
+        '''
+        :param images: hdf5 dataset or numpy array with shape [N, x, y, z]
+        :param batch_size: number of images per batch
+        :param labels_list: list of hdf5 datasets or numpy arrays with the labels, None for images only
+        :param selection_indices: indices of the images in the set. If this is None all images are used
+        :param max_images: if not None and there are more images, a fixed random subset of max_images images is used
+        :param augmentation_function: deterministic function (e.g. a restored generator) that is applied once per batch
+        when the set is read, called as augmentation_function(X, y_list) (or augmentation_function(X) without labels)
+        :param random_seed: seed of the subset
+        :param name: name of the set in the log
+        '''
+        if selection_indices is None:
+            indices = np.arange(images.shape[0])
+        else:
+            indices = np.sort(np.asarray(selection_indices))
+        if max_images is not None and max_images < len(indices):
+            # random instead of the first images, which can depend on the order of the subjects in the file
+            subset = np.random.RandomState(random_seed).choice(len(indices), max_images, replace=False)
+            indices = indices[np.sort(subset)]
+
+        self.batch_size = batch_size
+        self.n_batches = len(indices) // batch_size
+        self.indices = indices[:self.n_batches*batch_size]
+        if self.n_batches == 0:
+            logging.warning('The %s set has less than %d images, it has no batches' % (name, batch_size))
+
+        self.images = np.empty([len(self.indices)] + list(exp_config.image_size) + [1], dtype=np.float32)
+        read_images_into(images, self.indices, self.images)
+
+        self.labels_list = None
+        if labels_list is not None:
+            self.labels_list = [read_labels(labels, self.indices) for labels in labels_list]
+            if map_labels_to_standard_range:
+                # This puts the labels in a range from 0 to nlabels.
+                # E.g. [0,0,2,2] becomes [0,0,1,1] (if 1 doesnt exist in the data)
+                self.labels_list[0] = labels_to_standard_range(self.labels_list[0], exp_config.label_list)
+
+        if augmentation_function is not None:
+            for batch_slice in self._batch_slices():
+                if self.labels_list is None:
+                    self.images[batch_slice] = augmentation_function(self.images[batch_slice])
+                else:
+                    X, y_list = augmentation_function(self.images[batch_slice],
+                                                      [labels[batch_slice] for labels in self.labels_list])
+                    self.images[batch_slice] = X
+                    for labels, y in zip(self.labels_list, y_list):
+                        labels[batch_slice] = y
+
+        logging.info('Read the %s set into memory: %d images in %d batches (%.0f MB)'
+                     % (name, len(self.indices), self.n_batches, self.images.nbytes / 2.0**20))
+
+    def _batch_slices(self):
+        for batch_nr in range(self.n_batches):
+            yield np.s_[batch_nr*self.batch_size:(batch_nr + 1)*self.batch_size]
+
+    def batches(self):
+        '''
+        :return: generator of the batches in a fixed order, X or (X, y_list) if the set has labels. The batches are
+        views of the set and must not be changed
+        '''
+        for batch_slice in self._batch_slices():
+            if self.labels_list is None:
+                yield self.images[batch_slice]
+            else:
+                yield self.images[batch_slice], [labels[batch_slice] for labels in self.labels_list]
@@ -0,0 +1,100 @@
+# Benchmark for the block shuffle sampling mode of the minibatch iterators.
+# Measures the read throughput and how random the batches still are for different block sizes.
+#
+# The page cache is dropped for the data file before every run (posix_fadvise), so the numbers show the disk and not
+# the RAM. Run it once with the preprocessed file on a local spinning disk and once with a file on the network storage
+# to see the throughput-versus-randomness trade-off for both.
+
+import logging
+import os
+import time
+
+import numpy as np
+import h5py
+
+from batch_generator_list import iterate_minibatches, coalesce_index_ranges, block_shuffle_indices
+import utils
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def drop_file_from_page_cache(file_path):
+    # advise the kernel to drop the cached pages of the file (works without root, also for NFS clients)
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def batch_randomness(batch_indices_list, n_images):
+    '''
+    Average spread of the indices inside a batch relative to the spread of uniformly drawn indices.
+    1 means as random as a global shuffle, values close to 0 mean the batches consist of neighbouring images.
+    '''
+    # expected mean absolute difference of two uniformly drawn indices is n/3
+    spreads = [np.mean(np.abs(np.subtract.outer(ind, ind))) * len(ind) / (len(ind) - 1) for ind in batch_indices_list]
+    return np.mean(spreads) / (n_images / 3.0)
+
+
+def benchmark_block_size(data_file_path, dataset_name, batch_size, block_size, n_batches):
+    '''
+    Reads n_batches batches with the given block size and returns a dict with the measurements
+    '''
+    drop_file_from_page_cache(data_file_path)
+
+    with h5py.File(data_file_path, 'r') as data:
+        images = data[dataset_name]
+        n_images = images.shape[0]
+        exp_config = utils.Bunch(image_size=images.shape[1:], label_list=None)
+
+        # index sequence drawn like in iterate_minibatches to count the range reads and measure the randomness
+        if block_size is None:
+            shuffled = np.random.permutation(n_images)
+        else:
+            shuffled = block_shuffle_indices(np.arange(n_images), block_size)
+        batch_indices_list = [np.sort(shuffled[b_i:b_i + batch_size])
+                              for b_i in range(0, n_images - batch_size + 1, batch_size)][:n_batches]
+        ranges_per_batch = np.mean([len(coalesce_index_ranges(ind)) for ind in batch_indices_list])
+
+        start_time = time.time()
+        n_read = 0
+        for X, _ in iterate_minibatches(images, [], batch_size, exp_config, map_labels_to_standard_range=False,
+                                        block_size=block_size):
+            n_read += X.shape[0]
+            if n_read >= n_batches*batch_size:
+                break
+        duration = time.time() - start_time
+
+        megabytes = n_read*np.prod(images.shape[1:])*images.dtype.itemsize / 1e6
+
+    return {'block_size': block_size,
+            'images_per_sec': n_read / duration,
+            'mb_per_sec': megabytes / duration,
+            'ranges_per_batch': ranges_per_batch,
+            'randomness': batch_randomness(batch_indices_list, n_images)}
+
+
+def run_benchmark(data_file_path, dataset_name, batch_size, block_sizes, n_batches, disk_name):
+    results = []
+    for block_size in block_sizes:
+        result = benchmark_block_size(data_file_path, dataset_name, batch_size, block_size, n_batches)
+        results.append(result)
+        logging.info('[%s] block size %s: %.1f images/s, %.1f MB/s, %.1f range reads per batch, randomness %.3f'
+                     % (disk_name, str(result['block_size']), result['images_per_sec'], result['mb_per_sec'],
+                        result['ranges_per_batch'], result['randomness']))
+    return results
+
+
+if __name__ == '__main__':
+
+    # preprocessed data file on the disk that should be measured  # <-------------------------------------------------
+    data_file_path = '/scratch_net/brossa/jdietric/PycharmProjects/mri_domain_adapt/data/adni/preprocessed/final/' \
+                     'all_data_size_64_80_64_res_1.5_1.5_1.5_lbl_0_2_intrangeone_offset_0_0_-10.hdf5'
+    disk_name = 'spinning disk'  # <------------------------------------------------------------------------------------
+    dataset_name = 'images_train'
+    batch_size = 20
+    n_batches = 50
+    block_sizes = [None, 2, 4, 10, 20, 40, 100]
+
+    run_benchmark(data_file_path, dataset_name, batch_size, block_sizes, n_batches, disk_name)
@@ -0,0 +1,158 @@
+# Authors:
+# Jonathan Dietrich
+
+# wall time of the phases of the training steps (e.g. data, critic, generator, summaries, validation, checkpoint)
+# The time of every phase is summed up per step. The profiler keeps the phase times of the last window steps and
+# logs their percentiles and the share of the phases in the total time every log_frequency steps.
+# Every trace_frequency steps the session runs of the step are traced (tf.RunOptions.FULL_TRACE) and the first run of
+# every phase is written as a Chrome trace timeline (open with chrome://tracing). Traced steps are slower and are not
+# part of the statistics.
+
+import collections
+import contextlib
+import logging
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+class StepProfiler(object):
+    '''
+    Usage in the training loop:
+        profiler.start_step(step)
+        with profiler.phase('data'):
+            feed_dict = ...
+        profiler.run(sess, 'critic', train_op, feed_dict)  # timed (and traced) sess.run
+        profiler.end_step()
+    Loops over batches can time the waits for the batches with profiler.iterate(batches, 'data').
+    '''
+    def __init__(self, log_frequency=100, window=200, trace_frequency=0, trace_dir=None):
+        '''
+        :param log_frequency: number of steps between the logs, 0 turns the logs off
+        :param window: number of steps of the percentiles
+        :param trace_frequency: number of steps between the traced steps, 0 turns the tracing off
+        :param trace_dir: folder of the Chrome trace files (required for tracing)
+        '''
+        if trace_frequency > 0 and trace_dir is None:
+            raise ValueError('A trace_dir is required for tracing')
+        self.log_frequency = log_frequency
+        self.window = window
+        self.trace_frequency = trace_frequency
+        self.trace_dir = trace_dir
+
+        self.phase_times = collections.OrderedDict()  # phase name -> times of the phase in the last window steps
+        self.step_times = collections.deque(maxlen=window)
+        # totals since the last log for the shares of the phases
+        self.interval_phase_totals = collections.OrderedDict()
+        self.interval_step_total = 0.0
+        self.n_steps = 0
+
+        self.step = None
+        self.step_start_time = None
+        self.current_phase_times = collections.OrderedDict()
+        self.tracing = False
+        self.traced_phases = set()
+
+    def start_step(self, step):
+        self.step = step
+        self.step_start_time = time.time()
+        self.current_phase_times.clear()
+        self.tracing = self.trace_frequency > 0 and step % self.trace_frequency == 0
+        self.traced_phases.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.current_phase_times[name] = self.current_phase_times.get(name, 0.0) + time.time() - start_time
+
+    def iterate(self, iterable, phase_name='data'):
+        '''
+        Yields the items of iterable, the time to get every item is part of the phase (e.g. waiting for the batches)
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(phase_name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def run(self, sess, phase_name, fetches, feed_dict=None):
+        '''
+        sess.run that is timed as a part of the phase. In a traced step the first run of the phase is traced
+        :return: the fetched values
+        '''
+        with self.phase(phase_name):
+            if not self.tracing or phase_name in self.traced_phases:
+                return sess.run(fetches, feed_dict=feed_dict)
+            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            run_metadata = tf.RunMetadata()
+            result = sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+        self.traced_phases.add(phase_name)
+        self.write_trace(run_metadata, phase_name)
+        return result
+
+    def write_trace(self, run_metadata, phase_name):
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format(show_memory=True)
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        trace_path = os.path.join(self.trace_dir, 'timeline_step%d_%s.json' % (self.step, phase_name))
+        with open(trace_path, 'w') as trace_file:
+            trace_file.write(trace)
+        logging.info('Wrote the trace of %s in step %d to %s' % (phase_name, self.step, trace_path))
+
+    def end_step(self):
+        if self.tracing:
+            return
+        step_time = time.time() - self.step_start_time
+        self.step_times.append(step_time)
+        self.interval_step_total += step_time
+        for name, phase_time in self.current_phase_times.items():
+            if name not in self.phase_times:
+                self.phase_times[name] = collections.deque(maxlen=self.window)
+            self.phase_times[name].append(phase_time)
+            self.interval_phase_totals[name] = self.interval_phase_totals.get(name, 0.0) + phase_time
+        self.n_steps += 1
+        if self.log_frequency > 0 and self.n_steps % self.log_frequency == 0:
+            self.log_stats()
+
+    def stats(self):
+        '''
+        :return: dict with the phase names (and 'step' for the whole step) and dicts with the percentiles of the
+        time per step (p50, p90, p99) over the window, the number of steps in the window with the phase and the share
+        of the phase in the time since the last log
+        '''
+        stats = collections.OrderedDict()
+        for name, times in [('step', self.step_times)] + list(self.phase_times.items()):
+            if len(times) == 0:
+                continue
+            p50, p90, p99 = np.percentile(times, [50, 90, 99])
+            total = self.interval_step_total if name == 'step' else self.interval_phase_totals.get(name, 0.0)
+            share = total / self.interval_step_total if self.interval_step_total > 0 else 0.0
+            stats[name] = {'p50': p50, 'p90': p90, 'p99': p99, 'steps': len(times), 'share': share}
+        return stats
+
+    def log_stats(self):
+        stats = self.stats()
+        if 'step' not in stats:
+            return
+        logging.info('Time per step (last %d steps): p50 %.3f s, p90 %.3f s, p99 %.3f s'
+                     % (stats['step']['steps'], stats['step']['p50'], stats['step']['p90'], stats['step']['p99']))
+        other_share = 1.0
+        for name, phase_stats in stats.items():
+            if name == 'step':
+                continue
+            other_share -= phase_stats['share']
+            logging.info(' - %-12s p50 %.3f s, p90 %.3f s, p99 %.3f s (in %d steps), %5.1f%% of the time'
+                         % (name, phase_stats['p50'], phase_stats['p90'], phase_stats['p99'], phase_stats['steps'],
+                            100*phase_stats['share']))
+        logging.info(' - %-12s %5.1f%% of the time' % ('other', 100*max(other_share, 0.0)))
+        self.interval_phase_totals.clear()
+        self.interval_step_total = 0.0
@@ -27,6 +27,7 @@ import utils
 import adni_data_loader
 import adni_data_loader_all
 import data_utils
+from metadata_index import get_metadata_index
 from clf_model_multitask import predict
 import experiments.gan.standard_parameters as std_params
 from batch_generator_list import iterate_minibatches
@@ -106,19 +107,12 @@ def classifier_test(clf_experiment_path, score_functions, batch_size=1, balanced
     # check that the data has really been iterated in order and in full
     assert np.array_equal(ground_truth_labels, labels_test)
 
-    source_indices = []
-    target_indices = []
-    source_true_labels = []
-    source_pred = []
-    target_true_labels = []
-    target_pred = []
-    for i, field_strength in enumerate(data['field_strength_test']):
-        if field_strength == clf_config.source_field_strength:
-            source_indices.append(i)
-            source_true_labels.append(labels_test[i])
-        elif field_strength == clf_config.target_field_strength:
-            target_indices.append(i)
-            target_true_labels.append(labels_test[i])
+    metadata = get_metadata_index(data)
+    labels_test = metadata['test']['diagnosis'].tolist()
+    source_indices, target_indices = [ind.tolist() for ind in metadata.domain_indices(
+        'test', clf_config.source_field_strength, clf_config.target_field_strength)]
+    source_true_labels = metadata['test']['diagnosis'][source_indices].tolist()
+    target_true_labels = metadata['test']['diagnosis'][target_indices].tolist()
 
     # check that the source and target images together are all images
     all_indices = source_indices + target_indices
@@ -139,7 +133,7 @@ def classifier_test(clf_experiment_path, score_functions, batch_size=1, balanced
             (source_indices, source_true_labels), (target_indices, target_true_labels), random_seed=0)
         all_indices = source_indices_new + target_indices_new
         all_indices.sort()
-        labels_test = [label for ind, label in enumerate(labels_test) if ind in all_indices]
+        labels_test = metadata['test']['diagnosis'][all_indices].tolist()
 
         # to make sure the new indices and labels are subsets of the old ones
         source_label_count = Counter(source_true_labels_new)
@@ -207,8 +201,7 @@ def classifier_test(clf_experiment_path, score_functions, batch_size=1, balanced
     logging.info('target label distribution ' + str(target_label_count))
 
     # find out how many unique subjects there are in the test set
-    rid_numbers = data['rid_test']
-    reduced_rid_numbers = [number for ind, number in enumerate(rid_numbers) if ind in all_indices]
+    reduced_rid_numbers = metadata['test']['rid'][all_indices]
     logging.info('number of unique subjects: %d' % len(np.unique(reduced_rid_numbers)))
 
     scores = {}
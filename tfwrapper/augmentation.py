@@ -0,0 +1,169 @@
+# Authors:
+# Jonathan Dietrich
+
+# augmentation of image batches with shape [N, x, y, z, channels] inside the graph
+# The augmentation runs on the thread pool of TensorFlow as part of the training step instead of in the python input
+# thread. It is only applied when the training placeholder is True, so the same graph is used for the evaluation.
+
+import numpy as np
+import tensorflow as tf
+
+
+def random_flip(images, axis=1, seed=None):
+    '''
+    Flips every image of the batch with probability 0.5 along axis
+    '''
+    flip = tf.random_uniform([tf.shape(images)[0]], 0, 1, seed=seed) < 0.5
+    return tf.where(flip, tf.reverse(images, axis=[axis]), images)
+
+
+def random_intensity(images, scale_range=(0.9, 1.1), shift_range=(-0.1, 0.1), seed=None):
+    '''
+    Scales and shifts the intensities of every image of the batch by a random factor and offset
+    '''
+    n_dims = images.get_shape().ndims
+    parameter_shape = tf.concat([tf.shape(images)[:1], tf.ones([n_dims - 1], dtype=tf.int32)], axis=0)
+    scales = tf.random_uniform(parameter_shape, scale_range[0], scale_range[1], seed=seed)
+    shifts = tf.random_uniform(parameter_shape, shift_range[0], shift_range[1],
+                               seed=None if seed is None else seed + 1)
+    return images*scales + shifts
+
+
+def rotation_matrices(angles):
+    '''
+    3D rotation matrices for a batch of rotation angles (same as batch_augmentors.rotation_matrices)
+    :param angles: tensor with shape [N, 3] with the angles [rad] around the three image axes
+    :return: tensor with shape [N, 3, 3]
+    '''
+    cos = tf.cos(angles)
+    sin = tf.sin(angles)
+    zeros = tf.zeros_like(angles[:, 0])
+    ones = tf.ones_like(angles[:, 0])
+
+    def matrix(rows):
+        return tf.stack([tf.stack(row, axis=-1) for row in rows], axis=-2)
+
+    rotation_0 = matrix([[ones, zeros, zeros],
+                         [zeros, cos[:, 0], -sin[:, 0]],
+                         [zeros, sin[:, 0], cos[:, 0]]])
+    rotation_1 = matrix([[cos[:, 1], zeros, -sin[:, 1]],
+                         [zeros, ones, zeros],
+                         [sin[:, 1], zeros, cos[:, 1]]])
+    rotation_2 = matrix([[cos[:, 2], -sin[:, 2], zeros],
+                         [sin[:, 2], cos[:, 2], zeros],
+                         [zeros, zeros, ones]])
+    return tf.matmul(tf.matmul(rotation_0, rotation_1), rotation_2)
+
+
+def affine_warp(images, matrices):
+    '''
+    Resamples every image of the batch with its own affine transformation around the image center (trilinear
+    interpolation, coordinates outside the image are clamped to the border)
+    :param images: tensor with shape [N, x, y, z, channels] with known spatial dimensions
+    :param matrices: tensor with shape [N, 3, 3] that maps the coordinates of the warped image to the coordinates of
+    the original image
+    :return: warped images with the same shape as images
+    '''
+    image_shape = images.get_shape().as_list()[1:4]
+    n_channels = images.get_shape().as_list()[4]
+    n_images = tf.shape(images)[0]
+    n_voxels = int(np.prod(image_shape))
+    center = (np.asarray(image_shape, dtype=np.float32) - 1) / 2
+
+    # coordinates of all voxels relative to the center [n_voxels, 3]
+    grid = np.stack(np.meshgrid(*[np.arange(size, dtype=np.float32) for size in image_shape], indexing='ij'), axis=-1)
+    grid = tf.constant(grid.reshape([n_voxels, 3]) - center)
+
+    # source coordinates [N, n_voxels, 3]
+    coordinates = tf.matmul(tf.tile(grid[tf.newaxis, ...], [n_images, 1, 1]), matrices, transpose_b=True) + center
+    max_coordinates = np.asarray(image_shape, dtype=np.float32) - 1
+    coordinates = tf.clip_by_value(coordinates, 0.0, max_coordinates)
+    lower = tf.floor(coordinates)
+    weights_upper = coordinates - lower
+    lower = tf.cast(lower, tf.int32)
+    upper = tf.minimum(lower + 1, tf.constant(max_coordinates.astype(np.int32)))
+
+    # the corners are gathered from the flattened batch
+    flat_images = tf.reshape(images, [-1, n_channels])
+    strides = [image_shape[1]*image_shape[2], image_shape[2], 1]
+    batch_offsets = (tf.range(n_images) * n_voxels)[:, tf.newaxis]
+
+    warped = 0
+    for corner in range(8):
+        corner_weight = 1
+        flat_index = batch_offsets
+        for axis in range(3):
+            if (corner >> axis) & 1:
+                index = upper[..., axis]
+                weight = weights_upper[..., axis]
+            else:
+                index = lower[..., axis]
+                weight = 1 - weights_upper[..., axis]
+            flat_index = flat_index + index*strides[axis]
+            corner_weight = corner_weight*weight
+        warped += tf.gather(flat_images, flat_index) * corner_weight[..., tf.newaxis]
+
+    return tf.reshape(warped, tf.shape(images))
+
+
+def random_affine_warp(images, do_rotations=True, do_scaleaug=True, max_rotation_degrees=10.0, scale_range=(0.9, 1.1),
+                       seed=None):
+    '''
+    Rotates every image of the batch by random angles around the three axes and/or scales it by a random factor
+    '''
+    n_images = tf.shape(images)[0]
+    matrices = tf.tile(tf.eye(3)[tf.newaxis, ...], [n_images, 1, 1])
+    if do_rotations:
+        max_rotation = np.deg2rad(max_rotation_degrees)
+        matrices = rotation_matrices(tf.random_uniform([n_images, 3], -max_rotation, max_rotation, seed=seed))
+    if do_scaleaug:
+        matrices = matrices / tf.random_uniform([n_images, 1, 1], scale_range[0], scale_range[1],
+                                                seed=None if seed is None else seed + 1)
+    return affine_warp(images, matrices)
+
+
+def augment_images(images, training, do_fliplr=True, do_rotations=False, do_scaleaug=False, do_intensityaug=False,
+                   max_rotation_degrees=10.0, scale_range=(0.9, 1.1), intensity_scale_range=(0.9, 1.1),
+                   intensity_shift_range=(-0.1, 0.1), seed=None):
+    '''
+    Random augmentation of an image batch in the graph, see BatchAugmentor in batch_augmentors.py for the python version
+    :param images: image placeholder or tensor with shape [N, x, y, z, channels]
+    :param training: boolean placeholder, the images are only augmented if it is True
+    :param do_fliplr: random flips along the first image axis
+    :param do_rotations: random small rotations around the image center
+    :param do_scaleaug: random isotropic scaling. Rotations and scaling are one trilinear resampling of the whole
+    batch, which needs memory for the coordinates of all voxels of the batch
+    :param do_intensityaug: random intensity scaling and shift
+    :param seed: operation seed of the random ops
+    :return: augmented images with the same shape
+    '''
+    def augmented():
+        augmented_images = images
+        if do_fliplr:
+            augmented_images = random_flip(augmented_images, axis=1, seed=seed)
+        if do_rotations or do_scaleaug:
+            augmented_images = random_affine_warp(augmented_images, do_rotations, do_scaleaug, max_rotation_degrees,
+                                                  scale_range, seed=None if seed is None else seed + 10)
+        if do_intensityaug:
+            augmented_images = random_intensity(augmented_images, intensity_scale_range, intensity_shift_range,
+                                                seed=None if seed is None else seed + 20)
+        return augmented_images
+
+    with tf.name_scope('augmentation'):
+        augmented_images = tf.cond(training, augmented, lambda: images)
+        augmented_images.set_shape(images.get_shape())
+        return augmented_images
+
+
+def augment_images_with_config(images, training, exp_config):
+    '''
+    augment_images with the augmentation settings of an experiment config (do_fliplr, do_rotations, do_scaleaug,
+    do_intensityaug). Returns the images unchanged if exp_config.use_graph_augmentation is False.
+    '''
+    if not exp_config.use_graph_augmentation:
+        return images
+    return augment_images(images, training,
+                          do_fliplr=exp_config.do_fliplr,
+                          do_rotations=exp_config.do_rotations,
+                          do_scaleaug=exp_config.do_scaleaug,
+                          do_intensityaug=exp_config.do_intensityaug)
@@ -0,0 +1,88 @@
+# Authors:
+# Jonathan Dietrich
+
+# gradient accumulation over micro batches in the graph
+# One sess.run of GradientAccumulator.train_op adds the gradients of the fed batch to the accumulators and increments
+# a counter. On the n_accum_batches-th batch the same call divides the accumulated gradients by n_accum_batches, applies
+# them and resets the accumulators and the counter. So a training step needs neither separate runs for averaging and
+# applying the gradients nor a second feed of the image batch.
+# With average_externally the accumulated gradients are averaged outside of the graph before they are applied (e.g. over
+# the workers of the data parallel training in data_parallel.py).
+
+import tensorflow as tf
+
+
+class GradientAccumulator(object):
+    '''
+    Accumulates the gradients of loss over n_accum_batches batches and applies their mean with the optimizer.
+    The accumulators and the counter are local variables (not saved in the checkpoints), they are initialized by
+    tf.local_variables_initializer() or self.initializer.
+    '''
+    def __init__(self, optimizer, loss, var_list=None, n_accum_batches=1, average_externally=False,
+                 name='gradient_accumulation'):
+        '''
+        :param optimizer: tf.train optimizer that applies the gradients
+        :param loss: loss of a (micro) batch
+        :param var_list: variables that are trained, all trainable variables if None. Variables without gradient
+        (e.g. the moving averages of batch normalization) are skipped
+        :param n_accum_batches: number of batches the gradients are accumulated over
+        :param average_externally: if True there is no train_op. accum_op accumulates the gradients of a batch and
+        evaluates to the number of accumulated batches. After n_accum_batches batches the mean gradients
+        (mean_gradients) are averaged outside of the graph and applied by feeding them into gradient_placeholders and
+        running apply_op, which also resets the accumulators
+        '''
+        self.n_accum_batches = n_accum_batches
+
+        # The with statement is needed to make sure batch norm properly performs its updates
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        with tf.control_dependencies(update_ops):
+            grads_vars = [(grad, var) for grad, var in optimizer.compute_gradients(loss, var_list=var_list)
+                          if grad is not None]
+
+        with tf.variable_scope(name):
+            self.accum_vars = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                           collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                           name=var.op.name.replace('/', '_'))
+                               for _, var in grads_vars]
+            self.counter = tf.Variable(0, dtype=tf.int32, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                       name='counter')
+            self.initializer = tf.variables_initializer(self.accum_vars + [self.counter])
+
+            # The optimizer creates its slots (e.g. the moments of Adam) the first time it applies gradients. They
+            # can't be created inside the tf.cond below, so they are created here with an apply op that is never run
+            optimizer.apply_gradients(grads_vars, name='create_slots')
+
+            accum_op = tf.group(*[accum_var.assign_add(grad) for accum_var, (grad, _) in zip(self.accum_vars,
+                                                                                            grads_vars)])
+            with tf.control_dependencies([accum_op]):
+                count = self.counter.assign_add(1)
+
+            def apply_and_reset():
+                apply_op = optimizer.apply_gradients([(accum_var / float(n_accum_batches), var)
+                                                      for accum_var, (_, var) in zip(self.accum_vars, grads_vars)])
+                with tf.control_dependencies([apply_op]):
+                    reset_op = self._reset()
+                with tf.control_dependencies([reset_op]):
+                    return tf.constant(True)
+
+            if average_externally:
+                self.accum_op = count
+                self.mean_gradients = [accum_var / float(n_accum_batches) for accum_var in self.accum_vars]
+                self.gradient_placeholders = [tf.placeholder(var.dtype.base_dtype, var.get_shape(),
+                                                             name='gradient_' + var.op.name.replace('/', '_'))
+                                              for _, var in grads_vars]
+                apply_op = optimizer.apply_gradients(list(zip(self.gradient_placeholders,
+                                                              [var for _, var in grads_vars])))
+                with tf.control_dependencies([apply_op]):
+                    self.apply_op = self._reset()
+                self.train_op = None
+            else:
+                # evaluates to True if the gradients were applied in this call
+                self.train_op = tf.cond(tf.equal(count, n_accum_batches), apply_and_reset, lambda: tf.constant(False))
+
+            # discards the gradients of an incomplete accumulation (e.g. at the start of an epoch)
+            self.reset_op = self._reset()
+
+    def _reset(self):
+        return tf.group(*([accum_var.assign(tf.zeros_like(accum_var)) for accum_var in self.accum_vars]
+                          + [self.counter.assign(0)]))
@@ -406,6 +406,32 @@ def residual_block_original(bottom,
         return last_layer + bottom
 
 
+def recomputed_block(block_function, bottom, recompute=True):
+    '''
+    Gradient checkpointing of a block of layers: only the input of the block is kept for the backward pass, the
+    activations inside the block are recomputed from it when the gradients are computed. Saves the memory of the
+    intermediate activations for the time of a second forward pass through the block.
+    The variables of the block are resource variables (checkpoints are compatible with the normal layers). In the
+    recomputation the batch norm layers use the batch statistics of the forward pass again, their moving averages and
+    summaries are only updated in the forward pass.
+    :param block_function: function(bottom) -> top that builds the layers of the block in its own variable scope. It
+    must not contain random ops like dropout (the recomputation would draw different random numbers)
+    :param recompute: if False the block is built normally
+    :return: top of the block
+    '''
+    if not recompute:
+        return block_function(bottom)
+
+    def block(block_bottom, is_recomputing=False):
+        if not is_recomputing:
+            return block_function(block_bottom)
+        with utils.discard_collection_additions():
+            return block_function(block_bottom)
+
+    with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+        return tf.contrib.layers.recompute_grad(block)(bottom)
+
+
 def reduce_avg_layer3D(x, name=None):
     op = tf.reduce_mean(x, axis=(1,2,3), keep_dims=False, name=name)
     tf.summary.histogram(op.op.name + '/activations', op)
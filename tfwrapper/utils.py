@@ -1,6 +1,8 @@
 # Authors:
 # Christian F. Baumgartner (c.f.baumgartner@gmail.com)
 
+import contextlib
+
 import tensorflow as tf
 import numpy as np
 from math import sqrt
@@ -111,4 +113,19 @@ def put_kernels_on_grid3d(images, axis, cut_index, pad=1, rescale_mode='automati
         image_cut = images[:, :, cut_index, :, :]
     elif axis == 2:
         image_cut = images[:, :, :, cut_index, :]
-    return put_kernels_on_grid(image_cut, pad, rescale_mode, input_range, cutoff_abs)
\ No newline at end of file
+    return put_kernels_on_grid(image_cut, pad, rescale_mode, input_range, cutoff_abs)
+
+
+@contextlib.contextmanager
+def discard_collection_additions(graph=None):
+    '''
+    Removes everything that is added to the collections of the graph (summaries, batch norm updates, weight lists...)
+    inside the with block. Used for ops that are built a second time (e.g. recomputed activations) and must not be
+    picked up by merge_all, the train ops or the regularization.
+    '''
+    graph = tf.get_default_graph() if graph is None else graph
+    collection_sizes = {key: len(graph.get_collection(key)) for key in graph.get_all_collection_keys()}
+    yield
+    for key in graph.get_all_collection_keys():
+        if key not in (tf.GraphKeys.WHILE_CONTEXT, tf.GraphKeys.COND_CONTEXT):
+            del graph.get_collection_ref(key)[collection_sizes.get(key, 0):]
@@ -4,6 +4,7 @@
 
 # train the WGAN for image-to-image translation
 
+import functools
 import logging
 import time
 
@@ -19,7 +20,13 @@ import utils
 import adni_data_loader_all
 import adni_data_loader
 import data_utils
-from batch_generator_list import iterate_minibatches_endlessly
+from batch_generator_list import iterate_paired_minibatches_endlessly
+import batch_sampler
+from checkpoint_writer import CheckpointWriter
+from step_profiler import StepProfiler
+from resident_eval_set import ResidentEvalSet
+import input_pipeline
+from batch_sampler import StratifiedSampler
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
@@ -79,14 +86,32 @@ def run_training(continue_run, log_dir):
     generator = exp_config.generator
     discriminator = exp_config.discriminator
 
-    z_sampler_train = iterate_minibatches_endlessly(images_train,
-                                                    batch_size=exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    selection_indices=source_images_train_ind)
-    x_sampler_train = iterate_minibatches_endlessly(images_train,
-                                                    batch_size=exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    selection_indices=target_images_train_ind)
+    # index samplers of the training data. Their state is saved with the checkpoints to continue with the same data order
+    index_samplers = {'z': StratifiedSampler(source_images_train_ind, block_size=exp_config.sampling_block_size),
+                      'x': StratifiedSampler(target_images_train_ind, block_size=exp_config.sampling_block_size)}
+
+    # source (z) and target (x) batches are read together with one HDF5 read per step
+    zx_sampler_train = iterate_paired_minibatches_endlessly(images_train,
+                                                            source_batch_size=exp_config.batch_size,
+                                                            target_batch_size=exp_config.batch_size,
+                                                            exp_config=exp_config,
+                                                            source_sampler=index_samplers['z'],
+                                                            target_sampler=index_samplers['x'],
+                                                            max_bulk_megabytes=exp_config.max_bulk_read_megabytes)
+
+    # fixed validation batches (num_val_batches from each domain), read once and evaluated in the same order every time.
+    # The batches of the two domains are evaluated in pairs, so both sets get the same number of batches
+    n_val_images = exp_config.num_val_batches*exp_config.batch_size
+    n_val_images_domain = min(len(source_images_val_ind), len(target_images_val_ind))
+    if n_val_images_domain < n_val_images:
+        logging.warning('Only %d validation images in the smaller domain, %d validation batches are used instead of %d'
+                        % (n_val_images_domain, n_val_images_domain // exp_config.batch_size,
+                           exp_config.num_val_batches))
+        n_val_images = n_val_images_domain
+    z_val_set = ResidentEvalSet(images_val, exp_config.batch_size, exp_config, selection_indices=source_images_val_ind,
+                                max_images=n_val_images, name='source validation')
+    x_val_set = ResidentEvalSet(images_val, exp_config.batch_size, exp_config, selection_indices=target_images_val_ind,
+                                max_images=n_val_images, name='target validation')
 
 
     with tf.Graph().as_default():
@@ -102,11 +127,29 @@ def run_training(continue_run, log_dir):
         else:
             noise_in_gen_pl = None
 
-        # target image batch
-        x_pl = tf.placeholder(tf.float32, [exp_config.batch_size, im_s[0], im_s[1], im_s[2], exp_config.n_channels], name='x')
+        if exp_config.use_tf_data_pipeline:
+            # the training batches are read by a tf.data pipeline, every training run takes the next batch.
+            # z_pl and x_pl can still be fed (e.g. for validation)
+            sampler_history = input_pipeline.SamplerStateHistory(index_samplers)
+            train_dataset = input_pipeline.paired_dataset(images_train,
+                                                          source_batch_size=exp_config.batch_size,
+                                                          target_batch_size=exp_config.batch_size,
+                                                          exp_config=exp_config,
+                                                          source_sampler=index_samplers['z'],
+                                                          target_sampler=index_samplers['x'],
+                                                          num_parallel_calls=exp_config.pipeline_parallel_reads,
+                                                          prefetch_batches=exp_config.pipeline_prefetch_batches,
+                                                          sampler_history=sampler_history)
+            train_input = input_pipeline.PipelineInput(train_dataset, names=['z', 'x'], sampler_history=sampler_history)
+            z_pl, x_pl = train_input.tensors
+        else:
+            train_input = None
+
+            # target image batch
+            x_pl = tf.placeholder(tf.float32, [exp_config.batch_size, im_s[0], im_s[1], im_s[2], exp_config.n_channels], name='x')
 
-        # source image batch
-        z_pl = tf.placeholder(tf.float32, [exp_config.batch_size, im_s[0], im_s[1], im_s[2], exp_config.n_channels], name='z')
+            # source image batch
+            z_pl = tf.placeholder(tf.float32, [exp_config.batch_size, im_s[0], im_s[1], im_s[2], exp_config.n_channels], name='z')
 
         # generated fake image batch
         x_pl_ = generator(z_pl, noise_in_gen_pl, training_placeholder)
@@ -147,6 +190,16 @@ def run_training(continue_run, log_dir):
 
         dist_l1 = tf.reduce_mean(tf.abs(diff_img_pl))
 
+        # the critic iterations of a step run in one session call, reading their batches directly from the pipeline
+        fuse_critic_iterations = exp_config.fuse_critic_iterations and train_input is not None
+        if exp_config.fuse_critic_iterations and not fuse_critic_iterations:
+            logging.warning('fuse_critic_iterations requires use_tf_data_pipeline, running the critic iterations one by one')
+        if fuse_critic_iterations:
+            # shared by the discriminator train op and the fused critic op
+            discriminator_optimizer = gan_model.make_optimizer(exp_config.optimizer_handle, exp_config.learning_rate)
+        else:
+            discriminator_optimizer = None
+
         # nr means no regularization, meaning the loss without the regularization term
         discriminator_train_op, generator_train_op, \
         disc_loss_pl, gen_loss_pl, \
@@ -159,12 +212,42 @@ def run_training(continue_run, log_dir):
                                                                  w_reg_disc_l1=exp_config.w_reg_disc_l1,
                                                                  w_reg_gen_l2=exp_config.w_reg_gen_l2,
                                                                  w_reg_disc_l2=exp_config.w_reg_disc_l2,
-                                                                 d_hat=d_hat, x_hat=x_hat, scale=exp_config.scale)
+                                                                 d_hat=d_hat, x_hat=x_hat, scale=exp_config.scale,
+                                                                 discriminator_optimizer=discriminator_optimizer)
 
 
         # Build the operation for clipping the discriminator weights
         d_clip_op = gan_model.clip_op()
 
+        if fuse_critic_iterations:
+            disc_weights = gan_model.discriminator_weights()
+
+            def critic_loss_function():
+                # one critic iteration with the next batch of the pipeline
+                z, x = train_input.iterator.get_next()
+                if exp_config.use_generator_input_noise:
+                    noise_in_gen = tf.random_uniform(shape=exp_config.generator_input_noise_shape, minval=-1, maxval=1)
+                else:
+                    noise_in_gen = None
+                x_ = generator(z, noise_in_gen, training_placeholder, scope_reuse=True)
+                d_real = discriminator(x, training_placeholder, scope_reuse=True)
+                d_fake = discriminator(x_, training_placeholder, scope_reuse=True)
+                d_hat_iteration = None
+                x_hat_iteration = None
+                if exp_config.improved_training:
+                    epsilon_iteration = tf.random_uniform([], 0.0, 1.0)
+                    x_hat_iteration = epsilon_iteration * x + (1 - epsilon_iteration) * x_
+                    d_hat_iteration = discriminator(x_hat_iteration, training_placeholder, scope_reuse=True)
+                return gan_model.critic_loss(d_real, d_fake, disc_weights,
+                                             w_reg_disc_l1=exp_config.w_reg_disc_l1,
+                                             w_reg_disc_l2=exp_config.w_reg_disc_l2,
+                                             d_hat=d_hat_iteration, x_hat=x_hat_iteration, scale=exp_config.scale)
+
+            n_critic_iterations_pl = tf.placeholder(tf.int32, shape=[], name='n_critic_iterations')
+            fused_critic_train_op = gan_model.fused_critic_op(critic_loss_function, discriminator_optimizer,
+                                                              n_critic_iterations_pl,
+                                                              clip_weights=not exp_config.improved_training)
+
         # Put L1 distance of generated image and original image on summary
         dist_l1_summary_op = tf.summary.scalar('L1_distance_to_source_img', dist_l1)
 
@@ -184,8 +267,10 @@ def run_training(continue_run, log_dir):
         init = tf.global_variables_initializer()
 
         # Create a savers for writing training checkpoints.
-        saver_latest = tf.train.Saver(max_to_keep=3)
-        saver_best_disc = tf.train.Saver(max_to_keep=3)  # disc loss is scaled negative EM distance
+        # the checkpoints are written in a background thread
+        checkpoint_writer = CheckpointWriter()
+        saver_latest = checkpoint_writer.saver(max_to_keep=3)
+        saver_best_disc = checkpoint_writer.saver(max_to_keep=3)  # disc loss is scaled negative EM distance
 
         # prevents ResourceExhaustError when a lot of memory is used
         config = tf.ConfigProto()
@@ -203,93 +288,114 @@ def run_training(continue_run, log_dir):
         if continue_run:
             # Restore session
             saver_latest.restore(sess, init_checkpoint_path)
-
+            batch_sampler.restore_sampler_states(init_checkpoint_path, index_samplers)
+
+        if train_input is not None:
+            # start the input pipeline after the sampler states are restored
+            sess.run(train_input.initializer)
+
+        def next_train_feed_dict(feed_dict, batch=None):
+            # adds the next training batch (or the given batch) to the feed_dict. With the pipeline the run takes the
+            # next batch itself
+            if train_input is not None:
+                train_input.consumed()
+            else:
+                z, x = next(zx_sampler_train) if batch is None else batch
+                feed_dict.update({z_pl: z, x_pl: x})
+            return feed_dict
 
         # initialize value of lowest (i. e. best) discriminator loss
         best_d_loss = np.inf
 
+        # time of the phases of the steps, optionally with Chrome trace timelines of the session runs
+        profiler = StepProfiler(log_frequency=exp_config.profile_log_frequency,
+                                trace_frequency=exp_config.trace_frequency,
+                                trace_dir=os.path.join(log_dir, 'timelines'))
+
         for step in range(init_step, 1000000):
 
             start_time = time.time()
+            profiler.start_step(step)
 
             # discriminator training iterations
             d_iters = 5
             if step % 500 == 0 or step < 25:
                 d_iters = 100
 
-            for _ in range(d_iters):
+            # the batches of all critic iterations are read with one bulk read (the pipeline reads in parallel)
+            if fuse_critic_iterations:
+                # all iterations (including clipping) in one call
+                profiler.run(sess, 'critic', fused_critic_train_op, feed_dict={n_critic_iterations_pl: d_iters,
+                                                                               training_placeholder: True})
+                train_input.consumed(d_iters)
+                critic_batches = []
+            elif train_input is None:
+                with profiler.phase('data'):
+                    critic_batches = zx_sampler_train.next_batches(d_iters)
+            else:
+                critic_batches = [None]*d_iters
 
-                x = next(x_sampler_train)
-                z = next(z_sampler_train)
+            for batch in critic_batches:
+
+                with profiler.phase('data'):
+                    feed_dict = next_train_feed_dict({training_placeholder: True}, batch)
 
                 # train discriminator
-                sess.run(discriminator_train_op,
-                         feed_dict={z_pl: z, x_pl: x, training_placeholder: True})
+                profiler.run(sess, 'critic', discriminator_train_op, feed_dict=feed_dict)
 
                 if not exp_config.improved_training:
-                    sess.run(d_clip_op)
+                    profiler.run(sess, 'critic', d_clip_op)
 
             elapsed_time = time.time() - start_time
 
             # train generator
-            x = next(x_sampler_train)  # why not sample a new x??
-            z = next(z_sampler_train)
-            sess.run(generator_train_op,
-                     feed_dict={z_pl: z, x_pl: x, training_placeholder: True})
+            with profiler.phase('data'):
+                feed_dict = next_train_feed_dict({training_placeholder: True})
+            profiler.run(sess, 'generator', generator_train_op, feed_dict=feed_dict)
 
             if step % exp_config.update_tensorboard_frequency == 0:
 
-                x = next(x_sampler_train)
-                z = next(z_sampler_train)
-
-                g_loss_train, d_loss_train, summary_str = sess.run(
-                        [gen_loss_nr_pl, disc_loss_nr_pl, summary_op], feed_dict={z_pl: z, x_pl: x, training_placeholder: False})
+                with profiler.phase('summaries'):
+                    g_loss_train, d_loss_train, summary_str = sess.run(
+                            [gen_loss_nr_pl, disc_loss_nr_pl, summary_op],
+                            feed_dict=next_train_feed_dict({training_placeholder: False}))
 
-                summary_writer.add_summary(summary_str, step)
-                summary_writer.flush()
+                    summary_writer.add_summary(summary_str, step)
+                    summary_writer.flush()
 
-                logging.info("[Step: %d], generator loss: %g, discriminator_loss: %g" % (step, g_loss_train, d_loss_train))
-                logging.info(" - elapsed time for one step: %f secs" % elapsed_time)
+                    logging.info("[Step: %d], generator loss: %g, discriminator_loss: %g" % (step, g_loss_train, d_loss_train))
+                    logging.info(" - elapsed time for one step: %f secs" % elapsed_time)
 
 
             if step % exp_config.validation_frequency == 0:
 
-                z_sampler_val = iterate_minibatches_endlessly(images_val,
-                                                    batch_size=exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    selection_indices=source_images_val_ind)
-                x_sampler_val = iterate_minibatches_endlessly(images_val,
-                                                    batch_size=exp_config.batch_size,
-                                                    exp_config=exp_config,
-                                                    selection_indices=target_images_val_ind)
-
-                # evaluate the validation batch with batch_size images (from each domain) at a time
-                g_loss_val_list = []
-                d_loss_val_list = []
-                for _ in range(exp_config.num_val_batches):
-                    x = next(x_sampler_val)
-                    z = next(z_sampler_val)
-                    g_loss_val, d_loss_val = sess.run(
-                        [gen_loss_nr_pl, disc_loss_nr_pl], feed_dict={z_pl: z,
-                                                                      x_pl: x,
-                                                                      training_placeholder: False})
-                    g_loss_val_list.append(g_loss_val)
-                    d_loss_val_list.append(d_loss_val)
-
-                g_loss_val_avg = np.mean(g_loss_val_list)
-                d_loss_val_avg = np.mean(d_loss_val_list)
-
-                validation_summary_str = sess.run(val_summary_op, feed_dict={val_disc_loss_pl: d_loss_val_avg,
-                                                                                 val_gen_loss_pl: g_loss_val_avg}
-                                             )
-                summary_writer.add_summary(validation_summary_str, step)
-                summary_writer.flush()
+                with profiler.phase('validation'):
+                    # evaluate the validation batch with batch_size images (from each domain) at a time
+                    g_loss_val_list = []
+                    d_loss_val_list = []
+                    for z, x in zip(z_val_set.batches(), x_val_set.batches()):
+                        g_loss_val, d_loss_val = sess.run(
+                            [gen_loss_nr_pl, disc_loss_nr_pl], feed_dict={z_pl: z,
+                                                                          x_pl: x,
+                                                                          training_placeholder: False})
+                        g_loss_val_list.append(g_loss_val)
+                        d_loss_val_list.append(d_loss_val)
+
+                    g_loss_val_avg = np.mean(g_loss_val_list)
+                    d_loss_val_avg = np.mean(d_loss_val_list)
+
+                    validation_summary_str = sess.run(val_summary_op, feed_dict={val_disc_loss_pl: d_loss_val_avg,
+                                                                                     val_gen_loss_pl: g_loss_val_avg}
+                                                 )
+                    summary_writer.add_summary(validation_summary_str, step)
+                    summary_writer.flush()
 
                 # save best variables (if discriminator loss is the lowest yet)
                 if d_loss_val_avg <= best_d_loss:
                     best_d_loss = d_loss_val_avg
                     best_file = os.path.join(log_dir, 'model_best_d_loss.ckpt')
-                    saver_best_disc.save(sess, best_file, global_step=step)
+                    with profiler.phase('checkpoint'):
+                        saver_best_disc.save(sess, best_file, global_step=step)
                     logging.info('Found new best discriminator loss on validation set! - %f -  Saving model_best_d_loss.ckpt' % best_d_loss)
 
                 logging.info("[Validation], generator loss: %g, discriminator_loss: %g" % (g_loss_val_avg, d_loss_val_avg))
@@ -297,7 +403,18 @@ def run_training(continue_run, log_dir):
             # Write the summaries and print an overview fairly often.
             if step % exp_config.save_frequency == 0:
 
-                saver_latest.save(sess, os.path.join(log_dir, 'model.ckpt'), global_step=step)
+                with profiler.phase('checkpoint'):
+                    # the sampler states of this step are saved when the checkpoint is complete. The pipeline draws
+                    # ahead, its states after the batches that were trained on are saved
+                    if train_input is not None:
+                        states = train_input.sampler_states()
+                    else:
+                        states = batch_sampler.sampler_states(index_samplers)
+                    saver_latest.save(sess, os.path.join(log_dir, 'model.ckpt'), global_step=step,
+                                      after_write=functools.partial(batch_sampler.save_sampler_states, states=states))
+                    checkpoint_writer.log_stats()
+
+            profiler.end_step()
 
 
 
@@ -0,0 +1,243 @@
+# Authors:
+# Jonathan Dietrich
+
+# Cache of the source images of a preprocessed file translated by a GAN checkpoint
+# The translated images G(x_s) of the source domain images of the splits are computed once and stored in
+#   <preprocessing folder>/translated/<preprocessed file>__<GAN experiment>__<checkpoint>[_noise<seed>].hdf5
+# so the preprocessing settings, the GAN checkpoint and (for generators with input noise) the noise seed are part of
+# the key. The file contains for every split
+#   indices_<split>  indices of the translated images in the split (increasing)
+#   images_<split>   translated images with shape [len(indices_<split>), x, y, z]
+# The cache is only used if the preprocessed file and the checkpoint did not change after the translation.
+# TranslatedImages replaces the generator augmentation of the classifier training (use_translation_cache in the
+# adni_clf configs): the images of the split are read as usual and the cached images are swapped in for their
+# translations.
+#
+# usage: python translation_cache.py <GAN experiment log dir> [<GAN experiment log dir> ...]
+
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+import h5py
+
+import utils
+import hdf5_handles
+import dataset_server
+from batch_generator_list import read_images_into
+from metadata_index import get_metadata_index
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+TRANSLATED_FOLDER = 'translated'
+
+
+def checkpoint_signature(checkpoint_path):
+    # a checkpoint that was written again (e.g. a restarted experiment) gets a new signature
+    stat = os.stat(checkpoint_path + '.index')
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def translation_cache_path(data_file_path, checkpoint_path, noise_seed=None):
+    '''
+    :param data_file_path: path of the preprocessed HDF5 file
+    :param checkpoint_path: GAN checkpoint (e.g. log_dir/model.ckpt-20000)
+    :param noise_seed: seed of the generator input noise, None for generators without noise
+    :return: path of the cache file
+    '''
+    experiment_name = os.path.basename(os.path.dirname(os.path.abspath(checkpoint_path)))
+    noise_postfix = '' if noise_seed is None else '_noise%d' % noise_seed
+    file_name = '%s__%s__%s%s.hdf5' % (dataset_server.dataset_key(data_file_path), experiment_name,
+                                       os.path.basename(checkpoint_path), noise_postfix)
+    return os.path.join(os.path.dirname(data_file_path), TRANSLATED_FOLDER, file_name)
+
+
+def translate_dataset(data, generator, checkpoint_path, source_field_strength, splits=('train', 'val', 'test'),
+                      batch_size=8, noise_seed=None):
+    '''
+    Translates the source domain images of the splits with a restored generator and writes them into the cache
+    :param data: h5py file (or ForkSafeFile, SharedDataset) of the preprocessed data
+    :param generator: gan_model.Generator with the variables of checkpoint_path restored
+    :param checkpoint_path: checkpoint the generator was restored from
+    :param source_field_strength: field strength of the images that are translated
+    :param batch_size: number of images that are read and translated at once
+    :param noise_seed: seed of the generator input noise (required if the generator uses input noise)
+    :return: path of the cache file
+    '''
+    use_noise = generator.exp_config.use_generator_input_noise
+    if use_noise and noise_seed is None:
+        raise ValueError('The generator uses input noise, a noise seed is required for the translation cache')
+    if not use_noise:
+        noise_seed = None
+
+    path = translation_cache_path(data.filename, checkpoint_path, noise_seed)
+    utils.makefolder(os.path.dirname(path))
+    metadata = get_metadata_index(data)
+    noise_random_state = np.random.RandomState(noise_seed) if use_noise else None
+
+    # written into a temporary file that is renamed when complete, so a cache is never read partially
+    tmp_path = path + '.tmp%d' % os.getpid()
+    with h5py.File(tmp_path, 'w') as cache_file:
+        cache_file.attrs['checkpoint_path'] = os.path.abspath(checkpoint_path)
+        cache_file.attrs['checkpoint_signature'] = str(checkpoint_signature(checkpoint_path))
+        cache_file.attrs['data_signature'] = str(dataset_server.source_signature(data.filename))
+        cache_file.attrs['source_field_strength'] = source_field_strength
+
+        for split in splits:
+            images = data['images_%s' % split]
+            indices = metadata.indices(split, field_strength=source_field_strength)
+            cache_file.create_dataset('indices_%s' % split, data=indices)
+            translated = cache_file.create_dataset('images_%s' % split, [len(indices)] + list(images.shape[1:]),
+                                                   dtype=np.float32)
+            batch = np.empty([batch_size] + list(images.shape[1:]) + [1], dtype=np.float32)
+            for start in range(0, len(indices), batch_size):
+                batch_indices = indices[start:start + batch_size]
+                X = read_images_into(images, batch_indices, batch[:len(batch_indices)])
+                if use_noise:
+                    noise_shape = [len(batch_indices)] + list(generator.noise_shape[1:])
+                    noise_in = noise_random_state.uniform(low=-1.0, high=1.0, size=noise_shape)
+                else:
+                    noise_in = None
+                translated[start:start + len(batch_indices), ...] = generator.translate(X, noise_in)[..., 0]
+            logging.info('translated %d %s images' % (len(indices), split))
+
+    os.rename(tmp_path, path)
+    generator.log_throughput()
+    logging.info('Saved the translated images in %s' % path)
+    return path
+
+
+class TranslationCache(object):
+    '''
+    Translated images of a cache file, read with the indices of the images in the original split
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = hdf5_handles.ForkSafeFile(path)
+        self.indices = {key[len('indices_'):]: self.file[key][()] for key in self.file.keys()
+                        if key.startswith('indices_')}
+
+    def images(self, split):
+        '''
+        :return: dataset with the translated images of the split in the order of self.indices[split]
+        '''
+        return self.file['images_%s' % split]
+
+    def read(self, split, indices, out=None):
+        '''
+        Reads the translated images of the given images of a split
+        :param indices: indices of the images in the split (increasing), they must be in the cache
+        :param out: array with shape [len(indices), x, y, z, 1] for the images, allocated if None
+        :return: translated images with shape [len(indices), x, y, z, 1]
+        '''
+        indices = np.asarray(indices)
+        positions = np.searchsorted(self.indices[split], indices)
+        positions = np.minimum(positions, len(self.indices[split]) - 1)
+        if len(indices) > 0 and not np.array_equal(self.indices[split][positions], indices):
+            raise ValueError('Some images are not in the translation cache %s' % self.path)
+        images = self.images(split)
+        if out is None:
+            out = np.empty([len(indices)] + list(images.shape[1:]) + [1], dtype=np.float32)
+        return read_images_into(images, positions, out)
+
+    def close(self):
+        self.file.close()
+
+
+class TranslatedImages(object):
+    '''
+    Images of a split in which every cached image is replaced by its translation with probability translation_fraction
+    at every read. It can be passed as images to the batch iterators, the tf.data pipelines and ResidentEvalSet instead
+    of the generator augmentation (batch_augmentors.generator_augment). The fraction of translated images is the same
+    on average, but not in every batch. Images that are not in the cache (e.g. target domain images) are not changed.
+    '''
+    def __init__(self, images, translation_cache, split, translation_fraction=0.5, seed=None):
+        '''
+        :param images: hdf5 dataset or numpy array with shape [N, x, y, z] of the split
+        :param translation_cache: TranslationCache
+        :param translation_fraction: probability that a cached image is replaced by its translation
+        :param seed: seed of the choice of the translated images
+        '''
+        if translation_fraction < 0 or translation_fraction > 1:
+            raise ValueError('translation_fraction %f is outside the range [0, 1]' % translation_fraction)
+        self.images = images
+        self.translation_cache = translation_cache
+        self.split = split
+        self.translation_fraction = translation_fraction
+        self.shape = images.shape
+        self.dtype = np.dtype(np.float32)
+        self.cached_indices = translation_cache.indices[split]
+        self.random_state = np.random.RandomState(seed)
+        # the tf.data pipelines read in several threads
+        self.random_state_lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        # only ranges of images are read (like read_images_into does), e.g. images[start:stop, ...]
+        image_range = key[0] if isinstance(key, tuple) else key
+        if not isinstance(image_range, slice):
+            raise TypeError('TranslatedImages can only be read in ranges of images')
+        start, stop, step = image_range.indices(self.shape[0])
+        if step != 1:
+            raise TypeError('TranslatedImages can only be read in ranges of images')
+        out = np.array(self.images[start:stop, ...], dtype=np.float32)
+        in_range = self.cached_indices[np.searchsorted(self.cached_indices, start):
+                                       np.searchsorted(self.cached_indices, stop)]
+        with self.random_state_lock:
+            translated = self.random_state.uniform(size=len(in_range)) < self.translation_fraction
+        translated_indices = in_range[translated]
+        if len(translated_indices) > 0:
+            out[translated_indices - start, ...] = self.translation_cache.read(self.split, translated_indices)[..., 0]
+        return out
+
+
+def open_translation_cache(data, checkpoint_path, noise_seed=None):
+    '''
+    Opens the cache of the translated images of a GAN checkpoint
+    :param data: h5py file (or ForkSafeFile, SharedDataset) of the preprocessed data
+    :param checkpoint_path: GAN checkpoint
+    :param noise_seed: seed of the generator input noise, None for generators without noise
+    :return: TranslationCache or None if there is no cache or it is outdated
+    '''
+    path = translation_cache_path(data.filename, checkpoint_path, noise_seed)
+    if not os.path.exists(path):
+        return None
+    with h5py.File(path, 'r') as cache_file:
+        up_to_date = cache_file.attrs['data_signature'] == str(dataset_server.source_signature(data.filename)) \
+                     and cache_file.attrs['checkpoint_signature'] == str(checkpoint_signature(checkpoint_path))
+    if not up_to_date:
+        logging.warning('The translation cache %s is outdated and not used' % path)
+        return None
+    logging.info('Using the translated images in %s' % path)
+    return TranslationCache(path)
+
+
+if __name__ == '__main__':
+
+    import adni_data_loader_all
+    import gan_model
+
+    splits = ('train', 'val', 'test')
+    batch_size = 8  # <---------------------------------------------------------------------------------------------------
+    noise_seed = 0  # only used for generators with input noise # <-------------------------------------------------------
+
+    for gan_log_dir in sys.argv[1:]:
+        gan_config, _ = utils.load_log_exp_config(gan_log_dir)
+        data = adni_data_loader_all.load_and_maybe_process_data(
+            input_folder=gan_config.data_root,
+            preprocessing_folder=gan_config.preproc_folder,
+            size=gan_config.image_size,
+            target_resolution=gan_config.target_resolution,
+            label_list=gan_config.label_list,
+            offset=gan_config.offset,
+            rescale_to_one=gan_config.rescale_to_one,
+            force_overwrite=False
+        )
+        generator = gan_model.Generator(gan_log_dir, batch_size=batch_size)
+        checkpoint_path = generator.restore_variables(log_dir=gan_log_dir)
+        translate_dataset(data, generator, checkpoint_path, gan_config.source_field_strength, splits=splits,
+                          batch_size=batch_size, noise_seed=noise_seed)
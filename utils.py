@@ -16,40 +16,25 @@ import tensorflow as tf
 from collections import Counter
 from matplotlib.image import imsave
 
+import label_encodings
+
 
 def fstr_to_label(fieldstrengths, field_strength_list, label_list):
     # input fieldstrenghts hdf5 list
     # field_strength_list must have the same size as label_list
     # returns a numpy array of labels
-    assert len(label_list) == len(field_strength_list)
-    labels = np.empty_like(fieldstrengths, dtype=np.int16)
-    for fs_ind, current_field_strength in enumerate(fieldstrengths):
-        valid_value = False
-        for label_ind, current_label in enumerate(label_list):
-            if(current_field_strength == field_strength_list[label_ind]):
-                labels[fs_ind] = current_label
-                valid_value = True
-                break
-        if(not valid_value):
-            raise ValueError('unexpected value in fieldstrengths: %s' % current_field_strength)
-    return labels
+    # raises a ValueError for unexpected values in fieldstrengths
+    return label_encodings.fstr_to_label(fieldstrengths, field_strength_list, label_list)
 
 
 
 def age_to_ordinal_reg_format(ages, bins=(65, 70, 75, 80, 85)):
 
-    N = ages.shape[0]
-    P = len(bins)
-
-    ages_mat = np.transpose(np.tile(ages,(P,1)))
-    bins_mat = np.tile(bins, (N,1))
-
-    return np.array(ages_mat>bins_mat, dtype=np.uint8)
+    return label_encodings.age_to_ordinal_reg_format(ages, bins)
 
 def age_to_bins(ages,  bins=(65, 70, 75, 80, 85)):
 
-    ages_ordinal = age_to_ordinal_reg_format(ages, bins)
-    return np.sum(ages_ordinal, axis=-1)
+    return label_encodings.age_to_bins(ages, bins)
 
 
 def ordinal_regression_to_bin(ages_ord_reg):